@@ -1,26 +1,163 @@
+import asyncio
+import atexit
+import bisect
+import codecs
+import concurrent.futures
+import gzip
+import hashlib
+import io
 import json
+import multiprocessing.connection
+import operator
 import os
 import sys
 import uuid
+from collections import Counter, OrderedDict, deque
 import subprocess
 import tempfile
 import threading
-import queue
+import re
+import secrets
+import selectors
 import shutil
+import signal
+import sqlite3
 import time
+import urllib.parse
+import weakref
 from datetime import datetime
 from flask import Flask, render_template, request, jsonify, send_from_directory, Response
 
+try:
+    import brotli
+except ImportError:  # brotli необязателен, без него отдаём gzip
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессные блокировки файлов через msvcrt
+    fcntl = None
+    import msvcrt
+
+try:
+    from asgiref.sync import ThreadSensitiveContext
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:  # asgiref нужен только в режиме asgi
+    WsgiToAsgi = None
+
+try:
+    import zstandard
+except ImportError:  # zstandard необязателен, без него проекты в компактном формате сжимаются gzip
+    zstandard = None
+
 app = Flask(__name__)
 
-# Configuration - фиксированные настройки
+# Configuration - значения по умолчанию, переопределяются turtcd_config.json и переменными TURTCD_*
 config = {
     "is_host": True,
     "port": 5000,
-    "mod_allow": True
+    "mod_allow": True,
+    "session_output_limit": 1024 * 1024,  # characters of output kept per run session
+    "session_input_limit": 1024 * 1024,  # bytes of stdin waiting for the program per run session
+    "max_sessions": 16,  # concurrent run sessions
+    "session_exit_grace": 60,  # seconds a finished session stays readable
+    # Секунды без обращений клиента, после которых сессия (и работающая программа) удаляется;
+    # 0 - никогда: боты и серверы работают, пока их не остановят
+    "session_idle_timeout": 0,
+    "warm_workers": 0,  # pre-started interpreters waiting for a program, 0 - disabled
+    "project_backups": 3,  # previous versions kept per project in projects/.backups, 0 - none
+    "project_deleted_backups": 20,  # deleted projects whose backups are kept, older ones are removed
+    # Формат сохранения проектов: "json" - читаемый JSON, "compact" - сжатый (читаются оба)
+    "project_format": "json",
+    # Журнал патчей рядом с проектом (<имя>.turtcd.journal): сохранение дописывает одну строку,
+    # журнал длиннее project_journal_limit байт сворачивается в файл проекта
+    "project_journal": False,
+    "project_journal_limit": 256 * 1024,
+    # "thread" - reader thread per session, "async" - all sessions on one asyncio loop, "auto" - async in asgi mode
+    "session_backend": "auto",
+    # Адрес процесса-владельца сессий (Unix-сокет, в Windows - именованный канал), "" - сессии в этом процессе.
+    # При server.workers > 1 в режиме asgi такой процесс запускается автоматически
+    "session_supervisor": "",
+    # Общий секрет для подключений к session_supervisor, обязателен (не короче 16 символов);
+    # вместо него можно указать файл с ключом. При автоматическом запуске сервиса генерируется
+    # случайный ключ и передаётся процессам сервера через файл с правами 0600
+    "session_supervisor_key": "",
+    "session_supervisor_key_file": "",
+    # Ограничения запуска по режиму безопасности, 0 - без ограничения.
+    # cpu_seconds, memory_mb и wall_seconds завершают программу (limit_hit в статусе сессии),
+    # поэтому по умолчанию выключены: боты работают часами.
+    # output_rate - символов вывода в секунду, output_action - "throttle" или "kill"
+    "run_limits": {
+        "restricted": {"cpu_seconds": 0, "memory_mb": 0, "wall_seconds": 0, "output_rate": 200000, "output_action": "throttle"},
+        "limited": {"cpu_seconds": 0, "memory_mb": 0, "wall_seconds": 0, "output_rate": 500000, "output_action": "throttle"},
+        "full": {"cpu_seconds": 0, "memory_mb": 0, "wall_seconds": 0, "output_rate": 0, "output_action": "throttle"}
+    },
+    # Режим сервера: "dev" - встроенный сервер Flask, "wsgi" - waitress, "asgi" - uvicorn
+    "server": {
+        "mode": "dev",
+        "workers": 1,  # server processes
+        "threads": 16,  # request handler threads per process
+        "keepalive": 5,  # seconds an idle keep-alive connection (or a stalled request in wsgi mode) stays open
+        "timeout": 120,  # seconds to start answering a request (asgi), streamed bodies are not limited
+        "max_body_mb": 100,  # largest request body (wsgi)
+        "connections": 1000  # simultaneous connections per process
+    }
 }
 
+CONFIG_FILE_PATH = os.environ.get('TURTCD_CONFIG', 'turtcd_config.json')
+CONFIG_ENV_PREFIX = 'TURTCD_'
+
+
+def _merge_settings(target, overrides):
+    for key, value in overrides.items():
+        if isinstance(target.get(key), dict) and isinstance(value, dict):
+            _merge_settings(target[key], value)
+        else:
+            target[key] = value
+
+
+def _coerce_setting(value, default):
+    """Convert an environment variable string to the type of the default value."""
+    if isinstance(default, bool):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    return value
+
+
+def apply_config_overrides(target, path=CONFIG_FILE_PATH, environ=os.environ):
+    """Merge settings from the JSON config file, then from the environment.
+
+    Sections such as "server" or "run_limits" are merged key by key, so the
+    file only needs the values that differ. Environment variables override
+    scalar settings and the keys of the "server" section: TURTCD_PORT,
+    TURTCD_SERVER_MODE, TURTCD_SERVER_THREADS and so on.
+    """
+    if os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                _merge_settings(target, json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"Ошибка чтения настроек {path}: {e}")
+    settings = [(key, target, key) for key, value in target.items() if not isinstance(value, dict)]
+    settings += [(f"server_{key}", target["server"], key) for key in target["server"]]
+    for name, section, key in settings:
+        env_name = CONFIG_ENV_PREFIX + name.upper()
+        if env_name not in environ:
+            continue
+        try:
+            section[key] = _coerce_setting(environ[env_name], section[key])
+        except ValueError:
+            print(f"Некорректное значение {env_name}={environ[env_name]!r}, оставлено {section[key]!r}")
+
+
+apply_config_overrides(config)
+
 BLOCKS_CONFIG_PATH = 'blocks_config.json'
+MODS_FOLDER = 'mods'
+BLOCKS_WATCH_INTERVAL = 1.0  # seconds between checks of blocks_config.json and mods/
 LICENSE_FILE_PATH = 'license.txt'
 LICENSE_ACCEPT_MARKER = '.turtcd_license.accepted'
 REQUIREMENTS_FILE_PATH = 'requirements.txt'
@@ -68,7 +205,7 @@ DEFAULT_BLOCKS_CONFIG = {
 }
 
 
-def load_blocks_config():
+def _read_core_blocks_config():
     # Load main config
     if os.path.exists(BLOCKS_CONFIG_PATH):
         with open(BLOCKS_CONFIG_PATH, 'r', encoding='utf-8') as f:
@@ -77,50 +214,315 @@ def load_blocks_config():
         config = DEFAULT_BLOCKS_CONFIG.copy()
         with open(BLOCKS_CONFIG_PATH, 'w', encoding='utf-8') as f:
             json.dump(config, f, ensure_ascii=False, indent=2)
-    
+
     # Ensure core categories have mod metadata
-    for cat in config.get('categories', []):
+    for cat in config.setdefault('categories', []):
         cat.setdefault('modId', 'core')
         cat.setdefault('modName', 'Основные')
-
-    # Load additional configs from mods folder (if allowed)
-    mods_metadata = {}
-    if config.get('mod_allow', True):
-        mods_folder = 'mods'
-        if os.path.exists(mods_folder):
-            for filename in os.listdir(mods_folder):
-                if filename.endswith('.json'):
-                    mod_path = os.path.join(mods_folder, filename)
-                    try:
-                        with open(mod_path, 'r', encoding='utf-8') as f:
-                            mod_config = json.load(f)
-                        mod_id = os.path.splitext(filename)[0]
-                        mod_name = mod_config.get('name', mod_id)
-                        
-                        # Сохраняем метаданные модификации, включая лицензию
-                        mods_metadata[mod_id] = {
-                            'modId': mod_id,
-                            'modName': mod_name,
-                            'license': mod_config.get('license')
-                        }
-                        
-                        # Merge categories from mod config
-                        if 'categories' in mod_config:
-                            for cat in mod_config['categories']:
-                                cat.setdefault('modId', mod_id)
-                                cat.setdefault('modName', mod_name)
-                            config['categories'].extend(mod_config['categories'])
-                    except Exception as e:
-                        print(f"Ошибка загрузки мода {filename}: {e}")
-    else:
-        print("Загрузка модов отключена в конфигурации")
-    
-    # Добавляем метаданные модификаций в конфигурацию
-    config['modsMetadata'] = mods_metadata
-    
     return config
 
 
+def _read_mod_config(filename):
+    mod_path = os.path.join(MODS_FOLDER, filename)
+    with open(mod_path, 'r', encoding='utf-8') as f:
+        mod_config = json.load(f)
+    mod_id = os.path.splitext(filename)[0]
+    mod_name = mod_config.get('name', mod_id)
+
+    # Сохраняем метаданные модификации, включая лицензию
+    metadata = {
+        'modId': mod_id,
+        'modName': mod_name,
+        'license': mod_config.get('license')
+    }
+
+    categories = mod_config.get('categories', [])
+    for cat in categories:
+        cat.setdefault('modId', mod_id)
+        cat.setdefault('modName', mod_name)
+    return mod_id, metadata, categories
+
+
+def _list_mod_files():
+    if not os.path.exists(MODS_FOLDER):
+        return []
+    return sorted(f for f in os.listdir(MODS_FOLDER) if f.endswith('.json'))
+
+
+def load_blocks_config():
+    return block_registry.get_config()
+
+
+_FIELD_PLACEHOLDER_RE = re.compile(r'\{([^{}]*)\}')
+
+
+def compile_block_template(code):
+    """Split block code into literal and placeholder parts.
+
+    The result alternates literal text (even positions) and field names (odd
+    positions), so an instance is rendered with one join.
+    """
+    return tuple(_FIELD_PLACEHOLDER_RE.split(code or ''))
+
+
+def render_block_template(parts, fields):
+    if len(parts) == 1:
+        return parts[0]
+    out = list(parts)
+    for i in range(1, len(parts), 2):
+        name = parts[i]
+        # Незаполненные плейсхолдеры остаются в коде как есть
+        out[i] = str(fields[name] or "") if name in fields else "{" + name + "}"
+    return "".join(out)
+
+
+# ===================== Block Registry =====================
+class BlockRegistry:
+    """Process-wide index of block templates from blocks_config.json and mods/.
+
+    Every source file is kept separately together with its own template-id
+    index, so a change in one mod re-reads and re-merges only that file.
+    Lookups during code generation cost a single dict access with no file I/O.
+    `generation` is bumped on every change and can be used as a cache key.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._core = None
+        self._core_index = {}
+        self._mods = {}  # mod_id -> {"metadata", "categories", "index"}
+        self._mod_order = []  # mods are merged after core, sorted by id
+        self._index = {}  # template_id -> {"config", "categoryId", "modId", "modName", "template"}
+        self._config = None  # merged config, rebuilt lazily after changes
+        self.generation = 0
+
+    @staticmethod
+    def _index_categories(categories):
+        index = {}
+        for cat in categories:
+            for blk in cat.get('blocks', []):
+                template_id = blk.get('id')
+                # Первый найденный блок имеет приоритет, как при линейном поиске
+                if template_id is None or template_id in index:
+                    continue
+                index[template_id] = {
+                    "config": blk,
+                    "categoryId": cat.get('id'),
+                    "modId": cat.get('modId'),
+                    "modName": cat.get('modName'),
+                    "template": compile_block_template(blk.get('code', ''))
+                }
+        return index
+
+    def _load_mod(self, filename):
+        mod_id, metadata, categories = _read_mod_config(filename)
+        return mod_id, {
+            "metadata": metadata,
+            "categories": categories,
+            "index": self._index_categories(categories)
+        }
+
+    def _resolve(self, template_id):
+        entry = self._core_index.get(template_id)
+        if entry is not None:
+            return entry
+        for mod_id in self._mod_order:
+            entry = self._mods[mod_id]["index"].get(template_id)
+            if entry is not None:
+                return entry
+        return None
+
+    def _reindex(self, template_ids):
+        for template_id in template_ids:
+            entry = self._resolve(template_id)
+            if entry is None:
+                self._index.pop(template_id, None)
+            else:
+                self._index[template_id] = entry
+
+    def _changed(self):
+        self._config = None
+        self.generation += 1
+
+    def _mods_allowed(self):
+        return bool(self._core.get('mod_allow', True))
+
+    def rebuild(self):
+        core = _read_core_blocks_config()
+        mods = {}
+        if core.get('mod_allow', True):
+            for filename in _list_mod_files():
+                try:
+                    mod_id, mod = self._load_mod(filename)
+                    mods[mod_id] = mod
+                except Exception as e:
+                    print(f"Ошибка загрузки мода {filename}: {e}")
+        else:
+            print("Загрузка модов отключена в конфигурации")
+
+        with self._lock:
+            self._core = core
+            self._core_index = self._index_categories(core.get('categories', []))
+            self._mods = mods
+            self._mod_order = sorted(mods)
+            self._index = {}
+            template_ids = set(self._core_index)
+            for mod in mods.values():
+                template_ids.update(mod["index"])
+            self._reindex(template_ids)
+            self._changed()
+        return self.get_config()
+
+    def reload_core(self):
+        self._ensure_loaded()
+        core = _read_core_blocks_config()
+        if bool(core.get('mod_allow', True)) != self._mods_allowed():
+            # Переключение mod_allow меняет весь набор модов
+            self.rebuild()
+            return
+        with self._lock:
+            old_ids = set(self._core_index)
+            self._core = core
+            self._core_index = self._index_categories(core.get('categories', []))
+            self._reindex(old_ids | set(self._core_index))
+            self._changed()
+
+    def reload_mod(self, filename):
+        self._ensure_loaded()
+        if not self._mods_allowed():
+            return
+        mod_id, mod = self._load_mod(filename)
+        with self._lock:
+            old = self._mods.get(mod_id)
+            old_ids = set(old["index"]) if old else set()
+            self._mods[mod_id] = mod
+            if old is None:
+                bisect.insort(self._mod_order, mod_id)
+            self._reindex(old_ids | set(mod["index"]))
+            self._changed()
+
+    def remove_mod(self, filename):
+        self._ensure_loaded()
+        mod_id = os.path.splitext(filename)[0]
+        with self._lock:
+            old = self._mods.pop(mod_id, None)
+            if old is None:
+                return
+            self._mod_order.remove(mod_id)
+            self._reindex(old["index"])
+            self._changed()
+
+    def _ensure_loaded(self):
+        if self._core is None:
+            with self._lock:
+                if self._core is None:
+                    self.rebuild()
+
+    def get_config(self):
+        self._ensure_loaded()
+        with self._lock:
+            if self._config is None:
+                config = dict(self._core)
+                categories = list(self._core.get('categories', []))
+                for mod_id in self._mod_order:
+                    categories.extend(self._mods[mod_id]["categories"])
+                config['categories'] = categories
+                # Добавляем метаданные модификаций в конфигурацию
+                config['modsMetadata'] = {mod_id: self._mods[mod_id]["metadata"] for mod_id in self._mod_order}
+                config['generation'] = self.generation
+                self._config = config
+            return self._config
+
+    def get_entry(self, template_id):
+        self._ensure_loaded()
+        return self._index.get(template_id)
+
+    def get_block(self, template_id):
+        entry = self.get_entry(template_id)
+        return entry["config"] if entry else None
+
+
+class BlocksConfigWatcher:
+    """Background poller that hot-reloads blocks_config.json and mods/*.json.
+
+    Files are compared by (mtime, size); only the file that changed is passed
+    to the registry, so a reload costs as much as that one file.
+    """
+
+    def __init__(self, registry, interval=BLOCKS_WATCH_INTERVAL):
+        self.registry = registry
+        self.interval = interval
+        self._core_signature = None
+        self._mod_signatures = {}  # filename -> (mtime_ns, size)
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _signature(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _current_mod_signatures(self):
+        return {
+            filename: self._signature(os.path.join(MODS_FOLDER, filename))
+            for filename in _list_mod_files()
+        }
+
+    def snapshot(self):
+        self._core_signature = self._signature(BLOCKS_CONFIG_PATH)
+        self._mod_signatures = self._current_mod_signatures()
+
+    def check(self):
+        core_signature = self._signature(BLOCKS_CONFIG_PATH)
+        if core_signature != self._core_signature:
+            self._core_signature = core_signature
+            # Пропускаем момент, когда файл удалён редактором перед перезаписью
+            if core_signature is not None:
+                try:
+                    self.registry.reload_core()
+                    print(f"Конфигурация блоков перезагружена (generation {self.registry.generation})")
+                except Exception as e:
+                    print(f"Ошибка перезагрузки {BLOCKS_CONFIG_PATH}: {e}")
+
+        mod_signatures = self._current_mod_signatures()
+        for filename, signature in mod_signatures.items():
+            if self._mod_signatures.get(filename) == signature:
+                continue
+            try:
+                self.registry.reload_mod(filename)
+                print(f"Мод {filename} перезагружен (generation {self.registry.generation})")
+            except Exception as e:
+                print(f"Ошибка загрузки мода {filename}: {e}")
+        for filename in set(self._mod_signatures) - set(mod_signatures):
+            self.registry.remove_mod(filename)
+            print(f"Мод {filename} удалён (generation {self.registry.generation})")
+        self._mod_signatures = mod_signatures
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                print(f"Ошибка отслеживания конфигурации блоков: {e}")
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+
+block_registry = BlockRegistry()
+blocks_watcher = BlocksConfigWatcher(block_registry)
+
+
 PROJECTS_FOLDER = 'projects'
 PATTERNS_FOLDER = 'patterns'
 os.makedirs(PROJECTS_FOLDER, exist_ok=True)
@@ -209,9 +611,62 @@ def compiled():
     return render_template('compiled.html')
 
 
+# Serialized /api/blocks payload for the current registry generation
+_blocks_payload_cache = {"generation": None}
+_blocks_payload_lock = threading.Lock()
+
+
+def _build_blocks_payload():
+    body = app.json.dumps(block_registry.get_config()).encode('utf-8')
+    digest = hashlib.sha256(body).hexdigest()[:32]
+    # Strong ETag per content-coding, as each encoding is a separate representation
+    bodies = {
+        "identity": (body, f'"{digest}"'),
+        "gzip": (gzip.compress(body, compresslevel=9), f'"{digest}-gz"')
+    }
+    if brotli is not None:
+        bodies["br"] = (brotli.compress(body), f'"{digest}-br"')
+    return bodies
+
+
+def get_blocks_payload():
+    generation = block_registry.generation
+    cache = _blocks_payload_cache
+    if cache["generation"] != generation:
+        with _blocks_payload_lock:
+            if cache["generation"] != generation:
+                cache["bodies"] = _build_blocks_payload()
+                cache["etags"] = {etag for _, etag in cache["bodies"].values()}
+                cache["generation"] = generation
+    return cache["bodies"], cache["etags"]
+
+
 @app.route('/api/blocks')
 def get_blocks():
-    return jsonify(load_blocks_config())
+    bodies, etags = get_blocks_payload()
+    encoding = "identity"
+    for candidate in ("br", "gzip"):
+        if candidate in bodies and request.accept_encodings[candidate]:
+            encoding = candidate
+            break
+    body, etag = bodies[encoding]
+
+    headers = {
+        "ETag": etag,
+        "Vary": "Accept-Encoding",
+        # Клиент всегда переспрашивает сервер, чтобы увидеть перезагруженные моды
+        "Cache-Control": "no-cache"
+    }
+    if any(request.if_none_match.contains(tag.strip('"')) for tag in etags):
+        return Response(status=304, headers=headers)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(body, mimetype='application/json', headers=headers)
+
+
+@app.route('/api/blocks/generation')
+def get_blocks_generation():
+    return jsonify({"status": "success", "generation": block_registry.generation})
 
 
 @app.route('/api/license/status')
@@ -339,8 +794,7 @@ def load_template_data(template_id: str, project_path=''):
     data = None
     if template_file and os.path.exists(template_file):
         try:
-            with open(template_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            data = read_project_path(template_file)
         except Exception as exc:
             print(f"Ошибка чтения шаблона {template_id}: {exc}")
     if not isinstance(data, dict):
@@ -358,167 +812,1420 @@ def list_templates():
     return jsonify({"status": "success", "templates": load_templates_manifest()})
 
 
-@app.route('/api/project/save-file', methods=['POST'])
-def save_project_file():
-    data = request.get_json()
-    filename = data.get('filename', '').strip()
-    project_data = data.get('project_data')
-    template_id = data.get('template_id')
-    project_path = ''
-    if isinstance(project_data, dict):
-        project_path = project_data.get('projectPath', '')
-    if not project_path:
-        project_path = data.get('project_path', '')
-    
-    print(f"Received save request: filename={filename}, project_path={project_path}")
-    
-    if not filename:
-        return jsonify({"status": "error", "message": "Имя файла обязательно"})
-    if not filename.endswith('.turtcd'):
-        filename += '.turtcd'
-    
-    if not isinstance(project_data, dict) or not project_data:
-        project_data = load_template_data(template_id, project_path)
+# ===================== Project Storage =====================
+PROJECT_BACKUPS_FOLDER = os.path.join(PROJECTS_FOLDER, '.backups')
+PROJECT_LOCKS_FOLDER = os.path.join(PROJECTS_FOLDER, '.locks')
+PROJECT_TEMP_MAX_AGE = 3600  # seconds after which a leftover temp file of an interrupted save is removed
+# Ключи блоков, которые компактный формат не пишет, если значение совпадает с общим для проекта
+PROJECT_COMPACT_BLOCK_KEYS = ("collapsedRightBranch", "fieldTypes", "hiddenBy", "ignoreIssues", "width", "height")
+PROJECT_COMPACT_DEFAULTS_KEY = "_blockDefaults"
+PROJECT_COMPACT_ORDER_KEY = "_blockKeyOrder"  # порядок ключей, общий для блоков проекта
+PROJECT_COMPACT_BLOCK_ORDER_KEY = "_keys"  # порядок ключей блока, не совпадающий с общим
+PROJECT_COMPRESS_MIN_SIZE = 1024  # bytes of compact JSON below which compression is not tried
+PROJECT_COMPRESS_MAX_RATIO = 0.9  # compressed data is kept only if it is at most this share of the JSON
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def _default_key(value):
+    # Ключ для сравнения значений как в JSON: True и 1 различаются, словари - независимо от порядка ключей
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True)
+    return type(value), value
+
+
+def _merged_key_order(blocks):
+    # Один порядок ключей, согласованный с порядком в блоках: новый ключ встаёт после предыдущего ключа блока
+    order = []
+    for block in blocks:
+        position = 0
+        for key in block:
+            if key in order:
+                position = order.index(key) + 1
+            else:
+                order.insert(position, key)
+                position += 1
+    return order
+
+
+def _compact_project(project_data):
+    """Copy of a project without block keys equal to the project-wide default.
+
+    The default of each key is its most common value among the blocks and is
+    stored under PROJECT_COMPACT_DEFAULTS_KEY, so the file does not depend
+    on blocks_config.json. A key missing from some block is left as is.
+    The key order of the blocks is kept: PROJECT_COMPACT_ORDER_KEY holds one
+    order shared by the blocks, and a block whose keys do not follow it
+    lists its own under PROJECT_COMPACT_BLOCK_ORDER_KEY.
+    """
+    blocks = project_data.get('blocks')
+    if not isinstance(blocks, list) or not blocks or not all(isinstance(block, dict) for block in blocks):
+        return project_data
+    defaults, default_keys = {}, {}
+    for key in PROJECT_COMPACT_BLOCK_KEYS:
+        if not all(key in block for block in blocks):
+            continue
+        counts = Counter(_default_key(block[key]) for block in blocks)
+        default_keys[key] = counts.most_common(1)[0][0]
+        defaults[key] = next(block[key] for block in blocks if _default_key(block[key]) == default_keys[key])
+
+    order = _merged_key_order(blocks)
+    rank = {key: index for index, key in enumerate(order)}
+    compact_blocks = []
+    for block in blocks:
+        compact_block = dict(block)
+        for key, default_key in default_keys.items():
+            if _default_key(block[key]) == default_key:
+                del compact_block[key]
+        if len(compact_block) < len(block) and list(block) != sorted(block, key=rank.__getitem__):
+            compact_block[PROJECT_COMPACT_BLOCK_ORDER_KEY] = list(block)
+        compact_blocks.append(compact_block)
+    compact = dict(project_data)
+    compact['blocks'] = compact_blocks
+    compact[PROJECT_COMPACT_DEFAULTS_KEY] = defaults
+    compact[PROJECT_COMPACT_ORDER_KEY] = order
+    return compact
+
+
+def _expand_project(project_data):
+    defaults = project_data.pop(PROJECT_COMPACT_DEFAULTS_KEY)
+    # Файлы без порядка ключей (записанные раньше) получают ключи по умолчанию в конце блока
+    rank = {key: index for index, key in enumerate(project_data.pop(PROJECT_COMPACT_ORDER_KEY, None) or ())}
+    scalars = {key: value for key, value in defaults.items() if not isinstance(value, (dict, list))}
+    # Списки и словари у каждого блока свои: json.loads быстрее copy.deepcopy
+    containers = {key: json.dumps(value) for key, value in defaults.items() if key not in scalars}
+    orders = {}  # ключи блока после дополнения -> (порядок, itemgetter); у блоков проекта он обычно один
+    blocks = project_data.get('blocks', [])
+    for index, block in enumerate(blocks):
+        own_order = block.pop(PROJECT_COMPACT_BLOCK_ORDER_KEY, None)
+        size = len(block)
+        for key, value in scalars.items():
+            block.setdefault(key, value)
+        for key, text in containers.items():
+            if key not in block:
+                block[key] = json.loads(text)
+        if len(block) == size or len(block) < 2 or not (own_order or rank):
+            continue
+        if own_order is None:
+            keys = tuple(block)
+            entry = orders.get(keys)
+            if entry is None:
+                order = sorted(keys, key=lambda key: rank.get(key, len(rank)))
+                entry = orders[keys] = (order, operator.itemgetter(*order))
+            order, values = entry
+        else:
+            order = [key for key in own_order if key in block]
+            values = operator.itemgetter(*order)
+        # Блок собирается заново в исходном порядке ключей
+        blocks[index] = dict(zip(order, values(block)))
+    return project_data
+
+
+def encode_project(project_data, project_format="json"):
+    """Bytes of a .turtcd file.
+
+    "json" is the readable indented JSON used so far. "compact" is minified
+    JSON without default block keys, compressed with zstd (gzip when the
+    zstandard package is missing) if that makes it noticeably smaller.
+    """
+    if project_format != "compact":
+        return json.dumps(project_data, ensure_ascii=False, indent=2).encode('utf-8')
+    raw = json.dumps(_compact_project(project_data), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    if len(raw) < PROJECT_COMPRESS_MIN_SIZE:
+        return raw
+    if zstandard is not None:
+        packed = zstandard.ZstdCompressor(level=3).compress(raw)
     else:
-        project_data.setdefault('blocks', [])
-        project_data.setdefault('connections', [])
-        project_data['projectPath'] = project_path or project_data.get('projectPath', '')
-        project_data['createdAt'] = datetime.utcnow().isoformat() + 'Z'
-    
-    # Всегда сохраняем в папку projects для простоты
-    filepath = os.path.join(PROJECTS_FOLDER, filename)
-    print(f"Saving to projects folder: {filepath}")
-    
-    try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(project_data, f, ensure_ascii=False, indent=2)
-        print(f"Successfully saved project to: {filepath}")
-        return jsonify({"status": "success", "filename": filename, "path": filepath})
-    except Exception as e:
-        print(f"Error saving file: {e}")
-        return jsonify({"status": "error", "message": f"Ошибка сохранения: {str(e)}"})
+        packed = gzip.compress(raw, compresslevel=6, mtime=0)
+    return packed if len(packed) <= len(raw) * PROJECT_COMPRESS_MAX_RATIO else raw
 
 
-@app.route('/api/project/load-file', methods=['POST'])
-def load_project_file():
-    data = request.get_json()
-    filename = data.get('filename')
-    
-    # Сначала ищем в папке projects
-    filepath = os.path.join(PROJECTS_FOLDER, filename)
-    if not os.path.exists(filepath):
-        # Если не найден в projects, ищем в других местах
-        # Пока что возвращаем ошибку, но в будущем можно расширить поиск
-        return jsonify({"status": "error", "message": "Файл не найден"})
-    
-    try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            project_data = json.load(f)
-        return jsonify({"status": "success", "project_data": project_data})
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка загрузки: {str(e)}"})
+def decode_project(data):
+    """Project from the bytes of a .turtcd file in any format, recognised by its magic bytes."""
+    # Повреждённый сжатый файл, как и повреждённый JSON, даёт ValueError
+    if data.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ValueError("Проект сжат zstd, установите пакет zstandard")
+        try:
+            data = zstandard.ZstdDecompressor().decompress(data)
+        except zstandard.ZstdError as e:
+            raise ValueError(f"Повреждённые данные zstd: {e}") from e
+    elif data.startswith(GZIP_MAGIC):
+        try:
+            data = gzip.decompress(data)
+        except (OSError, EOFError) as e:
+            raise ValueError(f"Повреждённые данные gzip: {e}") from e
+    project_data = json.loads(data)
+    if isinstance(project_data, dict) and PROJECT_COMPACT_DEFAULTS_KEY in project_data:
+        _expand_project(project_data)
+    return project_data
 
 
-@app.route('/api/project/list')
-def list_projects():
-    try:
-        if not os.path.exists(PROJECTS_FOLDER):
-            os.makedirs(PROJECTS_FOLDER, exist_ok=True)
-            print(f"Created projects folder: {PROJECTS_FOLDER}")
-        
-        projects = [f for f in os.listdir(PROJECTS_FOLDER) if f.endswith('.turtcd')]
-        
-        print(f"Found projects: {projects}")
-        return jsonify({"status": "success", "projects": projects})
-    except Exception as e:
-        print(f"Error listing projects: {e}")
-        return jsonify({"status": "error", "message": str(e)})
+def read_project_path(path):
+    with open(path, 'rb') as f:
+        return decode_project(f.read())
 
 
-@app.route('/api/project/delete', methods=['POST'])
-def delete_project():
-    data = request.get_json()
-    filename = data.get('filename')
-    if not filename:
-        return jsonify({"status": "error", "message": "Имя файла обязательно"})
-    
-    # Ищем файл в папке projects
-    filepath = os.path.join(PROJECTS_FOLDER, filename)
-    if not os.path.exists(filepath):
-        return jsonify({"status": "error", "message": "Файл не найден"})
-    
+def _remove_quietly(path):
     try:
-        os.remove(filepath)
-        return jsonify({"status": "success"})
-    except Exception as e:
-        return jsonify({"status": "error", "message": str(e)})
+        os.remove(path)
+    except FileNotFoundError:
+        pass
 
 
-@app.route('/api/project/compile', methods=['POST'])
-def compile_project():
-    data = request.get_json()
-    return jsonify({
-        "status": "success",
-        "code": generate_python_code(data.get('project_data', {}))
-    })
+class ProjectLock:
+    """Per-project lock shared by threads and server processes.
 
+    Re-entrant within a thread. The outermost acquire also takes an
+    exclusive lock on a file in PROJECT_LOCKS_FOLDER (flock, msvcrt.locking
+    on Windows), so server workers serialize as well. The holder may
+    discard() the file once the project is gone; a process that was waiting
+    on the removed file notices it and locks the new one.
+    """
 
-@app.route('/api/project/compile-exe', methods=['POST'])
-def compile_exe():
-    try:
-        # Get form data
-        code = request.form.get('code', '')
-        exe_name = request.form.get('exe_name', 'program.exe')
-        hide_console = request.form.get('hide_console', 'false').lower() == 'true'
-        icon_file = request.files.get('icon')
-        
-        if not code.strip():
-            return jsonify({"status": "error", "message": "Код не может быть пустым"})
-        
-        # Create compiled folder in project directory
-        compiled_path = os.path.join(os.getcwd(), 'compiled')
-        os.makedirs(compiled_path, exist_ok=True)
-        
-        def generate_progress():
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def acquire(self):
+        self._lock.acquire()
+        if self._depth == 0:
             try:
-                # Step 1: Create temporary Python file
-                yield f'data: {{"progress": 10, "status": "Создание временного файла..."}}\n\n'
-                
-                with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False, encoding='utf-8') as f:
-                    f.write(code)
-                    temp_py_file = f.name
-                
-                # Step 2: Install PyInstaller if needed
-                yield f'data: {{"progress": 20, "status": "Проверка PyInstaller..."}}\n\n'
-                
-                try:
-                    subprocess.run(['pyinstaller', '--version'], capture_output=True, check=True)
-                except (subprocess.CalledProcessError, FileNotFoundError):
-                    yield f'data: {{"progress": 25, "status": "Установка PyInstaller..."}}\n\n'
-                    subprocess.run(['pip', 'install', 'pyinstaller'], check=True)
-                
-                # Step 3: Prepare command
-                yield f'data: {{"progress": 30, "status": "Подготовка команды..."}}\n\n'
-                
-                exe_name_clean = exe_name.replace('.exe', '')
-                cmd = [
-                    'pyinstaller',
-                    '--onefile',
-                    '--distpath', compiled_path,
-                    '--name', exe_name_clean,
-                    '--clean'
-                ]
-                
-                if hide_console:
-                    cmd.append('--noconsole')
-                
-                if icon_file:
-                    icon_temp = tempfile.NamedTemporaryFile(suffix='.ico', delete=False)
-                    icon_file.save(icon_temp.name)
-                    cmd.extend(['--icon', icon_temp.name])
-                
-                cmd.append(temp_py_file)
-                
+                self._fd = self._lock_file()
+            except BaseException:
+                self._lock.release()
+                raise
+        self._depth += 1
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            fd, self._fd = self._fd, None
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                else:
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+            finally:
+                os.close(fd)
+        self._lock.release()
+
+    def _lock_file(self):
+        while True:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                else:
+                    while True:
+                        try:
+                            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                            break
+                        except OSError:
+                            time.sleep(0.01)
+                if fcntl is None or self._is_current_file(fd):
+                    return fd
+            except BaseException:
+                os.close(fd)
+                raise
+            # Файл удалили, пока мы ждали блокировку: блокируем новый
+            os.close(fd)
+
+    def _is_current_file(self, fd):
+        try:
+            return os.fstat(fd).st_ino == os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return False
+
+    def discard(self):
+        """Remove the lock file; call while holding the lock, after the project is gone."""
+        # В Windows открытый файл удалить нельзя, пустые файлы блокировок там остаются
+        if fcntl is not None and self._depth:
+            _remove_quietly(self.path)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class ProjectStorage:
+    """Crash-safe reads and writes of the .turtcd files in PROJECTS_FOLDER.
+
+    Every write goes to a temp file in the same folder, is fsynced and then
+    os.replace()d over the project, so the file on disk is always the old
+    or the new version, never a truncated one. Writes to one project are
+    serialized by a per-project ProjectLock, so two tabs or two server
+    workers saving the same project cannot interleave. The version being replaced or deleted is hard-linked
+    into PROJECT_BACKUPS_FOLDER/<filename>/ (no data is copied, the old
+    inode simply stays reachable) and only the newest `backups` of them are
+    kept; on file systems without hard links it is copied instead. Files are
+    written in `project_format` (see encode_project) and read in any format.
+    """
+
+    def __init__(self, folder, backups_folder, locks_folder, backups=3, project_format="json", deleted_backups=20):
+        self.folder = folder
+        self.backups_folder = backups_folder
+        self.locks_folder = locks_folder
+        self.backups = backups
+        self.deleted_backups = deleted_backups
+        self.project_format = project_format
+        # Блокировка живёт, пока её кто-то держит: словарь не растёт с числом проектов
+        self._locks = weakref.WeakValueDictionary()
+        self._locks_lock = threading.Lock()
+
+    def path(self, filename):
+        return os.path.join(self.folder, filename)
+
+    def exists(self, filename):
+        return os.path.isfile(self.path(filename))
+
+    def clean_filename(self, filename, add_suffix=False):
+        """`filename` if it names a .turtcd file directly in the folder, else None.
+
+        Every endpoint that takes a filename from the client goes through
+        this, so "../x.turtcd", "sub/x.turtcd" or a symlink out of the
+        folder never reach the file system.
+        """
+        if not isinstance(filename, str):
+            return None
+        filename = filename.strip()
+        if add_suffix and not filename.endswith('.turtcd'):
+            filename += '.turtcd'
+        if (not filename.endswith('.turtcd') or filename.startswith('.') or '\0' in filename
+                or os.path.basename(filename) != filename or '/' in filename or '\\' in filename):
+            return None
+        folder = os.path.realpath(self.folder)
+        if os.path.dirname(os.path.realpath(self.path(filename))) != folder:
+            return None
+        return filename
+
+    def lock(self, filename):
+        """Per-project lock; hold it around read-modify-write sequences."""
+        with self._locks_lock:
+            lock = self._locks.get(filename)
+            if lock is None:
+                lock = self._locks[filename] = ProjectLock(os.path.join(self.locks_folder, filename + '.lock'))
+            return lock
+
+    def read(self, filename):
+        return read_project_path(self.path(filename))
+
+    def write(self, filename, project_data):
+        """Replace (or create) a project file atomically."""
+        with self.lock(filename):
+            tmp_path = self._write_temp(filename, project_data)
+            try:
+                if os.path.exists(self.path(filename)):
+                    self._backup(filename)
+                os.replace(tmp_path, self.path(filename))
+            except BaseException:
+                _remove_quietly(tmp_path)
+                raise
+            self._sync_folder()
+
+    def create(self, filename, project_data):
+        """Write a new project; False if `filename` already exists."""
+        with self.lock(filename):
+            tmp_path = self._write_temp(filename, project_data)
+            try:
+                created = self._link_new(tmp_path, filename)
+            finally:
+                _remove_quietly(tmp_path)
+            if created:
+                self._sync_folder()
+            return created
+
+    def rename(self, filename, new_filename):
+        """Move a project under a free name; False if `new_filename` exists.
+
+        The new name is hard-linked to the file before the old one is
+        removed, so a crash in between leaves both names, never neither.
+        """
+        first, second = sorted((filename, new_filename))
+        with self.lock(first), self.lock(second):
+            if not self._link_new(self.path(filename), new_filename):
+                return False
+            _remove_quietly(self.path(filename))
+            old_backups = os.path.join(self.backups_folder, filename)
+            new_backups = os.path.join(self.backups_folder, new_filename)
+            if os.path.isdir(old_backups):
+                if not os.path.exists(new_backups):
+                    os.rename(old_backups, new_backups)
+                else:
+                    # Копии удалённого раньше проекта с новым именем: остаются только самые новые
+                    for name in os.listdir(old_backups):
+                        os.replace(os.path.join(old_backups, name), os.path.join(new_backups, name))
+                    os.rmdir(old_backups)
+                    self._prune_backups(new_backups)
+            self.lock(filename).discard()
+            self._sync_folder()
+            return True
+
+    def delete(self, filename):
+        """Remove a project, keeping its last version among the backups.
+
+        Backups of at most `deleted_backups` deleted projects are kept, the
+        ones deleted longest ago are removed.
+        """
+        with self.lock(filename) as lock:
+            self._backup(filename)
+            os.remove(self.path(filename))
+            lock.discard()
+            self._sync_folder()
+        self._prune_deleted_backups()
+
+    def remove_stale_locks(self):
+        """Delete lock files of projects that no longer exist."""
+        try:
+            names = os.listdir(self.locks_folder)
+        except FileNotFoundError:
+            return
+        for name in names:
+            filename = name[:-len('.lock')]
+            if not name.endswith('.lock') or self.exists(filename):
+                continue
+            with self.lock(filename) as lock:
+                if not self.exists(filename):
+                    lock.discard()
+
+    def remove_stale_temp(self, max_age=PROJECT_TEMP_MAX_AGE):
+        """Delete temp files left by saves interrupted by a crash."""
+        cutoff = time.time() - max_age
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') and entry.name.endswith('.tmp') and entry.stat().st_mtime < cutoff:
+                    _remove_quietly(entry.path)
+
+    def _write_temp(self, filename, project_data):
+        tmp_path = os.path.join(self.folder, f'.{filename}.{uuid.uuid4().hex[:12]}.tmp')
+        # os.open с 0o666, чтобы права файла, как и раньше, определялись umask
+        data = encode_project(project_data, self.project_format)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            _remove_quietly(tmp_path)
+            raise
+        return tmp_path
+
+    def _link_new(self, source, filename):
+        target = self.path(filename)
+        try:
+            os.link(source, target)
+        except FileExistsError:
+            return False
+        except OSError:
+            # ФС без жёстких ссылок: проверка и переименование под блокировкой проекта
+            if os.path.exists(target):
+                return False
+            os.rename(source, target)
+        return True
+
+    def _backup(self, filename):
+        if self.backups <= 0:
+            return
+        folder = os.path.join(self.backups_folder, filename)
+        os.makedirs(folder, exist_ok=True)
+        backup = os.path.join(folder, datetime.utcnow().strftime('%Y%m%dT%H%M%S%fZ') + '.turtcd')
+        try:
+            os.link(self.path(filename), backup)
+        except FileExistsError:
+            pass
+        except OSError:
+            shutil.copy2(self.path(filename), backup)
+        self._prune_backups(folder)
+
+    def _prune_backups(self, folder):
+        # Имена копий - время записи, поэтому сортировка по имени - по возрасту
+        for name in sorted(os.listdir(folder))[:-self.backups]:
+            _remove_quietly(os.path.join(folder, name))
+
+    def _prune_deleted_backups(self):
+        try:
+            entries = [entry for entry in os.scandir(self.backups_folder)
+                       if entry.is_dir() and not self.exists(entry.name)]
+        except FileNotFoundError:
+            return
+        # Папка копий удалённого проекта меняется последний раз при удалении
+        entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for entry in entries[self.deleted_backups:]:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+    def _sync_folder(self):
+        # Делаем переименование устойчивым к сбою питания; в Windows папку нельзя открыть для fsync
+        if os.name == 'nt':
+            return
+        fd = os.open(self.folder, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+project_storage = ProjectStorage(PROJECTS_FOLDER, PROJECT_BACKUPS_FOLDER, PROJECT_LOCKS_FOLDER,
+                                 config['project_backups'], config['project_format'], config['project_deleted_backups'])
+
+
+# ===================== Project Index =====================
+PROJECT_INDEX_PATH = os.path.join(PROJECTS_FOLDER, '.index.sqlite3')
+PROJECT_INDEX_RESCAN_INTERVAL = 60.0  # seconds between full checks of the folder for edits made outside the server
+PROJECT_SORT_COLUMNS = {
+    "name": "name COLLATE NOCASE",
+    "lastModified": "mtime_ns",
+    "createdAt": "created_at",
+    "size": "size",
+    "blocks": "blocks"
+}
+
+
+def _project_summary(project_data):
+    """Index fields taken from the contents of a project file."""
+    if not isinstance(project_data, dict):
+        project_data = {}
+    blocks = project_data.get('blocks')
+    connections = project_data.get('connections')
+    return {
+        "blocks": len(blocks) if isinstance(blocks, list) else 0,
+        "connections": len(connections) if isinstance(connections, list) else 0,
+        "template": project_data.get('templateId') or None,
+        "created_at": project_data.get('createdAt') or None
+    }
+
+
+class ProjectIndex:
+    """SQLite index of the .turtcd files in PROJECTS_FOLDER.
+
+    Keeps name, size, mtime, block and connection counts, template origin
+    and createdAt per project, so listing is one indexed query instead of
+    reading the folder and every file. The save/update/delete/duplicate
+    endpoints update it directly; reconcile() picks up files changed
+    outside the server by comparing mtime and size, and runs when the
+    folder's own mtime changes or every PROJECT_INDEX_RESCAN_INTERVAL.
+    Template origin and createdAt are kept from the first time a project
+    was seen when a later save no longer carries them.
+    """
+
+    def __init__(self, folder, path):
+        self.folder = folder
+        self.path = path
+        self._local = threading.local()
+        self._scan_lock = threading.Lock()
+        self._folder_mtime = None
+        self._scanned_at = 0.0
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS projects (
+                    filename TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    blocks INTEGER NOT NULL,
+                    connections INTEGER NOT NULL,
+                    template TEXT,
+                    created_at TEXT
+                );
+                CREATE INDEX IF NOT EXISTS projects_name ON projects (name COLLATE NOCASE);
+                CREATE INDEX IF NOT EXISTS projects_mtime ON projects (mtime_ns);
+                CREATE INDEX IF NOT EXISTS projects_created ON projects (created_at);
+            """)
+            self._local.conn = conn
+        return conn
+
+    def _upsert(self, conn, filename, st, summary):
+        conn.execute("""
+            INSERT INTO projects (filename, name, size, mtime_ns, blocks, connections, template, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (filename) DO UPDATE SET
+                size = excluded.size, mtime_ns = excluded.mtime_ns,
+                blocks = excluded.blocks, connections = excluded.connections,
+                template = COALESCE(excluded.template, projects.template),
+                created_at = COALESCE(projects.created_at, excluded.created_at)
+        """, (filename, filename[:-len('.turtcd')], st.st_size, st.st_mtime_ns,
+              summary["blocks"], summary["connections"], summary["template"], summary["created_at"]))
+
+    def update(self, filename, project_data=None, template=None):
+        """Record the current state of one project file, parsing it unless `project_data` is given."""
+        try:
+            filepath = os.path.join(self.folder, filename)
+            st = os.stat(filepath)
+            if project_data is None:
+                project_data = project_storage.read(filename)
+            summary = _project_summary(project_data)
+            summary["template"] = summary["template"] or template
+            with self._connection() as conn:
+                self._upsert(conn, filename, st, summary)
+        except (OSError, ValueError, sqlite3.Error) as e:
+            print(f"Ошибка обновления индекса проектов ({filename}): {e}")
+
+    def remove(self, filename):
+        try:
+            with self._connection() as conn:
+                conn.execute("DELETE FROM projects WHERE filename = ?", (filename,))
+        except sqlite3.Error as e:
+            print(f"Ошибка обновления индекса проектов ({filename}): {e}")
+
+    def rename(self, filename, new_filename):
+        try:
+            with self._connection() as conn:
+                conn.execute("DELETE FROM projects WHERE filename = ?", (new_filename,))
+                conn.execute("UPDATE projects SET filename = ?, name = ? WHERE filename = ?",
+                             (new_filename, new_filename[:-len('.turtcd')], filename))
+        except sqlite3.Error as e:
+            print(f"Ошибка обновления индекса проектов ({filename}): {e}")
+        self.update(new_filename)
+
+    def get(self, filename):
+        try:
+            row = self._connection().execute("SELECT * FROM projects WHERE filename = ?", (filename,)).fetchone()
+        except sqlite3.Error:
+            return None
+        return dict(row) if row else None
+
+    def reconcile(self, force=False):
+        """Bring the index in line with the folder; cheap when nothing changed."""
+        folder_mtime = os.stat(self.folder).st_mtime_ns
+        now = time.monotonic()
+        if not force and folder_mtime == self._folder_mtime and now - self._scanned_at < PROJECT_INDEX_RESCAN_INTERVAL:
+            return
+        with self._scan_lock:
+            conn = self._connection()
+            known = {row["filename"]: (row["size"], row["mtime_ns"])
+                     for row in conn.execute("SELECT filename, size, mtime_ns FROM projects")}
+            seen = set()
+            with conn:
+                with os.scandir(self.folder) as entries:
+                    for entry in entries:
+                        if not entry.name.endswith('.turtcd') or not entry.is_file():
+                            continue
+                        seen.add(entry.name)
+                        st = entry.stat()
+                        if known.get(entry.name) == (st.st_size, st.st_mtime_ns):
+                            continue
+                        try:
+                            project_data = project_storage.read(entry.name)
+                        except (OSError, ValueError):
+                            project_data = None  # повреждённый файл всё равно показываем в списке
+                        self._upsert(conn, entry.name, st, _project_summary(project_data))
+                conn.executemany("DELETE FROM projects WHERE filename = ?", [(name,) for name in known.keys() - seen])
+            self._folder_mtime = folder_mtime
+            self._scanned_at = now
+
+    def query(self, offset=0, limit=None, sort="name", order="asc", search="", template=None):
+        """One page of projects and the total number matching the filter."""
+        where, params = [], []
+        if search:
+            escaped = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            where.append("name LIKE ? ESCAPE '\\'")
+            params.append(f"%{escaped}%")
+        if template:
+            where.append("template = ?")
+            params.append(template)
+        clause = f" WHERE {' AND '.join(where)}" if where else ""
+        column = PROJECT_SORT_COLUMNS.get(sort, PROJECT_SORT_COLUMNS["name"])
+        direction = "DESC" if order == "desc" else "ASC"
+        conn = self._connection()
+        total = conn.execute(f"SELECT COUNT(*) FROM projects{clause}", params).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT * FROM projects{clause} ORDER BY {column} {direction}, filename LIMIT ? OFFSET ?",
+            params + [-1 if limit is None else limit, offset]
+        ).fetchall()
+        return total, [_project_index_item(row) for row in rows]
+
+
+def _project_index_item(row):
+    return {
+        "filename": row["filename"],
+        "name": row["name"],
+        "size": row["size"],
+        "lastModified": datetime.utcfromtimestamp(row["mtime_ns"] / 1e9).isoformat() + 'Z',
+        "blocks": row["blocks"],
+        "connections": row["connections"],
+        "templateId": row["template"],
+        "createdAt": row["created_at"]
+    }
+
+
+project_index = ProjectIndex(PROJECTS_FOLDER, PROJECT_INDEX_PATH)
+
+
+# ===================== Project Documents =====================
+PROJECT_REVISION_KEY = "_revision"
+PROJECT_PATCH_SAVE_DELAY = 2.0  # seconds without new patches before a patched project is written
+PROJECT_PATCH_MAX_DELAY = 10.0  # seconds a patched project may stay unwritten while patches keep coming
+PROJECT_FLUSH_INTERVAL = 0.5
+PROJECT_DOCUMENTS_MAX = 32  # projects kept in memory; projects with unwritten changes are never dropped
+PROJECT_PATCH_OPS = ("add", "remove", "replace", "move", "copy", "test")
+PROJECT_JOURNAL_SUFFIX = '.journal'
+
+
+class ProjectPatchError(ValueError):
+    pass
+
+
+def _pointer_tokens(pointer):
+    if pointer == "":
+        return []
+    if not isinstance(pointer, str) or not pointer.startswith('/'):
+        raise ProjectPatchError(f"Некорректный путь: {pointer!r}")
+    return [token.replace('~1', '/').replace('~0', '~') for token in pointer[1:].split('/')]
+
+
+def _array_index(array, token, allow_end=False):
+    if allow_end and token == '-':
+        return len(array)
+    if not token.isdigit() or (len(token) > 1 and token[0] == '0'):
+        raise ProjectPatchError(f"Некорректный индекс: {token!r}")
+    index = int(token)
+    if index > len(array) or (index == len(array) and not allow_end):
+        raise ProjectPatchError(f"Индекс {index} вне списка")
+    return index
+
+
+class _ProjectPatch:
+    """JSON Patch (RFC 6902) applied copy-on-write.
+
+    Containers on the paths an operation writes to are shallow-copied once,
+    so a patch costs O(path length + size of the touched lists) instead of a
+    deep copy of the project, and the original stays untouched when a later
+    operation fails. Objects created during this patch are tracked by id()
+    and modified in place.
+    """
+
+    def __init__(self, root):
+        self.root = dict(root)
+        self._own = {id(self.root)}
+
+    def _own_copy(self, parent, key):
+        child = parent[key]
+        if isinstance(child, (dict, list)) and id(child) not in self._own:
+            child = parent[key] = child.copy()
+            self._own.add(id(child))
+        return child
+
+    def _get(self, tokens):
+        node = self.root
+        for token in tokens:
+            node = node[self._key(node, token)]
+        return node
+
+    def _key(self, node, token, allow_end=False):
+        if isinstance(node, dict):
+            if not allow_end and token not in node:
+                raise ProjectPatchError(f"Ключ {token!r} не найден")
+            return token
+        if isinstance(node, list):
+            return _array_index(node, token, allow_end)
+        raise ProjectPatchError(f"Путь проходит через значение, а не объект или список: {token!r}")
+
+    def _parent(self, tokens):
+        node = self.root
+        for token in tokens[:-1]:
+            node = self._own_copy(node, self._key(node, token))
+        if not isinstance(node, (dict, list)):
+            raise ProjectPatchError("Путь проходит через значение, а не объект или список")
+        return node
+
+    def _add(self, tokens, value):
+        if not tokens:
+            self._set_root(value)
+            return
+        parent = self._parent(tokens)
+        key = self._key(parent, tokens[-1], allow_end=True)
+        if isinstance(parent, list):
+            parent.insert(key, value)
+        else:
+            parent[key] = value
+
+    def _remove(self, tokens):
+        if not tokens:
+            raise ProjectPatchError("Нельзя удалить проект целиком")
+        parent = self._parent(tokens)
+        return parent.pop(self._key(parent, tokens[-1]))
+
+    def _set_root(self, value):
+        if not isinstance(value, dict):
+            raise ProjectPatchError("Проект должен быть объектом")
+        self.root = value
+        self._own.add(id(value))
+
+    def apply(self, op):
+        if not isinstance(op, dict) or op.get('op') not in PROJECT_PATCH_OPS:
+            raise ProjectPatchError(f"Неизвестная операция: {op!r}")
+        name = op['op']
+        tokens = _pointer_tokens(op.get('path'))
+        if name in ("add", "replace", "test") and 'value' not in op:
+            raise ProjectPatchError(f"Операции {name} нужно значение")
+        if name == "add":
+            self._add(tokens, op['value'])
+        elif name == "remove":
+            self._remove(tokens)
+        elif name == "replace":
+            if not tokens:
+                self._set_root(op['value'])
+            else:
+                parent = self._parent(tokens)
+                parent[self._key(parent, tokens[-1])] = op['value']
+        elif name == "test":
+            if _default_key(self._get(tokens)) != _default_key(op['value']):
+                raise ProjectPatchError(f"Проверка не прошла: {op.get('path')}")
+        else:
+            source = _pointer_tokens(op.get('from'))
+            if name == "move":
+                if tokens[:len(source)] == source and len(tokens) > len(source):
+                    raise ProjectPatchError("Нельзя переместить значение внутрь самого себя")
+                self._add(tokens, self._remove(source))
+            else:
+                self._add(tokens, json.loads(json.dumps(self._get(source))))
+
+
+def apply_project_patch(project_data, ops):
+    """New project with the JSON Patch `ops` applied; `project_data` is not modified."""
+    if not isinstance(ops, list):
+        raise ProjectPatchError("ops должен быть списком операций")
+    patch = _ProjectPatch(project_data)
+    for op in ops:
+        patch.apply(op)
+    return patch.root
+
+
+class ProjectDocument:
+    def __init__(self, data, revision, stat=None):
+        self.lock = threading.Lock()  # keeps data and revision consistent for readers
+        self.data = data
+        self.revision = revision
+        self.saved_revision = revision  # last revision on disk, in the snapshot or the journal
+        self.base_revision = revision  # revision of the snapshot file itself
+        self.stat = stat
+        self.journal_size = 0  # bytes of the journal that belong to this copy
+        self.changed_at = 0.0
+        self.dirty_since = 0.0
+        self.detached = False
+
+    @property
+    def dirty(self):
+        return self.revision != self.saved_revision
+
+
+class ProjectHistoryError(ValueError):
+    pass
+
+
+def _project_writes_delayed():
+    # Откладывать запись можно, только если проекты меняет один процесс сервера
+    return config['server']['workers'] <= 1 and not config['session_supervisor']
+
+
+class ProjectDocuments:
+    """Server-side copies of open projects with a revision number.
+
+    load-file and save-file go through here, and /api/project/patch applies
+    JSON Patch operations to the cached copy when the client's revision
+    matches; a stale revision gets a conflict. The revision is stored in the
+    file under PROJECT_REVISION_KEY and never appears in project_data.
+
+    With config['project_journal'] every patch is appended and fsynced as
+    one line to <project>.turtcd.journal, so a save costs the size of the
+    edit; otherwise patched projects are written once no patch came for
+    PROJECT_PATCH_SAVE_DELAY seconds (at the latest after
+    PROJECT_PATCH_MAX_DELAY). Every snapshot write - save-file, a delayed
+    write or compaction of a journal longer than
+    config['project_journal_limit'] - removes the journal it covers.
+    Loading reads the snapshot and replays the journal lines after its
+    revision; a torn last line left by a crash is cut off. The journal
+    also gives the project at any revision since the last snapshot.
+
+    Every change runs under the project's ProjectLock, which other server
+    processes share, and first compares the cached copy with the snapshot's
+    stat and the journal's size on disk, re-reading it after a write by
+    another process. With several server workers or a session supervisor
+    writes are not delayed, so no process holds unwritten changes.
+    """
+
+    def __init__(self, storage, max_documents=PROJECT_DOCUMENTS_MAX):
+        self.storage = storage
+        self.max_documents = max_documents
+        self._docs = OrderedDict()
+        self._lock = threading.Lock()
+        self._saver = None
+
+    def start(self):
+        # Поток записи запускается с первым патчем: без патчей писать по таймеру нечего
+        with self._lock:
+            if self._saver is None:
+                self._saver = PeriodicTask(self.flush, PROJECT_FLUSH_INTERVAL, "Ошибка сохранения проектов")
+                atexit.register(self.flush, force=True)
+        self._saver.start()
+
+    def journal_path(self, filename):
+        return self.storage.path(filename) + PROJECT_JOURNAL_SUFFIX
+
+    def _file_stat(self, filename):
+        try:
+            st = os.stat(self.storage.path(filename))
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def _journal_size(self, filename):
+        try:
+            return os.path.getsize(self.journal_path(filename))
+        except FileNotFoundError:
+            return 0
+
+    def _is_current(self, doc, filename):
+        """Whether `doc` still matches the files on disk."""
+        return doc.stat == self._file_stat(filename) and doc.journal_size == self._journal_size(filename)
+
+    def _journal_records(self, filename, base_revision, size=None):
+        """Journal lines continuing `base_revision` as (record, start, end) and the end of the valid part."""
+        try:
+            with open(self.journal_path(filename), 'rb') as f:
+                raw = f.read() if size is None else f.read(size)
+        except FileNotFoundError:
+            return [], 0
+        records, offset, expected = [], 0, base_revision + 1
+        for line in raw.splitlines(keepends=True):
+            if not line.endswith(b'\n'):
+                break  # строка, недописанная при сбое
+            try:
+                record = json.loads(line)
+                revision, ops = record['revision'], record['ops']
+            except (ValueError, KeyError, TypeError):
+                break
+            if not isinstance(revision, int) or not isinstance(ops, list):
+                break
+            if revision > base_revision:
+                if revision != expected:
+                    break  # журнал от другого снимка (например, восстановленного из резервной копии)
+                records.append((record, offset, offset + len(line)))
+                expected += 1
+            offset += len(line)
+        return records, offset
+
+    def _load(self, filename):
+        # Вызывается под блокировкой проекта
+        stat = self._file_stat(filename)
+        if stat is None:
+            raise FileNotFoundError(filename)
+        data = self.storage.read(filename)
+        if not isinstance(data, dict):
+            raise ValueError("Файл проекта не содержит объект проекта")
+        base_revision = data.pop(PROJECT_REVISION_KEY, 0)
+        if not isinstance(base_revision, int):
+            base_revision = 0
+        revision = base_revision
+        records, valid = self._journal_records(filename, base_revision)
+        for record, start, end in records:
+            try:
+                data = apply_project_patch(data, record['ops'])
+            except ProjectPatchError as e:
+                print(f"Ошибка журнала проекта {filename}, ревизия {record['revision']}: {e}")
+                valid = start
+                break
+            revision = record['revision']
+        if self._journal_size(filename) > valid:
+            print(f"Журнал проекта {filename} обрезан до последней целой записи")
+            with open(self.journal_path(filename), 'r+b') as f:
+                f.truncate(valid)
+        doc = ProjectDocument(data, revision, stat)
+        doc.base_revision = base_revision
+        doc.journal_size = valid
+        return doc
+
+    def _current(self, filename):
+        """Cached document matching the files on disk; call under the project lock."""
+        with self._lock:
+            doc = self._docs.get(filename)
+            if doc is not None:
+                self._docs.move_to_end(filename)
+        if doc is not None and self._is_current(doc, filename):
+            return doc
+        fresh = self._load(filename)
+        if doc is not None:
+            with doc.lock:
+                if doc.dirty:
+                    print(f"Проект {filename} изменён на диске: незаписанные патчи ревизий "
+                          f"{doc.saved_revision + 1}-{doc.revision} заменены версией с диска")
+                if fresh.revision <= doc.revision:
+                    # Файл записали без нашей ревизии: она не уменьшается, чтобы клиенты
+                    # со старой копией получили конфликт; на диск попадёт при записи
+                    fresh.revision = doc.revision + 1
+                    fresh.dirty_since = fresh.changed_at = time.monotonic()
+                doc.detached = True
+        with self._lock:
+            self._docs[filename] = fresh
+            self._docs.move_to_end(filename)
+            self._evict()
+        if fresh.dirty:
+            self.start()
+        return fresh
+
+    def get(self, filename):
+        """Document of a project matching the disk; FileNotFoundError if there is none."""
+        with self._lock:
+            doc = self._docs.get(filename)
+            if doc is not None:
+                self._docs.move_to_end(filename)
+        if doc is not None and self._is_current(doc, filename):
+            return doc
+        with self.storage.lock(filename):
+            return self._current(filename)
+
+    def _evict(self):
+        for filename in list(self._docs)[:-self.max_documents or None]:
+            if len(self._docs) <= self.max_documents:
+                break
+            doc = self._docs[filename]
+            if not doc.lock.acquire(blocking=False):
+                continue
+            try:
+                if doc.dirty:
+                    continue
+                doc.detached = True
+                del self._docs[filename]
+            finally:
+                doc.lock.release()
+
+    def read(self, filename):
+        """(project_data, revision) of a project; the returned data is never modified later."""
+        doc = self.get(filename)
+        with doc.lock:
+            return doc.data, doc.revision
+
+    def history(self, filename):
+        """Current revision, snapshot revision and the journal records after it."""
+        with self.storage.lock(filename):
+            doc = self._current(filename)
+            records, _ = self._journal_records(filename, doc.base_revision, doc.journal_size)
+            return doc.revision, doc.base_revision, [record for record, _, _ in records]
+
+    def read_at(self, filename, revision):
+        """The project as it was at `revision`: the snapshot plus the journal up to that revision."""
+        with self.storage.lock(filename):
+            doc = self._current(filename)
+            if revision == doc.revision:
+                return doc.data
+            base_revision = doc.base_revision
+            records, _ = self._journal_records(filename, base_revision, doc.journal_size)
+            if not base_revision <= revision <= base_revision + len(records):
+                raise ProjectHistoryError(f"Ревизия {revision} недоступна: в журнале ревизии "
+                                          f"{base_revision}-{base_revision + len(records)}")
+            data = self.storage.read(filename)
+            data.pop(PROJECT_REVISION_KEY, None)
+        for record, _, _ in records[:revision - base_revision]:
+            data = apply_project_patch(data, record['ops'])
+        return data
+
+    def patch(self, filename, revision, ops, flush=False):
+        delayed = _project_writes_delayed()
+        if delayed and self._saver is None:
+            self.start()
+        with self.storage.lock(filename):
+            doc = self._current(filename)
+            if revision != doc.revision:
+                return {"status": "error", "conflict": True, "revision": doc.revision,
+                        "message": "Проект изменён в другом месте, ревизия устарела"}
+            data = apply_project_patch(doc.data, ops)
+            new_revision = doc.revision + 1
+            # Пока есть незаписанные изменения, журнал не продолжает ревизии снимка - ждём записи
+            if config['project_journal'] and not doc.dirty:
+                self._append(filename, doc, new_revision, ops)
+                with doc.lock:
+                    doc.data, doc.revision, doc.saved_revision = data, new_revision, new_revision
+            else:
+                now = time.monotonic()
+                with doc.lock:
+                    if not doc.dirty:
+                        doc.dirty_since = now
+                    doc.changed_at = now
+                    doc.data, doc.revision = data, new_revision
+                if flush or not delayed:
+                    self._write(filename, doc, data, new_revision)
+        return {"status": "success", "revision": new_revision, "saved": not doc.dirty}
+
+    def _append(self, filename, doc, revision, ops):
+        # Вызывается под блокировкой проекта: записи журнала идут строго по порядку ревизий
+        line = json.dumps({"revision": revision, "time": datetime.utcnow().isoformat() + 'Z', "ops": ops},
+                          ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+        path = self.journal_path(filename)
+        try:
+            with open(path, 'ab') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError:
+            if os.path.exists(path):
+                with open(path, 'r+b') as f:
+                    f.truncate(doc.journal_size)
+            raise
+        doc.journal_size += len(line)
+
+    def save(self, filename, project_data):
+        """Replace a project and write it immediately; returns the new revision."""
+        with self.storage.lock(filename):
+            try:
+                doc = self._current(filename)
+            except (FileNotFoundError, ValueError) as e:
+                if not isinstance(e, FileNotFoundError):
+                    # Повреждённый файл (например, обрезанный при сбое) перезаписывается,
+                    # а его копия остаётся в projects/.backups
+                    print(f"Проект {filename} повреждён ({e}), сохраняется поверх него")
+                doc = ProjectDocument({}, 0)
+                with self._lock:
+                    old = self._docs.get(filename)
+                    if old is not None:
+                        old.detached = True
+                    self._docs[filename] = doc
+                    self._evict()
+            revision = doc.revision + 1
+            with doc.lock:
+                doc.data, doc.revision = project_data, revision
+            self._write(filename, doc, project_data, revision)
+            return revision
+
+    def _write(self, filename, doc, data, revision):
+        # Вызывается под блокировкой проекта: снимок покрывает весь журнал, и он удаляется
+        self.storage.write(filename, {**data, PROJECT_REVISION_KEY: revision})
+        _remove_quietly(self.journal_path(filename))
+        stat = self._file_stat(filename)
+        with doc.lock:
+            doc.saved_revision = max(doc.saved_revision, revision)
+            doc.base_revision = revision
+            doc.stat = stat
+            doc.journal_size = 0
+        project_index.update(filename, data)
+
+    def _flush_document(self, filename, doc, compact=False):
+        with self.storage.lock(filename):
+            if doc.detached or not (doc.dirty or (compact and doc.journal_size)):
+                return
+            if not self._is_current(doc, filename):
+                # Файл записал другой процесс или программа: новая версия с диска важнее
+                self._current(filename)
+                return
+            self._write(filename, doc, doc.data, doc.revision)
+
+    def flush(self, filename=None, force=False):
+        """Write patched projects that are due (all of them with force=True) and compact long journals."""
+        now = time.monotonic()
+        with self._lock:
+            docs = [(name, doc) for name, doc in self._docs.items() if filename in (None, name)]
+        for name, doc in docs:
+            compact = doc.journal_size > config['project_journal_limit']
+            if not doc.dirty and not compact:
+                continue
+            if compact or force or filename is not None or now - doc.changed_at >= PROJECT_PATCH_SAVE_DELAY \
+                    or now - doc.dirty_since >= PROJECT_PATCH_MAX_DELAY:
+                try:
+                    self._flush_document(name, doc, compact=compact)
+                except (OSError, ValueError) as e:
+                    print(f"Ошибка сохранения проекта {name}: {e}")
+
+    def detach(self, filename, save=True):
+        """Drop the cached copy before the file is renamed (folding changes into the snapshot) or deleted."""
+        with self.storage.lock(filename):
+            if save:
+                try:
+                    doc = self._current(filename)
+                except FileNotFoundError:
+                    doc = None
+                if doc is not None and (doc.dirty or doc.journal_size):
+                    # Журнал не переименовывается вместе с файлом, сворачиваем его в снимок
+                    self._write(filename, doc, doc.data, doc.revision)
+            with self._lock:
+                doc = self._docs.pop(filename, None)
+            if doc is not None:
+                doc.detached = True
+            if not save:
+                _remove_quietly(self.journal_path(filename))
+
+
+project_documents = ProjectDocuments(project_storage)
+
+
+@app.route('/api/project/save-file', methods=['POST'])
+def save_project_file():
+    data = request.get_json()
+    filename = data.get('filename', '').strip()
+    project_data = data.get('project_data')
+    template_id = data.get('template_id')
+    project_path = ''
+    if isinstance(project_data, dict):
+        project_path = project_data.get('projectPath', '')
+    if not project_path:
+        project_path = data.get('project_path', '')
+    
+    print(f"Received save request: filename={filename}, project_path={project_path}")
+    
+    if not filename:
+        return jsonify({"status": "error", "message": "Имя файла обязательно"})
+    filename = project_storage.clean_filename(filename, add_suffix=True)
+    if not filename:
+        return jsonify({"status": "error", "message": "Некорректное имя файла"}), 400
+    
+    if not isinstance(project_data, dict) or not project_data:
+        project_data = load_template_data(template_id, project_path)
+        project_data['templateId'] = template_id or DEFAULT_TEMPLATE['id']
+    else:
+        project_data.setdefault('blocks', [])
+        project_data.setdefault('connections', [])
+        project_data['projectPath'] = project_path or project_data.get('projectPath', '')
+        # Дата создания сохраняется при повторных сохранениях
+        indexed = project_index.get(filename)
+        project_data['createdAt'] = (indexed and indexed['created_at']) or datetime.utcnow().isoformat() + 'Z'
+    
+    # Всегда сохраняем в папку projects для простоты
+    filepath = project_storage.path(filename)
+    print(f"Saving to projects folder: {filepath}")
+    
+    try:
+        project_data.pop(PROJECT_REVISION_KEY, None)
+        revision = project_documents.save(filename, project_data)
+        print(f"Successfully saved project to: {filepath}")
+        return jsonify({"status": "success", "filename": filename, "path": filepath, "revision": revision})
+    except Exception as e:
+        print(f"Error saving file: {e}")
+        return jsonify({"status": "error", "message": f"Ошибка сохранения: {str(e)}"})
+
+
+@app.route('/api/project/load-file', methods=['POST'])
+def load_project_file():
+    data = request.get_json()
+    filename = project_storage.clean_filename(data.get('filename'))
+    if not filename:
+        return jsonify({"status": "error", "message": "Некорректное имя файла"}), 400
+    
+    # Сначала ищем в папке projects
+    if not project_storage.exists(filename):
+        # Если не найден в projects, ищем в других местах
+        # Пока что возвращаем ошибку, но в будущем можно расширить поиск
+        return jsonify({"status": "error", "message": "Файл не найден"})
+    
+    try:
+        if data.get('revision') is not None:
+            # Состояние проекта на одну из ревизий журнала (см. /api/project/history)
+            revision = data['revision']
+            project_data = project_documents.read_at(filename, revision)
+        else:
+            # Из кэша: там могут быть изменения из патчей, ещё не записанные на диск
+            project_data, revision = project_documents.read(filename)
+        return jsonify({"status": "success", "project_data": project_data, "revision": revision})
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка загрузки: {str(e)}"})
+
+
+@app.route('/api/project/history')
+def project_history():
+    """Revisions of a project that load-file can return with "revision".
+
+    Covers the snapshot revision and every journaled patch after it, newest
+    last; older states are in projects/.backups.
+    """
+    filename = project_storage.clean_filename(request.args.get('filename', ''))
+    if not filename:
+        return jsonify({"status": "error", "message": "Некорректное имя файла"}), 400
+    if not project_storage.exists(filename):
+        return jsonify({"status": "error", "message": "Файл не найден"}), 404
+    try:
+        revision, base_revision, records = project_documents.history(filename)
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+    return jsonify({
+        "status": "success",
+        "revision": revision,
+        "base_revision": base_revision,
+        "entries": [{"revision": record["revision"], "time": record.get("time"), "ops": len(record["ops"])}
+                    for record in records]
+    })
+
+
+@app.route('/api/project/patch', methods=['POST'])
+def patch_project():
+    """Apply JSON Patch operations to a saved project.
+
+    Body: {"filename", "revision", "ops": [{"op": "replace", "path":
+    "/blocks/3/x", "value": 120}, ...], "flush": false}. `revision` is the
+    one returned by load-file, save-file or the previous patch; a different
+    revision gets 409 with the current one, and the client should reload or
+    send the whole project to save-file. The project is written to disk
+    shortly after the last patch, or immediately with "flush": true.
+    """
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename') or ''
+    revision = data.get('revision')
+    if not filename or not isinstance(revision, int):
+        return jsonify({"status": "error", "message": "Нужны filename и revision"}), 400
+    filename = project_storage.clean_filename(filename)
+    if not filename:
+        return jsonify({"status": "error", "message": "Некорректное имя файла"}), 400
+    try:
+        result = project_documents.patch(filename, revision, data.get('ops'), flush=bool(data.get('flush')))
+    except FileNotFoundError:
+        return jsonify({"status": "error", "message": "Файл не найден"}), 404
+    except ProjectPatchError as e:
+        return jsonify({"status": "error", "message": f"Некорректный патч: {e}"}), 400
+    except Exception as e:
+        print(f"Error patching project: {e}")
+        return jsonify({"status": "error", "message": f"Ошибка сохранения: {str(e)}"}), 500
+    return jsonify(result), 409 if result.get("conflict") else 200
+
+
+@app.route('/api/project/list')
+def list_projects():
+    """Projects from the index, one page at a time.
+
+    ?offset= and ?limit= select the page (all projects without limit),
+    ?sort=name|lastModified|createdAt|size|blocks with ?order=asc|desc,
+    ?q= filters by name and ?template= by template origin. `projects`
+    keeps the bare filenames of the old response, `items` has the details.
+    """
+    try:
+        if not os.path.exists(PROJECTS_FOLDER):
+            os.makedirs(PROJECTS_FOLDER, exist_ok=True)
+            print(f"Created projects folder: {PROJECTS_FOLDER}")
+
+        project_index.reconcile()
+        offset = max(0, request.args.get('offset', 0, type=int))
+        limit = request.args.get('limit', type=int)
+        if limit is not None:
+            limit = max(0, limit)
+        total, items = project_index.query(
+            offset=offset,
+            limit=limit,
+            sort=request.args.get('sort', 'name'),
+            order=request.args.get('order', 'asc'),
+            search=request.args.get('q', '').strip(),
+            template=request.args.get('template')
+        )
+        return jsonify({
+            "status": "success",
+            "projects": [item["filename"] for item in items],
+            "items": items,
+            "total": total,
+            "offset": offset,
+            "limit": limit
+        })
+    except Exception as e:
+        print(f"Error listing projects: {e}")
+        return jsonify({"status": "error", "message": str(e)})
+
+
+@app.route('/api/project/delete', methods=['POST'])
+def delete_project():
+    data = request.get_json()
+    filename = data.get('filename')
+    if not filename:
+        return jsonify({"status": "error", "message": "Имя файла обязательно"})
+    filename = project_storage.clean_filename(filename)
+    if not filename:
+        return jsonify({"status": "error", "message": "Некорректное имя файла"}), 400
+    
+    # Ищем файл в папке projects
+    if not project_storage.exists(filename):
+        return jsonify({"status": "error", "message": "Файл не найден"})
+    
+    try:
+        project_documents.detach(filename, save=False)
+        project_storage.delete(filename)
+        project_index.remove(filename)
+        return jsonify({"status": "success"})
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)})
+
+
+@app.route('/api/project/compile', methods=['POST'])
+def compile_project():
+    data = request.get_json()
+    project_id = data.get('project_id')
+    if project_id:
+        # Инкрементальный режим: project_data для полной синхронизации или diff по блокам
+        try:
+            return jsonify(compile_project_incremental(
+                project_id,
+                project_data=data.get('project_data'),
+                diff=data.get('diff'),
+                revision=data.get('revision')
+            ))
+        except (KeyError, TypeError) as e:
+            return jsonify({"status": "error", "message": f"Некорректные данные проекта: {str(e)}"})
+    return jsonify({
+        "status": "success",
+        "code": generate_python_code(data.get('project_data', {}))
+    })
+
+
+@app.route('/api/project/compile-exe', methods=['POST'])
+def compile_exe():
+    try:
+        # Get form data
+        code = request.form.get('code', '')
+        exe_name = request.form.get('exe_name', 'program.exe')
+        hide_console = request.form.get('hide_console', 'false').lower() == 'true'
+        icon_file = request.files.get('icon')
+        
+        if not code.strip():
+            return jsonify({"status": "error", "message": "Код не может быть пустым"})
+        
+        # Create compiled folder in project directory
+        compiled_path = os.path.join(os.getcwd(), 'compiled')
+        os.makedirs(compiled_path, exist_ok=True)
+        
+        def generate_progress():
+            try:
+                # Step 1: Create temporary Python file
+                yield f'data: {{"progress": 10, "status": "Создание временного файла..."}}\n\n'
+                
+                with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False, encoding='utf-8') as f:
+                    f.write(code)
+                    temp_py_file = f.name
+                
+                # Step 2: Install PyInstaller if needed
+                yield f'data: {{"progress": 20, "status": "Проверка PyInstaller..."}}\n\n'
+                
+                try:
+                    subprocess.run(['pyinstaller', '--version'], capture_output=True, check=True)
+                except (subprocess.CalledProcessError, FileNotFoundError):
+                    yield f'data: {{"progress": 25, "status": "Установка PyInstaller..."}}\n\n'
+                    subprocess.run(['pip', 'install', 'pyinstaller'], check=True)
+                
+                # Step 3: Prepare command
+                yield f'data: {{"progress": 30, "status": "Подготовка команды..."}}\n\n'
+                
+                exe_name_clean = exe_name.replace('.exe', '')
+                cmd = [
+                    'pyinstaller',
+                    '--onefile',
+                    '--distpath', compiled_path,
+                    '--name', exe_name_clean,
+                    '--clean'
+                ]
+                
+                if hide_console:
+                    cmd.append('--noconsole')
+                
+                if icon_file:
+                    icon_temp = tempfile.NamedTemporaryFile(suffix='.ico', delete=False)
+                    icon_file.save(icon_temp.name)
+                    cmd.extend(['--icon', icon_temp.name])
+                
+                cmd.append(temp_py_file)
+                
                 # Step 4: Run PyInstaller
                 yield f'data: {{"progress": 40, "status": "Запуск компиляции..."}}\n\n'
                 
@@ -542,238 +2249,1425 @@ def compile_exe():
                 
                 # Cleanup
                 try:
-                    os.unlink(temp_py_file)
-                    if icon_file:
-                        os.unlink(icon_temp.name)
-                    # Clean PyInstaller files
-                    for item in ['build', '__pycache__', exe_name_clean + '.spec']:
-                        if os.path.exists(item):
-                            if os.path.isdir(item):
-                                shutil.rmtree(item)
-                            else:
-                                os.unlink(item)
-                except:
-                    pass
-                    
+                    os.unlink(temp_py_file)
+                    if icon_file:
+                        os.unlink(icon_temp.name)
+                    # Clean PyInstaller files
+                    for item in ['build', '__pycache__', exe_name_clean + '.spec']:
+                        if os.path.exists(item):
+                            if os.path.isdir(item):
+                                shutil.rmtree(item)
+                            else:
+                                os.unlink(item)
+                except:
+                    pass
+                    
+            except Exception as e:
+                yield f'data: {{"status": "error", "message": "Ошибка: {str(e)}"}}\n\n'
+        
+        return Response(generate_progress(), mimetype='text/plain')
+        
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка сервера: {str(e)}"})
+
+
+@app.route('/api/project/open-compiled-folder', methods=['POST'])
+def open_compiled_folder():
+    try:
+        compiled_path = os.path.join(os.getcwd(), 'compiled')
+        
+        if not os.path.exists(compiled_path):
+            return jsonify({"status": "error", "message": "Папка compiled не найдена"})
+        
+        # Try to open folder in file explorer
+        if os.name == 'nt':  # Windows
+            os.startfile(compiled_path)
+        elif os.name == 'posix':  # macOS and Linux
+            subprocess.run(['open' if sys.platform == 'darwin' else 'xdg-open', compiled_path])
+        else:
+            return jsonify({"status": "error", "message": "Неподдерживаемая операционная система"})
+        
+        return jsonify({"status": "success", "message": "Папка открыта"})
+        
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка открытия папки: {str(e)}"})
+
+
+@app.route('/api/block/duplicate', methods=['POST'])
+def duplicate_block():
+    data = request.get_json()
+    block_data = data.get('block_data', {})
+    new_block = block_data.copy()
+    new_block['id'] = str(uuid.uuid4())
+    new_block['x'] += 20
+    new_block['y'] += 20
+    return jsonify({"status": "success", "new_block": new_block})
+
+
+# ===================== Interactive Run =====================
+sessions = {}  # session_id -> {"process", "output", "input", "read_offset", "thread", "script", "limits", "usage", "telemetry", "limit_hit", "started_at", "last_access", "finished_at"}
+sessions_lock = threading.Lock()
+SESSION_REAP_INTERVAL = 1.0  # seconds between reaper passes, also the wall-clock limit granularity
+
+
+class SessionOutput:
+    """Bounded ring buffer holding the output of one run session.
+
+    Offsets grow monotonically from the start of the session and are counted
+    in characters of decoded output. Once more than `limit` characters are
+    retained the oldest ones are dropped, and a reader asking for an offset
+    that is gone is told how much it missed. Reads never consume data, so
+    several viewers can tail the same session.
+    """
+
+    COALESCE_SIZE = 4096  # small writes are merged into the last chunk
+
+    def __init__(self, limit):
+        self.limit = max(1, int(limit))
+        self._chunks = deque()  # [start_offset, text]
+        self._size = 0
+        self._cond = threading.Condition()
+        self.start = 0  # offset of the oldest retained character
+        self.end = 0  # offset just past the newest character
+        self.closed = False
+        self._listeners = []  # callables notified on new output and on close, must not block
+
+    def append(self, text):
+        if not text:
+            return
+        with self._cond:
+            if self._chunks and len(self._chunks[-1][1]) < self.COALESCE_SIZE:
+                self._chunks[-1][1] += text
+            else:
+                self._chunks.append([self.end, text])
+            self.end += len(text)
+            self._size += len(text)
+
+            overflow = self._size - self.limit
+            while overflow > 0:
+                chunk = self._chunks[0]
+                if len(chunk[1]) <= overflow:
+                    self._chunks.popleft()
+                    overflow -= len(chunk[1])
+                    self._size -= len(chunk[1])
+                else:
+                    chunk[1] = chunk[1][overflow:]
+                    chunk[0] += overflow
+                    self._size -= overflow
+                    overflow = 0
+            self.start = self._chunks[0][0] if self._chunks else self.end
+            self._notify()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._notify()
+
+    def _notify(self):
+        self._cond.notify_all()
+        for listener in self._listeners:
+            listener()
+
+    def subscribe(self, listener):
+        """Call `listener()` whenever output is appended or the buffer is closed."""
+        with self._cond:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        with self._cond:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def wait(self, since, timeout):
+        with self._cond:
+            return self._cond.wait_for(lambda: self.end > since or self.closed, timeout)
+
+    def read(self, since=0):
+        with self._cond:
+            since = max(0, min(int(since), self.end))
+            begin = max(since, self.start)
+            parts = []
+            # Читатели обычно близко к концу, поэтому идём с конца буфера
+            for chunk_start, text in reversed(self._chunks):
+                if chunk_start + len(text) <= begin:
+                    break
+                parts.append(text[max(0, begin - chunk_start):])
+            parts.reverse()
+            return {
+                "output": "".join(parts),
+                "offset": begin,
+                "next": self.end,
+                "dropped": begin - since,
+                "droppedTotal": self.start,
+                "exited": self.closed
+            }
+
+
+class SessionInput:
+    """Stdin data of one run session waiting for the program to read it.
+
+    Request handlers only put() into the queue, so they never wait for the
+    program; the data is moved into the pipe by stdin_writer (thread
+    backend) or by a task on the session loop (async backend). `queued` is
+    reported back to clients, and put() refuses data beyond `limit`.
+    """
+
+    def __init__(self, limit):
+        self.limit = max(1, int(limit))
+        self._chunks = deque()
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.written = 0
+        self.error = None
+
+    def put(self, data):
+        """Queue `data`; False if it does not fit. Raises BrokenPipeError once stdin failed."""
+        with self._lock:
+            if self.error is not None:
+                raise BrokenPipeError(self.error)
+            if self.queued + len(data) > self.limit:
+                return False
+            self._chunks.append(data)
+            self.queued += len(data)
+            return True
+
+    def peek(self):
+        with self._lock:
+            return self._chunks[0] if self._chunks else None
+
+    def consume(self, size):
+        with self._lock:
+            self.queued -= size
+            self.written += size
+            while size and self._chunks:
+                chunk = self._chunks[0]
+                if len(chunk) <= size:
+                    self._chunks.popleft()
+                    size -= len(chunk)
+                else:
+                    self._chunks[0] = chunk[size:]
+                    size = 0
+
+    def fail(self, error):
+        with self._lock:
+            self.error = str(error)
+            self._chunks.clear()
+            self.queued = 0
+
+
+class StdinWriter:
+    """One thread feeding the stdin pipes of all thread-backend sessions.
+
+    Pipes are switched to non-blocking mode and watched with a selector, so
+    a program that does not read its input only keeps the data queued. On
+    Windows, where pipes cannot be selected, each session with pending input
+    gets a short-lived thread doing blocking writes instead.
+    """
+
+    def __init__(self):
+        self._pending = {}  # fd -> sess with queued input
+        self._lock = threading.Lock()
+        self._thread = None
+        self._wake_r = self._wake_w = None
+        self._blocking_threads = {}  # fd -> thread, Windows only
+
+    def wake(self, sess):
+        """Schedule writing of whatever is queued in sess["input"]."""
+        fd = sess["process"].stdin.fileno()
+        with self._lock:
+            if os.name == 'nt':
+                if fd not in self._blocking_threads:
+                    thread = threading.Thread(target=self._run_blocking, args=(fd, sess), daemon=True)
+                    self._blocking_threads[fd] = thread
+                    thread.start()
+                return
+            if fd not in self._pending:
+                os.set_blocking(fd, False)
+                self._pending[fd] = sess
+            if self._thread is None:
+                self._wake_r, self._wake_w = os.pipe()
+                os.set_blocking(self._wake_r, False)
+                os.set_blocking(self._wake_w, False)
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            try:
+                os.write(self._wake_w, b"\0")
+            except BlockingIOError:
+                pass  # поток и так уже разбужен
+
+    def discard(self, sess):
+        """Forget the session; called before its pipes are closed."""
+        with self._lock:
+            stdin = sess["process"].stdin
+            if stdin is not None and not stdin.closed:
+                fd = stdin.fileno()
+                if self._pending.get(fd) is sess:
+                    del self._pending[fd]
+
+    def _run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self._wake_r, selectors.EVENT_READ)
+        while True:
+            with self._lock:
+                for fd, sess in list(self._pending.items()):
+                    if sess["input"].queued == 0:
+                        del self._pending[fd]
+                pending = dict(self._pending)
+            for key in list(selector.get_map().values()):
+                if key.fd != self._wake_r and pending.get(key.fd) is not key.data:
+                    selector.unregister(key.fd)
+            for fd, sess in pending.items():
+                if fd not in selector.get_map():
+                    selector.register(fd, selectors.EVENT_WRITE, sess)
+            for key, _ in selector.select(timeout=1.0):
+                if key.fd == self._wake_r:
+                    try:
+                        os.read(self._wake_r, 4096)
+                    except BlockingIOError:
+                        pass
+                else:
+                    self._flush(key.fd, key.data)
+
+    def _flush(self, fd, sess):
+        inp = sess["input"]
+        with self._lock:
+            # Под блокировкой: discard() не даст закрыть и переиспользовать fd посреди записи
+            if self._pending.get(fd) is not sess:
+                return
+            while True:
+                chunk = inp.peek()
+                if chunk is None:
+                    return
+                try:
+                    written = os.write(fd, chunk)
+                except BlockingIOError:
+                    return
+                except OSError as e:
+                    inp.fail(e)
+                    del self._pending[fd]
+                    return
+                inp.consume(written)
+
+    def _run_blocking(self, fd, sess):
+        inp, stdin = sess["input"], sess["process"].stdin
+        while True:
+            chunk = inp.peek()
+            if chunk is None:
+                with self._lock:
+                    if inp.queued == 0:
+                        del self._blocking_threads[fd]
+                        return
+                continue
+            try:
+                stdin.write(chunk)
+                stdin.flush()
+            except (OSError, ValueError) as e:
+                inp.fail(e)
+                with self._lock:
+                    del self._blocking_threads[fd]
+                return
+            inp.consume(len(chunk))
+
+
+stdin_writer = StdinWriter()
+
+
+def _sandbox_settings(safe_mode, project_path):
+    """Parameters for runtime/turtcd_sandbox.py, the security prelude of every run."""
+    # Get engine directories (where the application runs)
+    engine_root = os.path.abspath(os.getcwd())
+    return {
+        "safe_mode": safe_mode,
+        "project_path": project_path or '',
+        "engine_root": engine_root,
+        "projects_folder": os.path.abspath(PROJECTS_FOLDER),
+        "compiled_folder": os.path.abspath(os.path.join(engine_root, 'compiled')),
+        "source_folder": os.path.abspath(os.path.join(engine_root, 'source'))
+    }
+
+
+def _run_limits(safe_mode):
+    limits = config['run_limits']
+    return dict(limits.get(safe_mode) or limits['restricted'])
+
+
+def _mark_limit_hit(sess, kind, message):
+    if sess["limit_hit"] is None:
+        sess["limit_hit"] = kind
+    sess["output"].append(f"\n[{message}]\n")
+
+
+def _session_limit_hit(sess):
+    returncode = sess["process"].returncode
+    sigxcpu = getattr(signal, 'SIGXCPU', None)
+    if sess["limit_hit"] is None and sigxcpu is not None and returncode == -sigxcpu:
+        sess["limit_hit"] = "cpu"
+    return sess["limit_hit"]
+
+
+def _touch_session(sess):
+    sess["last_access"] = time.monotonic()
+
+
+def _cleanup_session(sess):
+    """Kill the process if needed and release its pipes, thread and temp file."""
+    proc = sess["process"]
+    try:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait(timeout=5)
+    except Exception as e:
+        print(f"Ошибка остановки процесса сессии: {e}")
+    stdin_writer.discard(sess)
+    for pipe in (proc.stdin, proc.stdout):
+        try:
+            if pipe:
+                pipe.close()
+        except Exception:
+            pass
+    thread = sess.get("thread")
+    if thread is not None:
+        thread.join(timeout=1)
+    script = sess.get("script")
+    if script:
+        try:
+            os.unlink(script)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Не удалось удалить временный файл {script}: {e}")
+
+
+def remove_session(session_id):
+    with sessions_lock:
+        sess = sessions.pop(session_id, None)
+    if sess:
+        _cleanup_session(sess)
+    return sess
+
+
+def reap_sessions():
+    """Collect finished sessions after the grace period and evict idle ones."""
+    now = time.monotonic()
+    grace = config['session_exit_grace']
+    idle_timeout = config['session_idle_timeout']
+    expired = []
+    with sessions_lock:
+        for session_id, sess in sessions.items():
+            wall_seconds = sess["limits"].get("wall_seconds")
+            if wall_seconds and sess["process"].poll() is None and now - sess["started_at"] >= wall_seconds:
+                _mark_limit_hit(sess, "wall", f"Программа остановлена: превышен лимит времени работы {wall_seconds} с")
+                sess["process"].kill()
+            if sess["process"].poll() is not None and sess["output"].closed:
+                if sess["finished_at"] is None:
+                    sess["finished_at"] = now
+                if now - sess["finished_at"] >= grace:
+                    expired.append(session_id)
+                    continue
+            if idle_timeout and now - sess["last_access"] >= idle_timeout:
+                expired.append(session_id)
+    for session_id in expired:
+        remove_session(session_id)
+    return expired
+
+
+class PeriodicTask:
+    """Background thread that calls `func` every `interval` seconds."""
+
+    def __init__(self, func, interval, error_message):
+        self.func = func
+        self.interval = interval
+        self.error_message = error_message
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.func()
+            except Exception as e:
+                print(f"{self.error_message}: {e}")
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+
+session_reaper = PeriodicTask(reap_sessions, SESSION_REAP_INTERVAL, "Ошибка очистки сессий")
+
+
+def _session_summary(session_id, sess, now):
+    return {
+        "session_id": session_id,
+        "running": sess["process"].poll() is None,
+        "returncode": sess["process"].returncode,
+        "uptime": round(now - sess["started_at"], 1),
+        "idle": round(now - sess["last_access"], 1),
+        "limit_hit": _session_limit_hit(sess)
+    }
+
+
+@app.route('/api/project/status/<session_id>')
+def session_status(session_id):
+    return jsonify(session_registry.status(session_id))
+
+
+@app.route('/api/project/sessions')
+def list_sessions():
+    return jsonify(session_registry.list_sessions())
+
+
+# ===================== Session Telemetry =====================
+TELEMETRY_INTERVAL = 2.0  # seconds between samples of all running sessions
+_PROC_AVAILABLE = os.path.isdir('/proc/self')
+_CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if _PROC_AVAILABLE else 100
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if _PROC_AVAILABLE else 4096
+
+
+def _read_proc_stats(pid):
+    """CPU time, RSS, threads and open fds of a process from /proc (Linux)."""
+    with open(f'/proc/{pid}/stat', 'rb') as f:
+        data = f.read()
+    # Имя процесса в скобках может содержать пробелы, поля считаем после ')'
+    fields = data[data.rindex(b')') + 2:].split()
+    try:
+        open_fds = len(os.listdir(f'/proc/{pid}/fd'))
+    except OSError:
+        open_fds = None
+    return {
+        "cpu_seconds": (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS,
+        "threads": int(fields[17]),
+        "rss_bytes": int(fields[21]) * _PAGE_SIZE,
+        "open_fds": open_fds
+    }
+
+
+def sample_sessions():
+    """Refresh sess["telemetry"] of every session in one pass."""
+    now = time.monotonic()
+    with sessions_lock:
+        items = list(sessions.values())
+    for sess in items:
+        proc = sess["process"]
+        previous = sess.get("telemetry") or {}
+        sample = {
+            "running": proc.poll() is None,
+            "cpu_seconds": previous.get("cpu_seconds"),
+            "cpu_percent": None,
+            "rss_bytes": None,
+            "threads": None,
+            "open_fds": None,
+            "output_bytes": sess["usage"]["output_bytes"],
+            "input_bytes": sess["input"].written,
+            "sampled_at": now
+        }
+        if sample["running"] and _PROC_AVAILABLE:
+            try:
+                sample.update(_read_proc_stats(proc.pid))
+            except (OSError, ValueError, IndexError):
+                pass  # процесс завершился между poll() и чтением /proc
+            if previous.get("cpu_seconds") is not None and sample["cpu_seconds"] is not None:
+                elapsed = now - previous["sampled_at"]
+                if elapsed > 0:
+                    sample["cpu_percent"] = round((sample["cpu_seconds"] - previous["cpu_seconds"]) / elapsed * 100, 1)
+        sess["telemetry"] = sample
+
+
+telemetry_sampler = PeriodicTask(sample_sessions, TELEMETRY_INTERVAL, "Ошибка сбора телеметрии сессий")
+
+
+def _session_telemetry(sess, now):
+    sample = dict(sess.get("telemetry") or {})
+    # Счётчики ввода-вывода живые, а не из последнего замера: иначе сумма по сессиям отстаёт
+    sample["output_bytes"] = sess["usage"]["output_bytes"]
+    # Ввод считается, когда он записан в stdin программы, а не когда принят в очередь
+    sample["input_bytes"] = sess["input"].written
+    if "sampled_at" in sample:
+        sample["age"] = round(now - sample.pop("sampled_at"), 1)
+    return sample
+
+
+@app.route('/api/project/telemetry/<session_id>')
+def session_telemetry(session_id):
+    return jsonify(session_registry.telemetry(session_id))
+
+
+@app.route('/api/project/telemetry')
+def sessions_telemetry():
+    return jsonify(session_registry.telemetry())
+
+
+# ===================== Interpreter Discovery =====================
+PYTHON_CANDIDATES = ["python", "py", "python3"]  # порядок как при прежнем поиске в PATH
+_INTERPRETER_PROBE = (
+    "import sys, json, importlib.util;"
+    "print(json.dumps({'executable': sys.executable, 'version': sys.version.split()[0],"
+    "'implementation': sys.implementation.name, 'platform': sys.platform,"
+    "'capabilities': {'resource': importlib.util.find_spec('resource') is not None,"
+    "'venv': sys.prefix != sys.base_prefix}}))"
+)
+
+_interpreter = None
+_interpreter_lock = threading.Lock()
+
+
+def _probe_interpreter(command):
+    result = subprocess.run([command, "-c", _INTERPRETER_PROBE], capture_output=True, text=True, timeout=15, check=True)
+    info = json.loads(result.stdout.strip().splitlines()[-1])
+    # py (Windows launcher) сообщает путь к настоящему python.exe
+    info["path"] = os.path.abspath(info.pop("executable") or command)
+    info["command"] = command
+    return info
+
+
+def discover_interpreter():
+    """Find the Python used to run user programs and cache its details."""
+    global _interpreter
+    info = None
+    for cmd in PYTHON_CANDIDATES:
+        path = shutil.which(cmd)
+        if not path:
+            continue
+        try:
+            info = _probe_interpreter(path)
+            break
+        except (subprocess.SubprocessError, OSError, ValueError, IndexError):
+            continue
+    if info is None and sys.executable and not getattr(sys, 'frozen', False):
+        # Интерпретатор самого сервера подходит, если он не упакован PyInstaller
+        try:
+            info = _probe_interpreter(sys.executable)
+        except (subprocess.SubprocessError, OSError, ValueError, IndexError):
+            info = None
+    if info is not None:
+        info["resolved_at"] = datetime.utcnow().isoformat() + 'Z'
+    with _interpreter_lock:
+        _interpreter = info
+    return info
+
+
+def get_interpreter(refresh=False):
+    """Return cached interpreter info, re-resolving only if its executable is gone."""
+    info = _interpreter
+    if refresh or info is None or not os.path.exists(info["path"]):
+        info = discover_interpreter()
+    return info
+
+
+@app.route('/api/system/interpreter')
+def interpreter_info():
+    info = get_interpreter(refresh=request.args.get('refresh') == '1')
+    if not info:
+        return jsonify({"status": "error", "message": "Python не найден в системе. Установите Python с https://python.org"})
+    return jsonify({"status": "success", "interpreter": info})
+
+
+def _session_env(sandbox=None, limits=None):
+    # Настройки сервера (TURTCD_*, в том числе ключ сервиса сессий) программе не передаются
+    env = {name: value for name, value in os.environ.items() if not name.startswith(CONFIG_ENV_PREFIX)}
+    # Обмен с программой идёт в UTF-8 независимо от локали системы
+    env['PYTHONIOENCODING'] = 'utf-8'
+    for name, value in (sandbox or {}).items():
+        env['TURTCD_' + name.upper()] = value
+    if limits:
+        env['TURTCD_LIMITS'] = json.dumps(limits)
+    return env
+
+
+# ===================== Warm Interpreter Pool =====================
+RUNTIME_FOLDER = 'runtime'
+WORKER_SCRIPT_PATH = os.path.join(RUNTIME_FOLDER, 'turtcd_worker.py')
+
+
+class InterpreterPool:
+    """Keeps idle interpreters started ahead of time for near-instant runs.
+
+    Each worker runs runtime/turtcd_worker.py, which has already imported the
+    common modules and the sandbox and is blocked reading its first stdin
+    line. launch() hands a worker the sandbox settings and the user code over
+    that pipe and starts a replacement in the background.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._idle = deque()  # (interpreter path, Popen)
+        self._lock = threading.Lock()
+        self._filling = False
+
+    def _spawn(self, interpreter_path):
+        return subprocess.Popen(
+            [interpreter_path, os.path.abspath(WORKER_SCRIPT_PATH)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env=_session_env()
+        )
+
+    def _fill(self):
+        try:
+            while True:
+                interpreter = get_interpreter()
+                with self._lock:
+                    if not interpreter or len(self._idle) >= self.size:
+                        return
+                try:
+                    worker = self._spawn(interpreter["path"])
+                except OSError as e:
+                    print(f"Не удалось запустить резервный интерпретатор: {e}")
+                    return
+                with self._lock:
+                    self._idle.append((interpreter["path"], worker))
+        finally:
+            with self._lock:
+                self._filling = False
+
+    def refill(self):
+        if self.size <= 0:
+            return
+        with self._lock:
+            if self._filling or len(self._idle) >= self.size:
+                return
+            self._filling = True
+        threading.Thread(target=self._fill, daemon=True).start()
+
+    def _acquire(self, interpreter_path):
+        with self._lock:
+            while self._idle:
+                path, worker = self._idle.popleft()
+                if path == interpreter_path and worker.poll() is None:
+                    return worker
+                _discard_worker(worker)
+        return None
+
+    def launch(self, interpreter, sandbox, code, limits=None):
+        """Start a program on an idle worker; None if no worker is ready."""
+        worker = self._acquire(interpreter["path"])
+        self.refill()
+        if worker is None:
+            return None
+        payload = json.dumps({"sandbox": sandbox, "limits": limits or {}, "code": code}, ensure_ascii=False)
+        try:
+            worker.stdin.write(payload.encode('utf-8') + b"\n")
+            worker.stdin.flush()
+        except (BrokenPipeError, OSError, ValueError):
+            _discard_worker(worker)
+            return None
+        return worker
+
+    def shutdown(self):
+        with self._lock:
+            workers, self._idle = list(self._idle), deque()
+        for _, worker in workers:
+            _discard_worker(worker)
+
+
+def _discard_worker(worker):
+    try:
+        if worker.poll() is None:
+            worker.kill()
+        worker.wait(timeout=5)
+        for pipe in (worker.stdin, worker.stdout):
+            if pipe:
+                pipe.close()
+    except Exception:
+        pass
+
+
+interpreter_pool = InterpreterPool(config['warm_workers'])
+atexit.register(interpreter_pool.shutdown)
+
+
+SESSION_READ_CHUNK = 64 * 1024  # max bytes taken from the output pipe per read
+
+
+class OutputPump:
+    """Decodes raw program output into the session buffer and applies output_rate.
+
+    Used by both run backends: feed() takes a chunk read from the pipe and
+    returns how many seconds the reader should pause before the next read
+    (the program then blocks on the full pipe), or stops the program when
+    the session's output_action is "kill".
+    """
+
+    def __init__(self, sess):
+        self.sess = sess
+        self.rate = sess["limits"].get("output_rate") or 0
+        self._tokens, self._refilled_at = float(self.rate), time.monotonic()
+        self._decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder('utf-8')(errors='replace'), translate=True)
+
+    def feed(self, data):
+        sess = self.sess
+        sess["usage"]["output_bytes"] += len(data)
+        text = self._decoder.decode(data)
+        if text:
+            sess["output"].append(text)
+        if not self.rate or sess["limit_hit"] is not None:
+            return 0
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._refilled_at) * self.rate) - len(text)
+        self._refilled_at = now
+        if self._tokens >= 0:
+            return 0
+        if sess["limits"].get("output_action") == "kill":
+            _mark_limit_hit(sess, "output", f"Программа остановлена: вывод быстрее {self.rate} символов/с")
+            sess["process"].kill()
+            return 0
+        delay = -self._tokens / self.rate
+        sess["usage"]["throttled_seconds"] += delay
+        return delay
+
+    def finish(self):
+        """Flush the decoder; call once the pipe is at EOF and the process was waited for."""
+        sess = self.sess
+        tail = self._decoder.decode(b'', final=True)
+        if tail:
+            sess["output"].append(tail)
+        if sess["limit_hit"] is None and _session_limit_hit(sess) == "cpu":
+            sess["output"].append(f"\n[Программа остановлена: превышен лимит процессорного времени {sess['limits'].get('cpu_seconds')} с]\n")
+
+
+def _session_reader(sess):
+    """Move program output from the pipe to the session buffer in chunks.
+
+    Reads whatever is available from the raw fd (up to SESSION_READ_CHUNK)
+    and decodes it incrementally, so multibyte characters split between two
+    reads are kept intact and newlines are normalized like in text mode.
+    """
+    p, output = sess["process"], sess["output"]
+    pump = OutputPump(sess)
+    try:
+        fd = p.stdout.fileno()
+        while True:
+            try:
+                data = os.read(fd, SESSION_READ_CHUNK)
+                if not data:
+                    break
+                delay = pump.feed(data)
+                if delay:
+                    time.sleep(delay)
+            except (OSError, ValueError) as e:
+                # Handle broken pipes, closed streams, etc.
+                output.append(f"\n[Ошибка чтения вывода: {str(e)}]\n")
+                break
             except Exception as e:
-                yield f'data: {{"status": "error", "message": "Ошибка: {str(e)}"}}\n\n'
-        
-        return Response(generate_progress(), mimetype='text/plain')
-        
+                # Catch any other unexpected errors
+                output.append(f"\n[Неожиданная ошибка: {str(e)}]\n")
+                break
+        try:
+            p.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            pass
+        pump.finish()
     except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка сервера: {str(e)}"})
+        # Final safety net
+        try:
+            output.append(f"\n[Критическая ошибка потока: {str(e)}]\n")
+        except:
+            pass
+    finally:
+        try:
+            output.close()
+        except:
+            pass
 
 
-@app.route('/api/project/open-compiled-folder', methods=['POST'])
-def open_compiled_folder():
+# ===================== Async Run Backend =====================
+class AsyncProcess:
+    """Popen-like handle of a program owned by the AsyncSessionBackend loop.
+
+    The pipes belong to the loop, so `stdin`/`stdout` are None; input goes
+    through AsyncSessionBackend.wake(). poll(), kill() and wait() are safe to call from any
+    thread except the loop's own.
+    """
+
+    stdin = None
+    stdout = None
+
+    def __init__(self, backend, process):
+        self._backend = backend
+        self._process = process
+        self.pid = process.pid
+
+    @property
+    def returncode(self):
+        return self._process.returncode
+
+    def poll(self):
+        return self._process.returncode
+
+    def kill(self):
+        self._backend.call(self._kill)
+
+    def _kill(self):
+        if self._process.returncode is None:
+            try:
+                self._process.kill()
+            except ProcessLookupError:
+                pass
+
+    def wait(self, timeout=None):
+        if self._process.returncode is not None:
+            return self._process.returncode
+        future = self._backend.submit(self._process.wait())
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise subprocess.TimeoutExpired(str(self.pid), timeout)
+
+    async def feed(self, inp):
+        """Move the SessionInput queue into stdin, pausing while the pipe is full."""
+        stdin = self._process.stdin
+        try:
+            while True:
+                chunk = inp.peek()
+                if chunk is None:
+                    return
+                if stdin.is_closing():
+                    raise BrokenPipeError("stdin is closed")
+                stdin.write(chunk)
+                await stdin.drain()
+                inp.consume(len(chunk))
+        except (OSError, RuntimeError) as e:
+            inp.fail(e)
+
+
+def _install_child_watcher(loop):
+    # До Python 3.12 asyncio ждёт завершения каждого потомка в отдельном потоке,
+    # через pidfd все процессы ожидаются на самом цикле (Linux 5.3+)
+    if sys.version_info >= (3, 12) or not hasattr(os, 'pidfd_open'):
+        return
     try:
-        compiled_path = os.path.join(os.getcwd(), 'compiled')
-        
-        if not os.path.exists(compiled_path):
-            return jsonify({"status": "error", "message": "Папка compiled не найдена"})
-        
-        # Try to open folder in file explorer
-        if os.name == 'nt':  # Windows
-            os.startfile(compiled_path)
-        elif os.name == 'posix':  # macOS and Linux
-            subprocess.run(['open' if sys.platform == 'darwin' else 'xdg-open', compiled_path])
-        else:
-            return jsonify({"status": "error", "message": "Неподдерживаемая операционная система"})
-        
-        return jsonify({"status": "success", "message": "Папка открыта"})
-        
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка открытия папки: {str(e)}"})
+        os.close(os.pidfd_open(os.getpid()))
+        watcher = asyncio.PidfdChildWatcher()
+        watcher.attach_loop(loop)
+        asyncio.get_event_loop_policy().set_child_watcher(watcher)
+    except (OSError, AttributeError) as e:
+        print(f"pidfd недоступен, ожидание процессов через потоки: {e}")
+
+
+class AsyncSessionBackend:
+    """Runs the pipes of all sessions on one asyncio event loop.
+
+    Programs are started with asyncio.create_subprocess_exec and read by a
+    coroutine each, so a running session costs a task instead of a reader
+    thread. The loop runs in a background thread, or on the ASGI server's
+    loop once attach() was called from asgi_app. sess["process"] is an
+    AsyncProcess, so the reaper, telemetry and endpoints work unchanged.
+    """
+
+    CALL_TIMEOUT = 15  # seconds a request handler waits for the loop
+
+    def __init__(self):
+        self.loop = None
+        self._lock = threading.Lock()
+        self._tasks = set()
+        self._feeders = {}  # id(sess) -> task writing its queued input
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                _install_child_watcher(loop)
+                threading.Thread(target=loop.run_forever, daemon=True, name="turtcd-sessions").start()
+                self.loop = loop
+            return self.loop
+
+    def attach(self, loop):
+        """Run sessions on an already running loop instead of a private thread."""
+        with self._lock:
+            if self.loop is None:
+                _install_child_watcher(loop)
+                self.loop = loop
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    def call(self, func, *args):
+        self._ensure_loop().call_soon_threadsafe(func, *args)
+
+    def wake(self, sess):
+        """Schedule writing of whatever is queued in sess["input"]."""
+        self.call(self._kick, sess)
+
+    def _kick(self, sess):
+        if id(sess) not in self._feeders:
+            self._feeders[id(sess)] = self.loop.create_task(self._feed(sess))
+
+    async def _feed(self, sess):
+        try:
+            await sess["process"].feed(sess["input"])
+        finally:
+            # В том же шаге цикла, что и опустевшая очередь: следующий wake() запустит новую задачу
+            self._feeders.pop(id(sess), None)
+
+    def start(self, sess, argv, env):
+        """Start `argv` for `sess` and begin pumping its output; blocks until spawned."""
+        self.submit(self._spawn(sess, argv, env)).result(self.CALL_TIMEOUT)
+
+    async def _spawn(self, sess, argv, env):
+        process = await asyncio.create_subprocess_exec(
+            *argv,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env=env,
+            limit=SESSION_READ_CHUNK
+        )
+        sess["process"] = AsyncProcess(self, process)
+        task = asyncio.get_running_loop().create_task(self._pump(sess, process))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _pump(self, sess, process):
+        output = sess["output"]
+        pump = OutputPump(sess)
+        try:
+            while True:
+                data = await process.stdout.read(SESSION_READ_CHUNK)
+                if not data:
+                    break
+                delay = pump.feed(data)
+                if delay:
+                    await asyncio.sleep(delay)
+            try:
+                await asyncio.wait_for(process.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+            pump.finish()
+        except Exception as e:
+            output.append(f"\n[Ошибка чтения вывода: {str(e)}]\n")
+        finally:
+            output.close()
+
+
+async_backend = AsyncSessionBackend()
+
+
+def session_backend_name():
+    backend = config['session_backend']
+    if backend == 'auto':
+        return 'async' if config['server']['mode'] == 'asgi' else 'thread'
+    return backend
+
+
+# ===================== Session Registry =====================
+class LocalSessionRegistry:
+    """Run sessions owned by this process, kept in the `sessions` dict.
+
+    Every method takes and returns plain JSON-compatible values (the API
+    payloads), so SupervisorSessionRegistry can forward the same calls to
+    the process that owns the sessions when the server runs several workers.
+    """
+
+    local = True
+
+    def __init__(self):
+        self._starting = 0  # места, занятые запусками между проверкой max_sessions и записью в sessions
+
+    def prepare(self):
+        get_interpreter()
+        interpreter_pool.refill()
+
+    def _reserve(self):
+        # Проверка лимита и занятие места под одной блокировкой: параллельные запуски не превысят max_sessions
+        with sessions_lock:
+            if len(sessions) + self._starting >= config['max_sessions']:
+                return False
+            self._starting += 1
+            return True
+
+    def start(self, code, safe_mode, project_path):
+        session_reaper.start()
+        telemetry_sampler.start()
+        if not self._reserve():
+            reap_sessions()
+            if not self._reserve():
+                return {
+                    "status": "error",
+                    "message": f"Достигнут лимит одновременно запущенных программ ({config['max_sessions']}). Остановите одну из них.",
+                    "limit": config['max_sessions']
+                }
+        session_id = str(uuid.uuid4())
+        fname = None
+        reserved = True
+        try:
+            # Security prelude settings based on safe mode
+            sandbox = _sandbox_settings(safe_mode, project_path)
+
+            interpreter = get_interpreter()
+            if not interpreter:
+                return {"status": "error", "message": "Python не найден в системе. Установите Python с https://python.org"}
+
+            limits = _run_limits(safe_mode)
+            now = time.monotonic()
+            sess = {
+                "process": None,
+                "output": SessionOutput(config['session_output_limit']),
+                "input": SessionInput(config['session_input_limit']),
+                "read_offset": 0,
+                "thread": None,
+                "script": None,
+                "limits": limits,
+                "usage": {"throttled_seconds": 0.0, "output_bytes": 0},
+                "telemetry": None,
+                "limit_hit": None,
+                "started_at": now,
+                "last_access": now,
+                "finished_at": None
+            }
+            async_mode = session_backend_name() == 'async'
+            # Сначала пробуем заранее запущенный интерпретатор из пула (только для потокового режима)
+            proc = None if async_mode else interpreter_pool.launch(interpreter, sandbox, code, limits)
+            if proc is None:
+                # Во временный файл пишется только код пользователя, prelude импортируется из runtime/
+                with tempfile.NamedTemporaryFile(mode="w", suffix=".py", delete=False, encoding="utf-8") as f:
+                    f.write(code)
+                    fname = f.name
+                sess["script"] = fname
+                argv = [interpreter["path"], os.path.abspath(WORKER_SCRIPT_PATH), fname]
+                if async_mode:
+                    async_backend.start(sess, argv, _session_env(sandbox, limits))
+                else:
+                    proc = subprocess.Popen(
+                        argv,
+                        stdin=subprocess.PIPE,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT,
+                        env=_session_env(sandbox, limits)
+                    )
+
+            if not async_mode:
+                sess["process"] = proc
+                sess["thread"] = threading.Thread(target=_session_reader, args=(sess,), daemon=True)
+                sess["thread"].start()
+            with sessions_lock:
+                sessions[session_id] = sess
+                self._starting -= 1
+                reserved = False
+            return {"status": "success", "session_id": session_id}
+        except Exception as e:
+            if fname and os.path.exists(fname):
+                try:
+                    os.unlink(fname)
+                except OSError:
+                    pass
+            return {"status": "error", "message": str(e)}
+        finally:
+            if reserved:
+                # Запуск не удался: место освобождается
+                with sessions_lock:
+                    self._starting -= 1
+
+    def read(self, session_id, since=None):
+        sess = sessions.get(session_id)
+        if not sess:
+            return {"status": "error", "message": "Session not found"}
+        _touch_session(sess)
+        try:
+            if since is not None:
+                # Чтение по смещению: не сдвигает общий курсор и не мешает другим зрителям
+                return {"status": "success", **sess["output"].read(since)}
+
+            # Старый режим опроса: общий курсор сессии и маркер __EXIT__ в конце
+            result = sess["output"].read(sess["read_offset"])
+            sess["read_offset"] = result["next"]
+            output = result["output"]
+            if result["exited"] and not sess.get("exit_reported"):
+                sess["exit_reported"] = True
+                output += "__EXIT__"
+            return {"status": "success", "output": output, "dropped": result["dropped"]}
+        except Exception as e:
+            return {"status": "error", "message": f"Ошибка чтения: {str(e)}"}
+
+    def wait(self, session_id, since, timeout):
+        """True once output past `since` exists or the program exited; None for an unknown session."""
+        sess = sessions.get(session_id)
+        if not sess:
+            return None
+        # Ожидание вывода считается активностью клиента
+        _touch_session(sess)
+        return sess["output"].wait(since, timeout)
+
+    def exit_code(self, session_id, timeout=5):
+        sess = sessions.get(session_id)
+        if not sess:
+            return None
+        if timeout <= 0:
+            return sess["process"].poll()
+        try:
+            return sess["process"].wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return None
+
+    def write(self, session_id, lines):
+        sess = sessions.get(session_id)
+        if not sess:
+            return {"status": "error", "message": "Session not found"}
+        _touch_session(sess)
+        payload = "".join(f"{line}\n" for line in lines).encode('utf-8')
+        inp = sess["input"]
+        try:
+            proc = sess["process"]
+            if proc.poll() is not None:
+                return {"status": "error", "message": "Process finished"}
+            try:
+                if not inp.put(payload):
+                    return {
+                        "status": "error",
+                        "message": "Программа не успевает читать ввод, попробуйте позже",
+                        "queued": inp.queued,
+                        "limit": inp.limit
+                    }
+            except BrokenPipeError as e:
+                return {"status": "error", "message": f"Ошибка записи: {str(e)}"}
+            if isinstance(proc, AsyncProcess):
+                async_backend.wake(sess)
+            else:
+                stdin_writer.wake(sess)
+            return {"status": "success", "accepted": len(payload), "queued": inp.queued, "limit": inp.limit}
+        except Exception as e:
+            return {"status": "error", "message": f"Ошибка процесса: {str(e)}"}
+
+    def stop(self, session_id):
+        if remove_session(session_id):
+            return {"status": "success"}
+        return {"status": "error", "message": "Session not found"}
+
+    def stop_all(self):
+        with sessions_lock:
+            session_ids = list(sessions)
+        for session_id in session_ids:
+            remove_session(session_id)
+
+    def status(self, session_id):
+        sess = sessions.get(session_id)
+        if not sess:
+            return {"status": "error", "message": "Session not found"}
+        _touch_session(sess)
+        summary = _session_summary(session_id, sess, time.monotonic())
+        usage = dict(sess["usage"], input_bytes=sess["input"].written, output_chars=sess["output"].end,
+                     output_dropped=sess["output"].start, input_queued=sess["input"].queued,
+                     input_written=sess["input"].written)
+        return {"status": "success", **summary, "limits": sess["limits"], "usage": usage}
+
+    def list_sessions(self):
+        now = time.monotonic()
+        with sessions_lock:
+            items = [_session_summary(sid, sess, now) for sid, sess in sessions.items()]
+        return {
+            "status": "success",
+            "sessions": items,
+            "limits": {
+                "max_sessions": config['max_sessions'],
+                "session_exit_grace": config['session_exit_grace'],
+                "session_idle_timeout": config['session_idle_timeout'],
+                "session_output_limit": config['session_output_limit'],
+                "session_input_limit": config['session_input_limit']
+            }
+        }
+
+    def telemetry(self, session_id=None):
+        now = time.monotonic()
+        if session_id is not None:
+            sess = sessions.get(session_id)
+            if not sess:
+                return {"status": "error", "message": "Session not found"}
+            return {"status": "success", "session_id": session_id, "telemetry": _session_telemetry(sess, now)}
+
+        with sessions_lock:
+            items = [(sid, _session_telemetry(sess, now)) for sid, sess in sessions.items()]
+        total = {"sessions": len(items), "running": 0, "cpu_seconds": 0.0, "cpu_percent": 0.0,
+                 "rss_bytes": 0, "threads": 0, "open_fds": 0, "output_bytes": 0, "input_bytes": 0}
+        for _, sample in items:
+            total["running"] += 1 if sample.get("running") else 0
+            for key in ("cpu_seconds", "cpu_percent", "rss_bytes", "threads", "open_fds", "output_bytes", "input_bytes"):
+                total[key] += sample.get(key) or 0
+        total["cpu_seconds"] = round(total["cpu_seconds"], 2)
+        total["cpu_percent"] = round(total["cpu_percent"], 1)
+        return {
+            "status": "success",
+            "interval": TELEMETRY_INTERVAL,
+            "total": total,
+            "sessions": [dict(sample, session_id=sid) for sid, sample in items]
+        }
+
+
+class SessionServiceError(ConnectionError):
+    """The session supervisor process cannot be reached."""
+
+
+class SupervisorSessionRegistry:
+    """Client of a SessionSupervisor: the sessions live in that process.
+
+    Used by every server worker when several are running, so a session
+    started through one worker can be read, written and stopped through
+    any other. Each thread keeps its own connection to the supervisor.
+    """
+
+    local = False
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self._local = threading.local()
+
+    def prepare(self):
+        pass  # интерпретатор и пул готовит процесс-владелец сессий
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            try:
+                conn = multiprocessing.connection.Client(self.address, authkey=self.authkey)
+            except (OSError, multiprocessing.AuthenticationError) as e:
+                raise SessionServiceError(f"Сервис сессий недоступен: {e}")
+            self._local.conn = conn
+        return conn
+
+    def _call(self, method, *args):
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.send((method, args))
+                break
+            except OSError as e:
+                # Соединение могло устареть после перезапуска сервиса - одна повторная попытка
+                self._local.conn = None
+                if attempt:
+                    raise SessionServiceError(f"Сервис сессий недоступен: {e}")
+        try:
+            ok, value = conn.recv()
+        except (EOFError, OSError) as e:
+            self._local.conn = None
+            raise SessionServiceError(f"Сервис сессий недоступен: {e}")
+        if not ok:
+            raise SessionServiceError(value)
+        return value
+
+    def start(self, code, safe_mode, project_path):
+        return self._call("start", code, safe_mode, project_path)
+
+    def read(self, session_id, since=None):
+        return self._call("read", session_id, since)
+
+    def wait(self, session_id, since, timeout):
+        return self._call("wait", session_id, since, timeout)
+
+    def exit_code(self, session_id, timeout=5):
+        return self._call("exit_code", session_id, timeout)
+
+    def write(self, session_id, lines):
+        return self._call("write", session_id, lines)
+
+    def stop(self, session_id):
+        return self._call("stop", session_id)
+
+    def status(self, session_id):
+        return self._call("status", session_id)
+
+    def list_sessions(self):
+        return self._call("list_sessions")
+
+    def telemetry(self, session_id=None):
+        return self._call("telemetry", session_id)
+
+
+class SessionSupervisor:
+    """Serves a LocalSessionRegistry to the server workers.
 
+    Listens on a Unix socket (a named pipe on Windows) through
+    multiprocessing.connection; each connection gets a thread, so a worker
+    waiting for output does not hold up the others.
+    """
 
-@app.route('/api/block/duplicate', methods=['POST'])
-def duplicate_block():
-    data = request.get_json()
-    block_data = data.get('block_data', {})
-    new_block = block_data.copy()
-    new_block['id'] = str(uuid.uuid4())
-    new_block['x'] += 20
-    new_block['y'] += 20
-    return jsonify({"status": "success", "new_block": new_block})
+    METHODS = ("start", "read", "wait", "exit_code", "write", "stop", "status", "list_sessions", "telemetry")
 
+    def __init__(self, registry, address, authkey):
+        self.registry = registry
+        self.address = address
+        self.authkey = authkey
 
-# ===================== Interactive Run =====================
-sessions = {}  # session_id -> {"process": Popen, "queue": queue.Queue()}
+    def serve_forever(self):
+        unix_socket = os.name != 'nt' and not self.address.startswith('\0')
+        # Сокет доступен только владельцу: права 0600 с момента создания
+        old_umask = os.umask(0o177) if unix_socket else None
+        try:
+            listener = multiprocessing.connection.Listener(self.address, authkey=self.authkey)
+        finally:
+            if old_umask is not None:
+                os.umask(old_umask)
+        if unix_socket:
+            os.chmod(self.address, 0o600)
+        with listener:
+            while True:
+                try:
+                    conn = listener.accept()
+                except (OSError, EOFError, multiprocessing.AuthenticationError) as e:
+                    print(f"Отклонено подключение к сервису сессий: {e}")
+                    continue
+                threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
 
+    def _serve(self, conn):
+        with conn:
+            while True:
+                try:
+                    method, args = conn.recv()
+                except (EOFError, OSError):
+                    return
+                if method not in self.METHODS:
+                    result = (False, f"Unknown method {method}")
+                else:
+                    try:
+                        result = (True, getattr(self.registry, method)(*args))
+                    except Exception as e:
+                        result = (False, str(e))
+                try:
+                    conn.send(result)
+                except OSError:
+                    return
 
-def _create_security_wrapper(safe_mode, project_path):
-    """Create Python code wrapper that enforces security restrictions"""
-    # Escape values for safe insertion into Python code
-    safe_mode_str = safe_mode.replace("'", "\\'").replace('"', '\\"')
-    project_path_str = (project_path or '').replace("'", "\\'").replace('\\', '\\\\').replace('"', '\\"')
-    
-    # Get engine directories (where the application runs)
-    engine_root = os.path.abspath(os.getcwd())
-    projects_folder = os.path.abspath(PROJECTS_FOLDER)
-    compiled_folder = os.path.abspath(os.path.join(engine_root, 'compiled'))
-    source_folder = os.path.abspath(os.path.join(engine_root, 'source'))
-    
-    # Escape engine paths
-    engine_root_str = engine_root.replace("'", "\\'").replace('\\', '\\\\').replace('"', '\\"')
-    projects_folder_str = projects_folder.replace("'", "\\'").replace('\\', '\\\\').replace('"', '\\"')
-    compiled_folder_str = compiled_folder.replace("'", "\\'").replace('\\', '\\\\').replace('"', '\\"')
-    source_folder_str = source_folder.replace("'", "\\'").replace('\\', '\\\\').replace('"', '\\"')
-    
-    wrapper = """
-import os
-import sys
-import shutil
-from pathlib import Path
-
-# Security mode: {safe_mode}
-# Project path: {project_path}
-
-# Store security settings as module-level variables
-_safe_mode = '{safe_mode_str}'
-_project_path = r'{project_path_str}'
-_engine_root = r'{engine_root_str}'
-_projects_folder = r'{projects_folder_str}'
-_compiled_folder = r'{compiled_folder_str}'
-_source_folder = r'{source_folder_str}'
-
-_original_open = open
-_original_makedirs = os.makedirs
-_original_remove = os.remove
-_original_unlink = os.unlink
-_original_rmdir = os.rmdir
-_original_rmtree = shutil.rmtree
-_original_copy = shutil.copy
-_original_copy2 = shutil.copy2
-_original_move = shutil.move
-_original_rename = os.rename
-
-def _is_project_path(filepath):
-    '''Check if filepath is within project directory'''
-    if not _project_path or not _project_path.strip():
-        return False
-    try:
-        abs_file = os.path.abspath(filepath)
-        abs_project = os.path.abspath(_project_path)
-        return abs_file.startswith(abs_project)
-    except:
-        return False
 
-def _is_engine_path(filepath):
-    '''Check if filepath is within engine directories'''
-    try:
-        abs_file = os.path.abspath(filepath)
-        abs_engine = os.path.abspath(_engine_root)
-        abs_projects = os.path.abspath(_projects_folder)
-        abs_compiled = os.path.abspath(_compiled_folder)
-        abs_source = os.path.abspath(_source_folder)
-        
-        # Normalize paths for comparison
-        abs_file_norm = os.path.normpath(abs_file)
-        abs_engine_norm = os.path.normpath(abs_engine)
-        abs_projects_norm = os.path.normpath(abs_projects)
-        abs_compiled_norm = os.path.normpath(abs_compiled)
-        abs_source_norm = os.path.normpath(abs_source)
-        
-        # Check if file is in specific engine folders
-        if abs_file_norm.startswith(abs_projects_norm) or abs_file_norm.startswith(abs_compiled_norm) or abs_file_norm.startswith(abs_source_norm):
-            return True
-        
-        # Check if it's directly in the root engine directory (where main.py is)
-        file_dir = os.path.dirname(abs_file_norm)
-        if file_dir == abs_engine_norm:
-            return True
-        
-        # Check for common engine files in root
-        engine_files = ['main.py', 'requirements.txt', 'README.md', 'config.py', 'settings.py']
-        file_name = os.path.basename(abs_file_norm)
-        if file_name in engine_files and file_dir == abs_engine_norm:
-            return True
-            
-        return False
-    except:
-        return False
+SUPERVISOR_KEY_MIN_LENGTH = 16
 
-def _check_file_access(filepath, operation):
-    '''Check if file operation is allowed based on security mode'''
-    if _safe_mode == 'full':
-        return True  # Full freedom
-    
-    is_project = _is_project_path(filepath)
-    is_engine = _is_engine_path(filepath)
-    
-    if _safe_mode == 'restricted':
-        # Full ban - no file operations
-        raise PermissionError(f"Безопасный режим: операция {{operation}} запрещена для пути {{filepath}}")
-    
-    if _safe_mode == 'limited':
-        # Limited - allow only non-project and non-engine files
-        if is_project:
-            raise PermissionError(f"Безопасный режим: операция {{operation}} запрещена для файлов проекта. Путь: {{filepath}}")
-        if is_engine:
-            raise PermissionError(f"Безопасный режим: операция {{operation}} запрещена для папок движка. Путь: {{filepath}}")
-        return True
-    
-    return True
-
-# Override file operations
-def _secure_open(file, mode='r', *args, **kwargs):
-    if 'w' in mode or 'a' in mode or 'x' in mode:
-        _check_file_access(file, 'open')
-    return _original_open(file, mode, *args, **kwargs)
-
-def _secure_makedirs(name, *args, **kwargs):
-    _check_file_access(name, 'makedirs')
-    return _original_makedirs(name, *args, **kwargs)
-
-def _secure_remove(path):
-    _check_file_access(path, 'remove')
-    return _original_remove(path)
-
-def _secure_unlink(path):
-    _check_file_access(path, 'unlink')
-    return _original_unlink(path)
-
-def _secure_rmdir(path):
-    _check_file_access(path, 'rmdir')
-    return _original_rmdir(path)
-
-def _secure_rmtree(path, *args, **kwargs):
-    _check_file_access(path, 'rmtree')
-    return _original_rmtree(path, *args, **kwargs)
-
-def _secure_copy(src, dst, *args, **kwargs):
-    _check_file_access(src, 'copy')
-    _check_file_access(dst, 'copy')
-    return _original_copy(src, dst, *args, **kwargs)
-
-def _secure_copy2(src, dst, *args, **kwargs):
-    _check_file_access(src, 'copy2')
-    _check_file_access(dst, 'copy2')
-    return _original_copy2(src, dst, *args, **kwargs)
-
-def _secure_move(src, dst):
-    _check_file_access(src, 'move')
-    _check_file_access(dst, 'move')
-    return _original_move(src, dst)
-
-def _secure_rename(src, dst):
-    _check_file_access(src, 'rename')
-    _check_file_access(dst, 'rename')
-    return _original_rename(src, dst)
-
-# Replace built-in functions
-open = _secure_open
-os.makedirs = _secure_makedirs
-os.remove = _secure_remove
-os.unlink = _secure_unlink
-os.rmdir = _secure_rmdir
-os.rename = _secure_rename
-shutil.rmtree = _secure_rmtree
-shutil.copy = _secure_copy
-shutil.copy2 = _secure_copy2
-shutil.move = _secure_move
-""".format(safe_mode=safe_mode_str, project_path=project_path_str, safe_mode_str=safe_mode_str, project_path_str=project_path_str, engine_root_str=engine_root_str, projects_folder_str=projects_folder_str, compiled_folder_str=compiled_folder_str, source_folder_str=source_folder_str)
-    return wrapper
+
+def _supervisor_authkey():
+    # multiprocessing.connection распаковывает pickle, поэтому без ключа подключаться нельзя
+    key = config['session_supervisor_key']
+    if not key and config['session_supervisor_key_file']:
+        try:
+            with open(config['session_supervisor_key_file'], 'r', encoding='utf-8') as f:
+                key = f.read().strip()
+        except OSError as e:
+            raise RuntimeError(f"Не удалось прочитать ключ сервиса сессий: {e}") from e
+    if len(key) < SUPERVISOR_KEY_MIN_LENGTH:
+        raise RuntimeError(
+            f"Для сервиса сессий нужен session_supervisor_key не короче {SUPERVISOR_KEY_MIN_LENGTH} символов "
+            "(turtcd_config.json, TURTCD_SESSION_SUPERVISOR_KEY или файл session_supervisor_key_file), "
+            "одинаковый у сервиса и процессов сервера")
+    return key.encode('utf-8')
+
+
+def create_session_registry():
+    if config['session_supervisor']:
+        return SupervisorSessionRegistry(config['session_supervisor'], _supervisor_authkey())
+    return LocalSessionRegistry()
+
+
+session_registry = create_session_registry()
+
+
+@app.errorhandler(SessionServiceError)
+def session_service_error(e):
+    return jsonify({"status": "error", "message": str(e)}), 503
 
 
 @app.route('/api/project/start', methods=['POST'])
@@ -781,139 +3675,100 @@ def start_project():
     data = request.get_json()
     code = data.get("code", "")
     safe_mode = data.get("safeMode", "restricted")  # full, limited, restricted
-    session_id = str(uuid.uuid4())
-    try:
-        # Get current project path if available
-        current_project = data.get("projectName") or request.cookies.get('currentProject') or ''
-        project_path = ''
-        if current_project:
-            project_file = os.path.join(PROJECTS_FOLDER, current_project)
-            if os.path.exists(project_file):
-                try:
-                    with open(project_file, 'r', encoding='utf-8') as pf:
-                        project_data = json.load(pf)
-                        project_path = project_data.get('projectPath', '')
-                except:
-                    pass
-        
-        # Create security wrapper based on safe mode
-        security_wrapper = _create_security_wrapper(safe_mode, project_path)
-        
-        with tempfile.NamedTemporaryFile(mode="w", suffix=".py", delete=False, encoding="utf-8") as f:
-            f.write("# -*- coding: utf-8 -*-\n")
-            f.write(security_wrapper)
-            f.write("\n# User code starts here\n")
-            f.write(code)
-            fname = f.name
-        
-        # Определяем команду Python для Windows
-        python_cmd = None
-        for cmd in ["python", "py", "python3"]:
-            try:
-                subprocess.run([cmd, "--version"], capture_output=True, check=True)
-                python_cmd = cmd
-                break
-            except (subprocess.CalledProcessError, FileNotFoundError):
-                continue
-        
-        if not python_cmd:
-            return jsonify({"status": "error", "message": "Python не найден в системе. Установите Python с https://python.org"})
-        
-        proc = subprocess.Popen(
-            [python_cmd, fname],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=0  # без буфера
-        )
-        q = queue.Queue()
-
-        def reader_thread(p, q):
+    # Get current project path if available
+    # Имя проекта приходит от клиента: некорректное имя просто игнорируется
+    current_project = project_storage.clean_filename(data.get("projectName") or request.cookies.get('currentProject'))
+    project_path = ''
+    if current_project:
+        if project_storage.exists(current_project):
             try:
-                while True:
-                    try:
-                        ch = p.stdout.read(1)
-                        if not ch:
-                            break
-                        q.put(ch)
-                    except (OSError, ValueError, UnicodeDecodeError) as e:
-                        # Handle encoding errors, broken pipes, etc.
-                        q.put(f"\n[Ошибка чтения вывода: {str(e)}]\n")
-                        break
-                    except Exception as e:
-                        # Catch any other unexpected errors
-                        q.put(f"\n[Неожиданная ошибка: {str(e)}]\n")
-                        break
-            except Exception as e:
-                # Final safety net
-                try:
-                    q.put(f"\n[Критическая ошибка потока: {str(e)}]\n")
-                except:
-                    pass
-            finally:
-                try:
-                    q.put("__EXIT__")
-                except:
-                    pass
-
-        t = threading.Thread(target=reader_thread, args=(proc, q), daemon=True)
-        t.start()
-        sessions[session_id] = {"process": proc, "queue": q}
-        return jsonify({"status": "success", "session_id": session_id})
-    except Exception as e:
-        return jsonify({"status": "error", "message": str(e)})
+                project_data = project_storage.read(current_project)
+                if isinstance(project_data, dict):
+                    project_path = project_data.get('projectPath', '')
+            except (OSError, ValueError):
+                pass
+    return jsonify(session_registry.start(code, safe_mode, project_path))
 
 
 @app.route('/api/project/read/<session_id>')
 def read_project(session_id):
     try:
-        sess = sessions.get(session_id)
-        if not sess:
-            return jsonify({"status": "error", "message": "Session not found"})
-        q = sess["queue"]
-        output = []
-        try:
-            while not q.empty():
-                try:
-                    output.append(q.get(timeout=0.1))
-                except queue.Empty:
-                    break
-                except Exception as e:
-                    # Handle any errors while reading from queue
-                    output.append(f"\n[Ошибка чтения очереди: {str(e)}]\n")
-                    break
-        except Exception as e:
-            # Handle errors in queue operations
-            return jsonify({"status": "error", "message": f"Ошибка чтения: {str(e)}"})
-        return jsonify({"status": "success", "output": "".join(output)})
+        return jsonify(session_registry.read(session_id, request.args.get('since', type=int)))
+    except SessionServiceError:
+        raise
     except Exception as e:
         # Final safety net - server should never crash
         return jsonify({"status": "error", "message": f"Внутренняя ошибка: {str(e)}"})
 
 
+SESSION_STREAM_HEARTBEAT = 15.0  # seconds between SSE keep-alive comments
+
+
+def _sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+@app.route('/api/project/stream/<session_id>')
+def stream_project(session_id):
+    """Server-Sent Events stream of a run session's output.
+
+    Starts at `?since=` (or the Last-Event-ID sent by a reconnecting
+    EventSource) and sends `output` events as soon as new text is buffered,
+    then a final `exit` event with the process return code. The event id is
+    the offset to resume from.
+    """
+    since = request.args.get('since', type=int)
+    if since is None:
+        since = request.headers.get('Last-Event-ID', 0, type=int)
+    if session_registry.wait(session_id, since, 0) is None:
+        return jsonify({"status": "error", "message": "Session not found"}), 404
+
+    def generate(since):
+        last_sent = time.monotonic()
+        while True:
+            ready = session_registry.wait(session_id, since, 1.0)
+            if ready is None:
+                return
+            if not ready:
+                if time.monotonic() - last_sent >= SESSION_STREAM_HEARTBEAT:
+                    last_sent = time.monotonic()
+                    yield ": keep-alive\n\n"
+                continue
+            result = session_registry.read(session_id, since)
+            if result["status"] != "success":
+                return
+            since = result["next"]
+            if result["output"] or result["dropped"]:
+                payload = {k: result[k] for k in ("output", "next", "dropped")}
+                yield f"id: {since}\n" + _sse_event("output", payload)
+                last_sent = time.monotonic()
+            if result["exited"]:
+                returncode = session_registry.exit_code(session_id)
+                yield _sse_event("exit", {"returncode": returncode, "next": since})
+                return
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(generate(since), mimetype='text/event-stream', headers=headers)
+
+
 @app.route('/api/project/write/<session_id>', methods=['POST'])
 def write_project(session_id):
+    """Queue input for the program: {"text": "line"} or a batch {"lines": [...]}.
+
+    Returns right away with the number of bytes still waiting for the
+    program to read them (`queued`). A batch that does not fit into
+    session_input_limit is refused as a whole, so the client can retry.
+    """
     try:
-        sess = sessions.get(session_id)
-        if not sess:
-            return jsonify({"status": "error", "message": "Session not found"})
-        data = request.get_json()
-        text = data.get("text", "") + "\n"
-        try:
-            proc = sess["process"]
-            if proc.poll() is None:
-                try:
-                    proc.stdin.write(text)
-                    proc.stdin.flush()
-                    return jsonify({"status": "success"})
-                except (BrokenPipeError, OSError, ValueError) as e:
-                    # Handle broken pipes, closed streams, etc.
-                    return jsonify({"status": "error", "message": f"Ошибка записи: {str(e)}"})
-            else:
-                return jsonify({"status": "error", "message": "Process finished"})
-        except Exception as e:
-            return jsonify({"status": "error", "message": f"Ошибка процесса: {str(e)}"})
+        data = request.get_json() or {}
+        lines = data.get("lines")
+        if lines is None:
+            lines = [data.get("text", "")]
+        elif not isinstance(lines, list):
+            return jsonify({"status": "error", "message": "lines must be a list"})
+        return jsonify(session_registry.write(session_id, [str(line) for line in lines]))
+    except SessionServiceError:
+        raise
     except Exception as e:
         # Final safety net
         return jsonify({"status": "error", "message": f"Внутренняя ошибка: {str(e)}"})
@@ -921,13 +3776,7 @@ def write_project(session_id):
 
 @app.route('/api/project/stop/<session_id>', methods=['POST'])
 def stop_project(session_id):
-    sess = sessions.pop(session_id, None)
-    if sess:
-        proc = sess["process"]
-        if proc.poll() is None:
-            proc.kill()
-        return jsonify({"status": "success"})
-    return jsonify({"status": "error", "message": "Session not found"})
+    return jsonify(session_registry.stop(session_id))
 
 
 @app.route('/api/project/update', methods=['POST'])
@@ -944,35 +3793,30 @@ def update_project():
         
         if not filename:
             return jsonify({"status": "error", "message": "Filename is required"})
+        filename = project_storage.clean_filename(filename)
+        if not filename or (new_name and not project_storage.clean_filename(new_name)):
+            return jsonify({"status": "error", "message": "Invalid filename"}), 400
         
-        filepath = os.path.join(PROJECTS_FOLDER, filename)
-        if not os.path.exists(filepath):
+        if not project_storage.exists(filename):
             return jsonify({"status": "error", "message": "Project file not found"})
         
         # Загружаем существующие данные проекта
-        with open(filepath, 'r', encoding='utf-8') as f:
-            project_data = json.load(f)
+        project_data, _ = project_documents.read(filename)
         
         print(f"Loaded project_data: {project_data}")  # Отладочная информация
         
         # Если нужно переименовать файл
         if new_name and new_name != filename:
-            new_filepath = os.path.join(PROJECTS_FOLDER, new_name)
-            if os.path.exists(new_filepath):
+            # Файл переносится под новое имя целиком, без перезаписи содержимого
+            project_documents.detach(filename)
+            if not project_storage.rename(filename, new_name):
                 return jsonify({"status": "error", "message": "Project with this name already exists"})
-            
-            # Сохраняем обновленные данные в новый файл
-            with open(new_filepath, 'w', encoding='utf-8') as f:
-                json.dump(project_data, f, ensure_ascii=False, indent=2)
-            
-            # Удаляем старый файл
-            os.remove(filepath)
+            project_index.rename(filename, new_name)
             
             return jsonify({"status": "success", "message": "Project updated and renamed", "filename": new_name})
         else:
             # Просто обновляем существующий файл
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(project_data, f, ensure_ascii=False, indent=2)
+            project_documents.save(filename, project_data)
             
             return jsonify({"status": "success", "message": "Project updated"})
             
@@ -992,30 +3836,30 @@ def duplicate_project():
             return jsonify({"status": "error", "message": "Source and target filenames are required"})
         
         # Добавляем расширение .turtcd если его нет
-        if not target_filename.endswith('.turtcd'):
-            target_filename += '.turtcd'
-        
-        source_filepath = os.path.join(PROJECTS_FOLDER, source_filename)
-        target_filepath = os.path.join(PROJECTS_FOLDER, target_filename)
+        source_filename = project_storage.clean_filename(source_filename)
+        target_filename = project_storage.clean_filename(target_filename, add_suffix=True)
+        if not source_filename or not target_filename:
+            return jsonify({"status": "error", "message": "Invalid filename"}), 400
         
-        if not os.path.exists(source_filepath):
+        if not project_storage.exists(source_filename):
             return jsonify({"status": "error", "message": "Source project not found"})
         
-        if os.path.exists(target_filepath):
+        if project_storage.exists(target_filename):
             return jsonify({"status": "error", "message": "Project with this name already exists"})
         
-        # Загружаем исходный проект
-        with open(source_filepath, 'r', encoding='utf-8') as f:
-            project_data = json.load(f)
+        # Загружаем исходный проект (копия: данные в кэше не меняем)
+        project_data = dict(project_documents.read(source_filename)[0])
         
         # Обновляем метаданные для копии
         project_data['createdAt'] = datetime.now().isoformat()
         if 'description' in project_data:
             project_data['description'] = project_data['description'] + ' (копия)'
         
-        # Сохраняем копию
-        with open(target_filepath, 'w', encoding='utf-8') as f:
-            json.dump(project_data, f, ensure_ascii=False, indent=2)
+        # Сохраняем копию; create не перезапишет проект, появившийся после проверки выше
+        if not project_storage.create(target_filename, project_data):
+            return jsonify({"status": "error", "message": "Project with this name already exists"})
+        source_entry = project_index.get(source_filename)
+        project_index.update(target_filename, project_data, template=source_entry and source_entry['template'])
         
         return jsonify({"status": "success", "message": "Project duplicated successfully", "filename": target_filename})
         
@@ -1025,71 +3869,277 @@ def duplicate_project():
 
 
 # ===================== Code Generator =====================
+def _block_prefix(indents, indent, block):
+    while len(indents) <= indent:
+        indents.append(indents[-1] + "    ")
+    if block.get('ignored', False):
+        # Комментируем строки игнорированного блока
+        return indents[indent] + "# "
+    return indents[indent]
+
+
+def _render_block_lines(entry, block, prefix):
+    code = render_block_template(entry["template"], block.get('fields', {}))
+    if not code.strip():
+        return []
+    # Разбиваем код на строки и применяем отступ к каждой строке, пропуская пустые
+    return [prefix + line for line in code.rstrip().split('\n') if line.strip()]
+
+
 def generate_python_code(project):
     if not project or 'blocks' not in project:
         return "# Нет блоков в проекте"
 
     blocks = {b['id']: b for b in project['blocks']}
-    connections = project.get('connections', [])
-    outgoing = {}
-    for conn in connections:
-        outgoing.setdefault(conn['from'], []).append(conn)
+    # (from, fromConnector) -> to; как и раньше, учитывается первое соединение
+    links = {}
+    for conn in project.get('connections', []):
+        links.setdefault((conn['from'], conn['fromConnector']), conn['to'])
 
     visited, code_lines = set(), []
+    indents = [""]  # строка отступа для каждой глубины, строится один раз
+
+    start = next((b for b in blocks.values() if b['type'] == 'header'), None)
+    if not start:
+        return ""
 
-    def compile_block(block_id, indent=0):
+    # Явный стек вместо рекурсии: длинные цепочки не упираются в лимит рекурсии
+    stack = [(start['id'], 0)]
+    while stack:
+        block_id, indent = stack.pop()
         if block_id in visited:
-            return
+            continue
         visited.add(block_id)
         block = blocks.get(block_id)
         if not block:
-            return
-        block_cfg = find_block_config(block.get('template'))
-        if not block_cfg:
-            return
-        
-        is_ignored = block.get('ignored', False)
-        
-        code = block_cfg.get('code', '')
-        for n, v in block.get('fields', {}).items():
-            code = code.replace(f"{{{n}}}", str(v or ""))
-        if code.strip():
-            # Разбиваем код на строки и применяем отступ к каждой строке
-            lines = code.rstrip().split('\n')
-            for line in lines:
-                if line.strip():  # Добавляем только непустые строки
-                    if is_ignored:
-                        # Комментируем строки игнорированного блока
-                        code_lines.append("    " * indent + "# " + line)
-                    else:
-                        code_lines.append("    " * indent + line)
-        if block_cfg['type'] in ['condition', 'loop']:
-            body = next((c for c in outgoing.get(block_id, []) if c['fromConnector'] == 'right'), None)
-            if body:
-                # Если блок игнорирован, все блоки на правом коннекторе также будут игнорированы
-                # и автоматически закомментированы внутри compile_block
-                compile_block(body['to'], indent + 1)
-            nxt = next((c for c in outgoing.get(block_id, []) if c['fromConnector'] == 'bottom'), None)
-            if nxt:
-                compile_block(nxt['to'], indent)
-        else:
-            nxt = next((c for c in outgoing.get(block_id, []) if c['fromConnector'] == 'bottom'), None)
-            if nxt:
-                compile_block(nxt['to'], indent)
+            continue
+        entry = block_registry.get_entry(block.get('template'))
+        if not entry:
+            continue
+        block_cfg = entry["config"]
 
-    start = next((b for b in blocks.values() if b['type'] == 'header'), None)
-    if start:
-        compile_block(start['id'], 0)
+        code_lines.extend(_render_block_lines(entry, block, _block_prefix(indents, indent, block)))
+
+        # Нижний коннектор кладём первым, чтобы тело (правый) обработалось раньше
+        nxt = links.get((block_id, 'bottom'))
+        if nxt is not None:
+            stack.append((nxt, indent))
+        if block_cfg['type'] in ['condition', 'loop']:
+            body = links.get((block_id, 'right'))
+            if body is not None:
+                stack.append((body, indent + 1))
     return "\n".join(code_lines)
 
 
 def find_block_config(template_id):
-    cfg = load_blocks_config()
-    for cat in cfg.get('categories', []):
-        for blk in cat.get('blocks', []):
-            if blk.get('id') == template_id:
-                return blk
-    return None
+    return block_registry.get_block(template_id)
+
+
+# ===================== Incremental Compiler =====================
+INCREMENTAL_COMPILE_MAX_PROJECTS = 32  # project states kept in memory, LRU
+
+
+def _content_hash(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def _block_content_hash(block):
+    return _content_hash(json.dumps(
+        [block.get('template'), block.get('fields', {}), bool(block.get('ignored', False))],
+        ensure_ascii=False, sort_keys=True, default=str
+    ))
+
+
+def _connection_key(conn):
+    return (conn['from'], conn['fromConnector'], conn['to'], conn.get('toConnector'))
+
+
+class ProjectCompileState:
+    """Server-side copy of a project with cached code fragments.
+
+    Every emitted block gets a subtree hash over its own content (template,
+    fields, ignored flag) and the hashes of the blocks reached through its
+    right and bottom connectors. Code is cached per chain (the top-level
+    chain and each condition/loop body) under (subtree hash, indent, config
+    generation) and per block under (content hash, indent, generation), so a
+    recompile only renders blocks that changed and re-joins the chains that
+    contain them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.blocks = {}
+        self.block_hashes = {}
+        self.connections = {}  # _connection_key -> connection, in insertion order
+        self.pieces = {}
+        self.fragments = {}
+        self.revision = 0
+
+    def load(self, project):
+        self.blocks = {b['id']: b for b in project.get('blocks', [])}
+        self.block_hashes = {block_id: _block_content_hash(b) for block_id, b in self.blocks.items()}
+        self.connections = {_connection_key(c): c for c in project.get('connections', [])}
+        self.revision += 1
+
+    def apply_diff(self, diff):
+        for block_id in diff.get('removeBlocks', []):
+            self.blocks.pop(block_id, None)
+            self.block_hashes.pop(block_id, None)
+        for block in diff.get('upsertBlocks', []):
+            self.blocks[block['id']] = block
+            self.block_hashes[block['id']] = _block_content_hash(block)
+        for conn in diff.get('removeConnections', []):
+            self.connections.pop(_connection_key(conn), None)
+        for conn in diff.get('addConnections', []):
+            self.connections[_connection_key(conn)] = conn
+        self.revision += 1
+
+    def _emission_tree(self):
+        """Walk blocks in generate_python_code order.
+
+        Returns nodes [block_id, indent, entry, body_node, next_node] in
+        pre-order, so every descendant has a larger index than its ancestor.
+        """
+        blocks = self.blocks
+        links = {}
+        for conn in self.connections.values():
+            links.setdefault((conn['from'], conn['fromConnector']), conn['to'])
+
+        start = next((b for b in blocks.values() if b['type'] == 'header'), None)
+        if not start:
+            return [], set()
+
+        nodes, heads, visited = [], {0}, set()
+        stack = [(start['id'], 0, None, None)]
+        while stack:
+            block_id, indent, parent, slot = stack.pop()
+            if block_id in visited:
+                continue
+            visited.add(block_id)
+            block = blocks.get(block_id)
+            if not block:
+                continue
+            entry = block_registry.get_entry(block.get('template'))
+            if not entry:
+                continue
+            node = len(nodes)
+            nodes.append([block_id, indent, entry, None, None])
+            if parent is not None:
+                nodes[parent][slot] = node
+                if slot == 3:
+                    heads.add(node)
+
+            nxt = links.get((block_id, 'bottom'))
+            if nxt is not None:
+                stack.append((nxt, indent, node, 4))
+            if entry["config"]['type'] in ['condition', 'loop']:
+                body = links.get((block_id, 'right'))
+                if body is not None:
+                    stack.append((body, indent + 1, node, 3))
+        return nodes, heads
+
+    def compile(self):
+        generation = block_registry.generation
+        nodes, heads = self._emission_tree()
+
+        subtree_hashes = [None] * len(nodes)
+        for i in range(len(nodes) - 1, -1, -1):
+            block_id, _, _, body, nxt = nodes[i]
+            subtree_hashes[i] = _content_hash(
+                self.block_hashes[block_id],
+                subtree_hashes[body] if body is not None else '',
+                subtree_hashes[nxt] if nxt is not None else ''
+            )
+
+        indents = [""]
+        pieces, fragments, chain_texts = {}, {}, {}
+        rebuilt_blocks, rebuilt_fragments, reused_fragments = [], 0, 0
+        # Цепочки тел обрабатываются раньше внешних: у потомков индексы больше
+        for i in range(len(nodes) - 1, -1, -1):
+            if i not in heads:
+                continue
+            key = (subtree_hashes[i], nodes[i][1], generation)
+            text = self.fragments.get(key)
+            if text is None:
+                parts = []
+                j = i
+                while j is not None:
+                    block_id, indent, entry, body, nxt = nodes[j]
+                    piece_key = (self.block_hashes[block_id], indent, generation)
+                    piece = self.pieces.get(piece_key)
+                    if piece is None:
+                        block = self.blocks[block_id]
+                        piece = "\n".join(_render_block_lines(entry, block, _block_prefix(indents, indent, block)))
+                        self.pieces[piece_key] = piece
+                        rebuilt_blocks.append(block_id)
+                    if piece:
+                        parts.append(piece)
+                    if body is not None and chain_texts[body]:
+                        parts.append(chain_texts[body])
+                    j = nxt
+                text = "\n".join(parts)
+                rebuilt_fragments += 1
+            else:
+                reused_fragments += 1
+            fragments[key] = text
+            chain_texts[i] = text
+
+        # Оставляем в кэше только то, что относится к текущему состоянию проекта
+        for block_id, indent, _, _, _ in nodes:
+            piece_key = (self.block_hashes[block_id], indent, generation)
+            if piece_key in self.pieces:
+                pieces[piece_key] = self.pieces[piece_key]
+        self.pieces = pieces
+        self.fragments = fragments
+
+        return chain_texts.get(0, ""), {
+            "rebuiltBlocks": rebuilt_blocks,
+            "rebuiltFragments": rebuilt_fragments,
+            "reusedFragments": reused_fragments
+        }
+
+
+compile_states = OrderedDict()  # project_id -> ProjectCompileState
+compile_states_lock = threading.Lock()
+
+
+def get_compile_state(project_id, create=False):
+    with compile_states_lock:
+        state = compile_states.get(project_id)
+        if state is None and create:
+            state = ProjectCompileState()
+            compile_states[project_id] = state
+            while len(compile_states) > INCREMENTAL_COMPILE_MAX_PROJECTS:
+                compile_states.popitem(last=False)
+        if state is not None:
+            compile_states.move_to_end(project_id)
+        return state
+
+
+def compile_project_incremental(project_id, project_data=None, diff=None, revision=None):
+    if project_data is not None:
+        if not project_data or 'blocks' not in project_data:
+            return {"status": "success", "code": generate_python_code(project_data)}
+        state = get_compile_state(project_id, create=True)
+        with state.lock:
+            state.load(project_data)
+            code, stats = state.compile()
+            return {"status": "success", "code": code, "revision": state.revision, **stats}
+
+    state = get_compile_state(project_id)
+    if state is None:
+        return {"status": "error", "resync": True, "message": "Состояние проекта не найдено, отправьте project_data"}
+    with state.lock:
+        if revision is not None and revision != state.revision:
+            return {"status": "error", "resync": True, "revision": state.revision,
+                    "message": "Ревизия проекта устарела, отправьте project_data"}
+        state.apply_diff(diff or {})
+        code, stats = state.compile()
+        return {"status": "success", "code": code, "revision": state.revision, **stats}
 
 
 @app.route('/static/<path:path>')
@@ -1141,14 +4191,345 @@ def sound_volume():
             return jsonify({"status": "error", "message": str(e)})
 
 
-if __name__ == '__main__':
+# ===================== ASGI =====================
+_ASGI_STREAM_RE = re.compile(r'^/api/project/stream/([^/]+)$')
+
+
+def prepare_server():
+    """One-time startup shared by the development server and asgi_app."""
     os.makedirs('static', exist_ok=True)
-    load_blocks_config()
-    
-    # Get configuration values
+    blocks_watcher.snapshot()
+    block_registry.rebuild()
+    blocks_watcher.start()
+    project_storage.remove_stale_temp()
+    project_storage.remove_stale_locks()
+    session_registry.prepare()
+
+
+_asgi_executor = None
+
+
+def _get_asgi_executor():
+    # Пул потоков для Flask-обработчиков, размер задаётся server.threads
+    global _asgi_executor
+    if _asgi_executor is None:
+        _asgi_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, config['server']['threads']), thread_name_prefix='turtcd-http')
+    return _asgi_executor
+
+
+def _parse_offset(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+_wsgi_to_asgi = WsgiToAsgi(app.wsgi_app) if WsgiToAsgi is not None else None
+_asgi_handlers = None
+_asgi_abandoned = set()  # обработчики, не успевшие ответить за server.timeout
+
+
+async def _asgi_wsgi(scope, receive, send):
+    """Serve a request with the Flask app through asgiref's WsgiToAsgi.
+
+    Each request gets its own handler thread, at most server.threads at a
+    time. A request that has not started its answer within server.timeout
+    seconds gets 504; its thread cannot be stopped and finishes unseen.
+    """
+    global _asgi_handlers
+    if _wsgi_to_asgi is None:
+        raise RuntimeError("Для режима asgi нужен asgiref: pip install asgiref")
+    if _asgi_handlers is None:
+        _asgi_handlers = asyncio.Semaphore(max(1, config['server']['threads']))
+    started = asyncio.Event()
+    timed_out = False
+
+    async def send_answer(message):
+        if timed_out:
+            return
+        started.set()
+        await send(message)
+
+    async def handle():
+        async with _asgi_handlers:
+            # Без отдельного контекста asgiref выполняет все запросы в одном потоке
+            async with ThreadSensitiveContext():
+                await _wsgi_to_asgi(scope, receive, send_answer)
+
+    handler = asyncio.ensure_future(handle())
+    timeout = config['server']['timeout'] or None
+    waiter = asyncio.ensure_future(started.wait())
+    try:
+        await asyncio.wait((handler, waiter), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        waiter.cancel()
+    if not started.is_set() and not handler.done():
+        timed_out = True
+        _asgi_abandoned.add(handler)
+        handler.add_done_callback(_asgi_abandoned.discard)
+        # Поток обработчика остановить нельзя, но соединение освобождаем
+        await _asgi_json(send, 504, {"status": "error", "message": f"Сервер не ответил за {timeout} с"})
+        return
+    # Ответ начат: дальше тело передаётся без ограничения по времени (compile-exe)
+    await handler
+
+
+async def _asgi_json(send, status, payload):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", b"application/json")]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _wait_output(session_id, since, timeout):
+    """Async registry.wait(): local sessions are awaited on the loop itself."""
+    loop = asyncio.get_running_loop()
+    if not session_registry.local:
+        return await loop.run_in_executor(_get_asgi_executor(), session_registry.wait, session_id, since, timeout)
+    sess = sessions.get(session_id)
+    if not sess:
+        return None
+    _touch_session(sess)
+    output = sess["output"]
+    changed = asyncio.Event()
+
+    def listener():
+        loop.call_soon_threadsafe(changed.set)
+
+    output.subscribe(listener)
+    try:
+        if output.end > since or output.closed:
+            return True
+        await asyncio.wait_for(changed.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        output.unsubscribe(listener)
+
+
+async def _registry_call(method, *args):
+    # Обращение к другому процессу не должно блокировать цикл событий
+    if session_registry.local:
+        return getattr(session_registry, method)(*args)
+    return await asyncio.get_running_loop().run_in_executor(_get_asgi_executor(), getattr(session_registry, method), *args)
+
+
+async def _exit_code(session_id, timeout=5):
+    # Без блокирующего wait: returncode у AsyncSessionBackend выставляет этот же цикл событий
+    deadline = time.monotonic() + timeout
+    while True:
+        returncode = await _registry_call("exit_code", session_id, 0)
+        if returncode is not None or time.monotonic() >= deadline:
+            return returncode
+        await asyncio.sleep(0.05)
+
+
+async def _asgi_stream(scope, receive, send, session_id):
+    """Coroutine version of stream_project: no thread is held while a client watches."""
+    query = urllib.parse.parse_qs(scope.get("query_string", b"").decode('latin-1'))
+    since = _parse_offset((query.get("since") or [None])[0])
+    if since is None:
+        since = _parse_offset(dict(scope.get("headers", [])).get(b"last-event-id")) or 0
+    if await _wait_output(session_id, since, 0) is None:
+        await _asgi_json(send, 404, {"status": "error", "message": "Session not found"})
+        return
+
+    loop = asyncio.get_running_loop()
+
+    async def watch_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    async def emit(text):
+        await send({"type": "http.response.body", "body": text.encode('utf-8'), "more_body": True})
+
+    await send({"type": "http.response.start", "status": 200, "headers": [
+        (b"content-type", b"text/event-stream; charset=utf-8"),
+        (b"cache-control", b"no-cache"),
+        (b"x-accel-buffering", b"no")
+    ]})
+    disconnected = loop.create_task(watch_disconnect())
+    try:
+        while True:
+            result = await _registry_call("read", session_id, since)
+            if result["status"] != "success":
+                break
+            since = result["next"]
+            if result["output"] or result["dropped"]:
+                payload = {k: result[k] for k in ("output", "next", "dropped")}
+                await emit(f"id: {since}\n" + _sse_event("output", payload))
+            if result["exited"]:
+                returncode = await _exit_code(session_id)
+                await emit(_sse_event("exit", {"returncode": returncode, "next": since}))
+                break
+            waiter = loop.create_task(_wait_output(session_id, since, SESSION_STREAM_HEARTBEAT))
+            await asyncio.wait({waiter, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                waiter.cancel()
+                break
+            if waiter.result() is None:
+                break
+            if not waiter.result():
+                await emit(": keep-alive\n\n")
+    finally:
+        disconnected.cancel()
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def asgi_app(scope, receive, send):
+    """ASGI entry point, e.g. `uvicorn main:asgi_app`.
+
+    Session output streams are served by coroutines on the server's event
+    loop, which with "session_backend": "async" also owns the pipes of all
+    running programs; write and stop reach that loop through the Flask
+    handlers. Every other request goes to the Flask app in a worker thread.
+    """
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                prepare_server()
+                async_backend.attach(asyncio.get_running_loop())
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+    match = _ASGI_STREAM_RE.match(scope["path"])
+    if match and scope["method"] == "GET":
+        await _asgi_stream(scope, receive, send, match.group(1))
+    else:
+        await _asgi_wsgi(scope, receive, send)
+
+
+def _default_supervisor_address(folder):
+    if os.name == 'nt':
+        return rf'\\.\pipe\turtcd-sessions-{os.getpid()}'
+    return os.path.join(folder, 'sessions.sock')
+
+
+def start_session_supervisor():
+    """Start `main.py --session-supervisor` and point this process and its workers at it."""
+    # Папка mkdtemp доступна только владельцу: в ней сокет и файл ключа
+    folder = tempfile.mkdtemp(prefix='turtcd-')
+    address = _default_supervisor_address(folder)
+    if not config['session_supervisor_key'] and not config['session_supervisor_key_file']:
+        key_file = os.path.join(folder, 'sessions.key')
+        fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(secrets.token_hex(32))
+        # Сам ключ в окружение не попадает, рабочие процессы сервера читают его из файла
+        os.environ[CONFIG_ENV_PREFIX + 'SESSION_SUPERVISOR_KEY_FILE'] = config['session_supervisor_key_file'] = key_file
+    # Рабочие процессы сервера получают адрес через окружение (TURTCD_SESSION_SUPERVISOR)
+    os.environ[CONFIG_ENV_PREFIX + 'SESSION_SUPERVISOR'] = config['session_supervisor'] = address
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--session-supervisor'])
+    atexit.register(_stop_session_supervisor, proc, folder)
+    deadline = time.monotonic() + 15
+    while True:
+        try:
+            multiprocessing.connection.Client(address, authkey=_supervisor_authkey()).close()
+            return proc
+        except OSError:
+            if proc.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError("Не удалось запустить сервис сессий")
+            time.sleep(0.1)
+
+
+def _stop_session_supervisor(proc, folder):
+    # SIGTERM, чтобы сервис успел остановить запущенные программы
+    try:
+        proc.terminate()
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+    except OSError:
+        pass
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+def run_session_supervisor():
+    """Entry point of `main.py --session-supervisor`: owns the run sessions of all workers."""
+    global session_registry
+    if not config['session_supervisor']:
+        print("Не задан адрес сервиса сессий: session_supervisor в turtcd_config.json или TURTCD_SESSION_SUPERVISOR")
+        return
+    try:
+        authkey = _supervisor_authkey()
+    except RuntimeError as e:
+        print(e)
+        return
+    session_registry = LocalSessionRegistry()
+    session_registry.prepare()
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        SessionSupervisor(session_registry, config['session_supervisor'], authkey).serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Программы не должны пережить своего владельца
+        session_registry.stop_all()
+        interpreter_pool.shutdown()
+
+
+def run_server():
+    """Serve the app in the mode from config["server"]["mode"]."""
+    server = config['server']
     port = config['port']
-    is_host = config['is_host']
-    host = '0.0.0.0' if is_host else '127.0.0.1'
-    
-    
-    app.run(debug=True, port=port, host=host)
\ No newline at end of file
+    host = '0.0.0.0' if config['is_host'] else '127.0.0.1'
+    mode = server['mode']
+    workers = server['workers']
+    if workers > 1 and mode != 'asgi':
+        print("Несколько процессов сервера поддерживаются только в режиме asgi. Запускается один процесс.")
+
+    if mode == 'wsgi':
+        try:
+            from waitress import serve
+        except ImportError:
+            print("Для режима wsgi нужен waitress: pip install waitress. Запускается встроенный сервер.")
+        else:
+            prepare_server()
+            # waitress не умеет прерывать обработчик, поэтому server.timeout здесь не действует.
+            # channel_timeout закрывает простаивающие соединения и недополученные запросы,
+            # проверка идёт раз в cleanup_interval секунд (по умолчанию 30)
+            serve(app, host=host, port=port, threads=server['threads'], channel_timeout=server['keepalive'],
+                  cleanup_interval=max(1, min(server['keepalive'], 30)),
+                  max_request_body_size=server['max_body_mb'] * 1024 * 1024,
+                  connection_limit=server['connections'], ident='TurtCD')
+            return
+    elif mode == 'asgi':
+        try:
+            import uvicorn
+        except ImportError:
+            uvicorn = None
+        if uvicorn is None or WsgiToAsgi is None:
+            print("Для режима asgi нужны uvicorn и asgiref: pip install uvicorn asgiref. Запускается встроенный сервер.")
+            config['server']['mode'] = 'dev'
+        else:
+            # prepare_server() вызывается из lifespan в asgi_app каждого процесса
+            options = dict(host=host, port=port, lifespan='on', timeout_keep_alive=server['keepalive'],
+                           limit_concurrency=server['connections'])
+            if workers > 1:
+                # Сессии переезжают в отдельный процесс, любой рабочий процесс обслуживает любую сессию
+                if not config['session_supervisor']:
+                    start_session_supervisor()
+                module = os.path.splitext(os.path.basename(__file__))[0]
+                uvicorn.run(f"{module}:asgi_app", workers=workers,
+                            app_dir=os.path.dirname(os.path.abspath(__file__)), **options)
+            else:
+                uvicorn.run(asgi_app, **options)
+            return
+
+    # С debug=True перезагрузчик Werkzeug запускает приложение в дочернем процессе,
+    # а родитель только следит за файлами: пул интерпретаторов и фоновые задачи нужны лишь дочернему
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        prepare_server()
+    app.run(debug=True, port=port, host=host, threaded=True)
+
+
+if __name__ == '__main__':
+    if '--session-supervisor' in sys.argv:
+        run_session_supervisor()
+    else:
+        run_server()
@@ -0,0 +1,251 @@
+"""Sandbox prelude for TurtCD run sessions.
+
+Applies the safe-mode file restrictions before a user program starts. It is
+an ordinary module, so CPython keeps its bytecode in __pycache__ instead of
+compiling a generated wrapper on every run. Parameters are passed to
+install() directly or read from TURTCD_* environment variables.
+"""
+import json
+import os
+import shutil
+
+ENV_PREFIX = 'TURTCD_'
+SETTING_NAMES = ('safe_mode', 'project_path', 'engine_root', 'projects_folder', 'compiled_folder', 'source_folder')
+
+_safe_mode = 'restricted'
+
+STANDARD_FDS = (0, 1, 2)  # stdin, stdout, stderr: allowed as file descriptors in the limited mode
+
+_original_open = open
+_original_makedirs = os.makedirs
+_original_remove = os.remove
+_original_unlink = os.unlink
+_original_rmdir = os.rmdir
+_original_rmtree = shutil.rmtree
+_original_copy = shutil.copy
+_original_copy2 = shutil.copy2
+_original_move = shutil.move
+_original_rename = os.rename
+
+
+def settings_from_env(environ=None):
+    environ = os.environ if environ is None else environ
+    return {name: environ.get(ENV_PREFIX + name.upper(), '') for name in SETTING_NAMES}
+
+
+def limits_from_env(environ=None):
+    environ = os.environ if environ is None else environ
+    try:
+        return json.loads(environ.get(ENV_PREFIX + 'LIMITS') or '{}')
+    except ValueError:
+        return {}
+
+
+def apply_limits(limits):
+    """Apply the CPU time and address space limits of the run (POSIX only).
+
+    The soft CPU limit delivers SIGXCPU, which the server reports as a CPU
+    limit hit; the hard limit one second later guarantees termination.
+    """
+    try:
+        import resource
+    except ImportError:
+        return False  # Windows: ограничения не поддерживаются
+    cpu_seconds = int(limits.get('cpu_seconds') or 0)
+    memory_mb = int(limits.get('memory_mb') or 0)
+    if cpu_seconds:
+        used = int(resource.getrusage(resource.RUSAGE_SELF).ru_utime + resource.getrusage(resource.RUSAGE_SELF).ru_stime)
+        resource.setrlimit(resource.RLIMIT_CPU, (used + cpu_seconds, used + cpu_seconds + 1))
+    if memory_mb:
+        memory = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    return True
+
+
+class PathPolicy:
+    """Classifies paths as project files, engine files or neither.
+
+    The roots are normalized once and stored in a trie of path components,
+    so a query walks the components of one path instead of normalizing every
+    root, and a sibling such as `projects2` never matches `projects`.
+    Decisions are memoized per directory.
+    """
+
+    CACHE_SIZE = 1024
+    _KINDS = None  # trie key holding the kinds of roots that end at a node
+
+    def __init__(self, project_path='', engine_root='', engine_folders=()):
+        self._trie = {}
+        self._engine_root = self._normalize(engine_root) if engine_root else None
+        for folder in engine_folders:
+            if folder:
+                self._add(folder, 'engine')
+        if project_path and project_path.strip():
+            self._add(project_path, 'project')
+        self._cache = {}
+
+    @staticmethod
+    def _normalize(path):
+        return os.path.normcase(os.path.abspath(path))
+
+    @staticmethod
+    def _parts(normalized):
+        return [part for part in normalized.split(os.sep) if part]
+
+    def _add(self, path, kind):
+        node = self._trie
+        for part in self._parts(self._normalize(path)):
+            node = node.setdefault(part, {})
+        node.setdefault(self._KINDS, set()).add(kind)
+
+    def _classify_dir(self, directory):
+        kinds = set(self._trie.get(self._KINDS, ()))
+        node = self._trie
+        for part in self._parts(directory):
+            node = node.get(part)
+            if node is None:
+                break
+            kinds.update(node.get(self._KINDS, ()))
+        # Файлы прямо в корне движка (где лежит main.py) тоже считаются файлами движка
+        return 'project' in kinds, 'engine' in kinds or directory == self._engine_root, node
+
+    def classify(self, filepath):
+        """Return (is_project, is_engine) for filepath.
+
+        Bytes and os.PathLike paths are decoded like the os functions do.
+        The standard streams 0-2 as file descriptors are neither, so
+        open(1, 'w', closefd=False) keeps working. Any other descriptor,
+        another type or a path that cannot be normalized counts as both,
+        so the limited mode denies it: a descriptor does not tell which
+        file it refers to.
+        """
+        if isinstance(filepath, int) and not isinstance(filepath, bool) and filepath in STANDARD_FDS:
+            return False, False
+        if not isinstance(filepath, (str, bytes, os.PathLike)):
+            return True, True
+        try:
+            directory, name = os.path.split(self._normalize(os.fsdecode(filepath)))
+        except Exception:
+            return True, True
+        cached = self._cache.get(directory)
+        if cached is None:
+            if len(self._cache) >= self.CACHE_SIZE:
+                self._cache.clear()
+            cached = self._cache[directory] = self._classify_dir(directory)
+        is_project, is_engine, node = cached
+        if node is not None and not (is_project and is_engine):
+            # Сам путь может совпадать с корнем, например rmtree папки projects
+            kinds = node.get(name, {}).get(self._KINDS, ())
+            is_project = is_project or 'project' in kinds
+            is_engine = is_engine or 'engine' in kinds
+        return is_project, is_engine
+
+
+_policy = PathPolicy()
+
+
+def _check_file_access(filepath, operation):
+    '''Check if file operation is allowed based on security mode'''
+    if _safe_mode == 'full':
+        return True  # Full freedom
+
+    is_project, is_engine = _policy.classify(filepath)
+
+    if _safe_mode == 'restricted':
+        # Full ban - no file operations
+        raise PermissionError(f"Безопасный режим: операция {operation} запрещена для пути {filepath}")
+
+    if _safe_mode == 'limited':
+        # Limited - allow only non-project and non-engine files
+        if is_project:
+            raise PermissionError(f"Безопасный режим: операция {operation} запрещена для файлов проекта. Путь: {filepath}")
+        if is_engine:
+            raise PermissionError(f"Безопасный режим: операция {operation} запрещена для папок движка. Путь: {filepath}")
+        return True
+
+    return True
+
+
+# Override file operations
+def _secure_open(file, mode='r', *args, **kwargs):
+    if 'w' in mode or 'a' in mode or 'x' in mode:
+        _check_file_access(file, 'open')
+    return _original_open(file, mode, *args, **kwargs)
+
+
+def _secure_makedirs(name, *args, **kwargs):
+    _check_file_access(name, 'makedirs')
+    return _original_makedirs(name, *args, **kwargs)
+
+
+def _secure_remove(path, *args, **kwargs):
+    _check_file_access(path, 'remove')
+    return _original_remove(path, *args, **kwargs)
+
+
+def _secure_unlink(path, *args, **kwargs):
+    _check_file_access(path, 'unlink')
+    return _original_unlink(path, *args, **kwargs)
+
+
+def _secure_rmdir(path, *args, **kwargs):
+    _check_file_access(path, 'rmdir')
+    return _original_rmdir(path, *args, **kwargs)
+
+
+def _secure_rmtree(path, *args, **kwargs):
+    _check_file_access(path, 'rmtree')
+    return _original_rmtree(path, *args, **kwargs)
+
+
+def _secure_copy(src, dst, *args, **kwargs):
+    _check_file_access(src, 'copy')
+    _check_file_access(dst, 'copy')
+    return _original_copy(src, dst, *args, **kwargs)
+
+
+def _secure_copy2(src, dst, *args, **kwargs):
+    _check_file_access(src, 'copy2')
+    _check_file_access(dst, 'copy2')
+    return _original_copy2(src, dst, *args, **kwargs)
+
+
+def _secure_move(src, dst):
+    _check_file_access(src, 'move')
+    _check_file_access(dst, 'move')
+    return _original_move(src, dst)
+
+
+def _secure_rename(src, dst, *args, **kwargs):
+    _check_file_access(src, 'rename')
+    _check_file_access(dst, 'rename')
+    return _original_rename(src, dst, *args, **kwargs)
+
+
+def install(namespace, safe_mode='restricted', project_path='', engine_root='', projects_folder='',
+            compiled_folder='', source_folder=''):
+    """Store the security settings and replace the guarded file operations.
+
+    `namespace` is the globals dict of the user program; its `open` is
+    replaced the same way the old generated wrapper did it.
+    """
+    global _safe_mode, _policy
+    _safe_mode = safe_mode or 'restricted'
+    engine_root = engine_root or os.getcwd()
+    _policy = PathPolicy(project_path, engine_root, (
+        projects_folder or os.path.join(engine_root, 'projects'),
+        compiled_folder or os.path.join(engine_root, 'compiled'),
+        source_folder or os.path.join(engine_root, 'source')
+    ))
+
+    # Replace built-in functions
+    namespace['open'] = _secure_open
+    os.makedirs = _secure_makedirs
+    os.remove = _secure_remove
+    os.unlink = _secure_unlink
+    os.rmdir = _secure_rmdir
+    os.rename = _secure_rename
+    shutil.rmtree = _secure_rmtree
+    shutil.copy = _secure_copy
+    shutil.copy2 = _secure_copy2
+    shutil.move = _secure_move
@@ -0,0 +1,79 @@
+"""Interpreter entry point for TurtCD run sessions.
+
+With a script path argument it runs that file once, reading the sandbox
+settings and run limits from TURTCD_* environment variables. Without
+arguments it is a warm worker of the server's interpreter pool: the
+modules every program needs are already imported and it waits for a
+single JSON line on stdin with the settings, limits and user code.
+Everything written to stdin after that line is the program's input.
+"""
+import builtins
+import json
+import linecache
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import turtcd_sandbox
+
+PROGRAM_FILENAME = '<program>'
+
+
+def _exec_program(code, filename, namespace):
+    # Исходник кладём в linecache, чтобы traceback показывал строки программы
+    linecache.cache[filename] = (len(code), None, code.splitlines(True), filename)
+    try:
+        exec(compile(code, filename, 'exec'), namespace)
+    except SystemExit:
+        raise
+    except BaseException:
+        etype, value, tb = sys.exc_info()
+        # Кадр воркера не относится к программе пользователя
+        value = value.with_traceback(tb.tb_next)
+        if sys.excepthook is sys.__excepthook__:
+            # Стандартный excepthook читает исходник с диска и не видит <program>
+            import traceback
+            traceback.print_exception(etype, value, value.__traceback__)
+        else:
+            sys.excepthook(etype, value, value.__traceback__)
+        sys.exit(1)
+
+
+def main():
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+        with open(filename, 'r', encoding='utf-8') as f:
+            code = f.read()
+        settings = turtcd_sandbox.settings_from_env()
+        limits = turtcd_sandbox.limits_from_env()
+        program_dir = os.path.dirname(os.path.abspath(filename))
+    else:
+        line = sys.stdin.buffer.readline()
+        if not line:
+            return  # сервер закрыл пул, программа так и не пришла
+        payload = json.loads(line.decode('utf-8'))
+        code = payload.get('code', '')
+        settings = payload.get('sandbox', {})
+        limits = payload.get('limits', {})
+        filename = PROGRAM_FILENAME
+        program_dir = None
+
+    # sys.path[0] должен указывать на папку программы, а не на runtime/
+    if sys.path and os.path.abspath(sys.path[0]) == os.path.dirname(os.path.abspath(__file__)):
+        if program_dir:
+            sys.path[0] = program_dir
+        else:
+            sys.path.pop(0)
+    sys.argv = [filename]
+    namespace = {"__name__": "__main__", "__builtins__": builtins, "__file__": filename}
+    # Прежний пролог импортировал их в саму программу, сгенерированный код на это рассчитывает
+    namespace.update(os=os, sys=sys, shutil=shutil, Path=Path)
+
+    turtcd_sandbox.apply_limits(limits)
+    turtcd_sandbox.install(namespace, **settings)
+    _exec_program(code, filename, namespace)
+
+
+if __name__ == '__main__':
+    main()
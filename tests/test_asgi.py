@@ -0,0 +1,169 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # main.py читает blocks_config.json и папки относительно текущей папки
+
+import main
+
+
+def http_scope(method, path, query=b"", headers=()):
+    return {"type": "http", "http_version": "1.1", "method": method, "scheme": "http", "path": path,
+            "root_path": "", "query_string": query, "headers": list(headers),
+            "server": ("127.0.0.1", 5000), "client": ("127.0.0.1", 40000)}
+
+
+async def call(scope, messages=(), disconnect_after=None):
+    """Run asgi_app and collect what it sends; http.disconnect follows the request body
+    once `disconnect_after` body chunks were sent (None - never)."""
+    incoming = asyncio.Queue()
+    for message in messages or [{"type": "http.request", "body": b""}]:
+        incoming.put_nowait(message)
+    sent = []
+
+    async def send(message):
+        message = dict(message, sent_at=time.monotonic())
+        sent.append(message)
+        chunks = [m for m in sent if m["type"] == "http.response.body" and m.get("body")]
+        if disconnect_after is not None and len(chunks) == disconnect_after:
+            incoming.put_nowait({"type": "http.disconnect"})
+
+    await main.asgi_app(scope, incoming.get, send)
+    return sent
+
+
+def response(sent):
+    start = sent[0]
+    body = b"".join(m.get("body", b"") for m in sent[1:])
+    return start["status"], dict(start["headers"]), body, sent[-1]
+
+
+@unittest.skipIf(main.WsgiToAsgi is None, "asgiref is not installed")
+class AsgiWsgiTest(unittest.TestCase):
+    def test_flask_request(self):
+        body = json.dumps({"filename": "../x.turtcd"}).encode('utf-8')
+        scope = http_scope("POST", "/api/project/load-file", headers=[
+            (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())])
+        # Тело приходит несколькими сообщениями
+        messages = [{"type": "http.request", "body": body[:5], "more_body": True},
+                    {"type": "http.request", "body": body[5:]}]
+        status, headers, payload, last = response(asyncio.run(call(scope, messages)))
+        self.assertEqual(status, 400)
+        self.assertEqual(headers[b"content-type"], b"application/json")
+        self.assertEqual(json.loads(payload)["status"], "error")
+        self.assertFalse(last.get("more_body"))
+
+    def test_generator_is_streamed(self):
+        def wsgi(environ, start_response):
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            for i in range(3):
+                yield f"{i}\n".encode()
+
+        with mock.patch.object(main, "_wsgi_to_asgi", main.WsgiToAsgi(wsgi)):
+            sent = asyncio.run(call(http_scope("GET", "/x")))
+        self.assertEqual([m.get("body") for m in sent[1:-1]], [b"0\n", b"1\n", b"2\n"])
+        self.assertTrue(all(m.get("more_body") for m in sent[1:-1]))
+        self.assertEqual(response(sent)[2], b"0\n1\n2\n")
+
+    def test_requests_run_in_parallel(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def wsgi(environ, start_response):
+            barrier.wait()
+            start_response("200 OK", [])
+            return [b"ok"]
+
+        async def both():
+            return await asyncio.gather(call(http_scope("GET", "/a")), call(http_scope("GET", "/b")))
+
+        with mock.patch.object(main, "_wsgi_to_asgi", main.WsgiToAsgi(wsgi)):
+            results = asyncio.run(both())
+        self.assertEqual([response(sent)[0] for sent in results], [200, 200])
+
+    def test_slow_answer_is_504(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def wsgi(environ, start_response):
+            release.wait(5)
+            start_response("200 OK", [])
+            return [b"late"]
+
+        with mock.patch.object(main, "_wsgi_to_asgi", main.WsgiToAsgi(wsgi)), \
+                mock.patch.dict(main.config["server"], timeout=0.2):
+            started = time.monotonic()
+            sent = asyncio.run(call(http_scope("GET", "/slow")))
+        # Ответ 504 отправлен, не дожидаясь обработчика
+        self.assertLess(sent[-1]["sent_at"] - started, 3)
+        status, headers, payload, last = response(sent)
+        self.assertEqual(status, 504)
+        self.assertEqual(json.loads(payload)["status"], "error")
+        self.assertEqual(len(sent), 2)
+
+
+class AsgiStreamTest(unittest.TestCase):
+    def start(self, code):
+        result = main.app.test_client().post('/api/project/start', json={"code": code, "safeMode": "full"}).get_json()
+        self.assertEqual(result["status"], "success", result)
+        session_id = result["session_id"]
+        self.addCleanup(main.app.test_client().post, f'/api/project/stop/{session_id}')
+        return session_id
+
+    def events(self, body):
+        events = []
+        for chunk in body.decode('utf-8').split("\n\n"):
+            lines = dict(line.split(": ", 1) for line in chunk.splitlines() if not line.startswith(":"))
+            if "event" in lines:
+                events.append((lines["event"], json.loads(lines["data"])))
+        return events
+
+    def test_output_and_exit(self):
+        session_id = self.start("print('hello')\nprint('world')")
+        sent = asyncio.run(asyncio.wait_for(call(http_scope("GET", f"/api/project/stream/{session_id}")), 30))
+        status, headers, body, last = response(sent)
+        self.assertEqual(status, 200)
+        self.assertTrue(headers[b"content-type"].startswith(b"text/event-stream"))
+        events = self.events(body)
+        output = "".join(payload["output"] for event, payload in events if event == "output")
+        self.assertEqual(output.split(), ["hello", "world"])
+        self.assertEqual(events[-1][0], "exit")
+        self.assertEqual(events[-1][1]["returncode"], 0)
+        self.assertFalse(last.get("more_body"))
+
+    def test_resume_from_offset(self):
+        session_id = self.start("print('hello')")
+        first = self.events(response(asyncio.run(asyncio.wait_for(
+            call(http_scope("GET", f"/api/project/stream/{session_id}")), 30)))[2])
+        end = first[-1][1]["next"]
+        # EventSource при переподключении присылает Last-Event-ID
+        sent = asyncio.run(asyncio.wait_for(call(http_scope(
+            "GET", f"/api/project/stream/{session_id}", headers=[(b"last-event-id", str(end).encode())])), 30))
+        self.assertEqual([event for event, payload in self.events(response(sent)[2])], ["exit"])
+
+    def test_disconnect_stops_stream(self):
+        session_id = self.start("import time\nprint('started', flush=True)\ntime.sleep(30)")
+        started = time.monotonic()
+        sent = asyncio.run(asyncio.wait_for(
+            call(http_scope("GET", f"/api/project/stream/{session_id}"), disconnect_after=1), 10))
+        self.assertLess(time.monotonic() - started, 10)
+        events = self.events(response(sent)[2])
+        self.assertEqual([event for event, payload in events], ["output"])
+        self.assertFalse(sent[-1].get("more_body"))
+        # Программа продолжает работать, отключился только зритель
+        status = main.app.test_client().get(f'/api/project/status/{session_id}').get_json()
+        self.assertTrue(status["running"], status)
+
+    def test_unknown_session(self):
+        status, headers, body, last = response(asyncio.run(call(http_scope("GET", "/api/project/stream/missing"))))
+        self.assertEqual(status, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+import json
+import os
+import random
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # main.py читает blocks_config.json и папки относительно текущей папки
+
+import main
+
+
+class RandomProject:
+    """A project built from the real block templates and edited at random.
+
+    edit() makes a few random changes the way the editor does and returns
+    the net diff the editor would send to /api/project/compile.
+    """
+
+    def __init__(self, rnd, size=15):
+        self.rnd = rnd
+        self.templates = {block["id"]: block["type"]
+                          for category in main.block_registry.get_config()["categories"]
+                          for block in category["blocks"] if block["type"] != "header"}
+        self.next_id = 0
+        self.blocks = {"start": {"id": "start", "type": "header", "template": "start", "fields": {}}}
+        self.connections = []
+        for _ in range(size):
+            self.add_block()
+
+    def project(self):
+        return json.loads(json.dumps({"blocks": list(self.blocks.values()), "connections": self.connections}))
+
+    def new_block(self, block_id=None, template=None):
+        if template is None:
+            template = self.rnd.choice(sorted(self.templates))
+        fields = {field["name"]: self.value() for field in main.block_registry.get_block(template).get("fields", [])}
+        if block_id is None:
+            self.next_id += 1
+            block_id = f"b{self.next_id}"
+        return {"id": block_id, "type": self.templates[template], "template": template, "fields": fields,
+                "ignored": self.rnd.random() < 0.1}
+
+    def value(self):
+        return self.rnd.choice(["x", "y", "n", "10", "'text'", "items", ""]) + str(self.rnd.randint(0, 3))
+
+    def free_connectors(self):
+        used = {(conn["from"], conn["fromConnector"]) for conn in self.connections}
+        connectors = []
+        for block in self.blocks.values():
+            names = ("bottom", "right") if block["type"] in ("condition", "loop") else ("bottom",)
+            connectors.extend((block["id"], name) for name in names if (block["id"], name) not in used)
+        return connectors
+
+    def others(self):
+        return [block_id for block_id in self.blocks if block_id != "start"]
+
+    def add_block(self):
+        block = self.new_block()
+        source, connector = self.rnd.choice(self.free_connectors())
+        conn = {"from": source, "fromConnector": connector, "to": block["id"], "toConnector": "top"}
+        self.blocks[block["id"]] = block
+        self.connections.append(conn)
+
+    def edit_fields(self):
+        block_id = self.rnd.choice(self.others())
+        block = dict(self.blocks[block_id], fields={name: self.value() for name in self.blocks[block_id]["fields"]})
+        self.blocks[block_id] = block
+
+    def toggle_ignored(self):
+        block_id = self.rnd.choice(self.others())
+        block = dict(self.blocks[block_id], ignored=not self.blocks[block_id]["ignored"])
+        self.blocks[block_id] = block
+
+    def change_template(self):
+        # Тип блока может смениться: действие становится условием и наоборот
+        block = self.new_block(self.rnd.choice(self.others()))
+        self.blocks[block["id"]] = block
+
+    def remove_block(self):
+        block_id = self.rnd.choice(self.others())
+        removed = [conn for conn in self.connections if block_id in (conn["from"], conn["to"])]
+        self.connections = [conn for conn in self.connections if conn not in removed]
+        del self.blocks[block_id]
+
+    def reconnect(self):
+        # Перенос цепочки в другое место, в том числе внутрь самой себя
+        if not self.connections:
+            return
+        conn = self.rnd.choice(self.connections)
+        source, connector = self.rnd.choice(self.free_connectors())
+        moved = dict(conn, **{"from": source, "fromConnector": connector})
+        self.connections.remove(conn)
+        self.connections.append(moved)
+
+    def edit(self):
+        blocks, connections = dict(self.blocks), list(self.connections)
+        edits = (self.add_block, self.edit_fields, self.toggle_ignored, self.change_template,
+                 self.remove_block, self.reconnect)
+        for _ in range(self.rnd.randint(1, 3)):
+            if len(self.blocks) < 3:
+                self.add_block()
+            else:
+                self.rnd.choices(edits, weights=(3, 4, 1, 1, 2, 2))[0]()
+        diff = {
+            "removeBlocks": [block_id for block_id in blocks if block_id not in self.blocks],
+            "upsertBlocks": [block for block_id, block in self.blocks.items() if blocks.get(block_id) != block],
+            "removeConnections": [conn for conn in connections if conn not in self.connections],
+            "addConnections": [conn for conn in self.connections if conn not in connections]
+        }
+        return json.loads(json.dumps(diff))
+
+
+class IncrementalCompileTest(unittest.TestCase):
+    def setUp(self):
+        main.compile_states.clear()
+        self.addCleanup(main.compile_states.clear)
+
+    def test_matches_full_compile_after_random_edits(self):
+        for seed in range(50):
+            rnd = random.Random(seed)
+            project = RandomProject(rnd)
+            project_id = f"random-{seed}"
+            result = main.compile_project_incremental(project_id, project_data=project.project())
+            self.assertEqual(result["code"], main.generate_python_code(project.project()))
+            revision = result["revision"]
+            for step in range(40):
+                diff = project.edit()
+                result = main.compile_project_incremental(project_id, diff=diff, revision=revision)
+                self.assertEqual(result["status"], "success")
+                with self.subTest(seed=seed, step=step):
+                    self.assertEqual(result["code"], main.generate_python_code(project.project()))
+                revision = result["revision"]
+
+    def test_field_edit_rebuilds_one_block(self):
+        project = RandomProject(random.Random(1), size=30)
+        result = main.compile_project_incremental("p", project_data=project.project())
+        self.assertEqual(len(result["rebuiltBlocks"]), len(set(result["rebuiltBlocks"])))
+        # Повторная компиляция того же проекта ничего не строит заново
+        result = main.compile_project_incremental("p", diff={}, revision=result["revision"])
+        self.assertEqual((result["rebuiltBlocks"], result["rebuiltFragments"]), ([], 0))
+        # Правка полей одного показанного блока строит заново только его
+        shown = next(block_id for block_id in _emitted(project)[1:] if project.blocks[block_id]["fields"])
+        block = dict(project.blocks[shown], fields={name: "changed" for name in project.blocks[shown]["fields"]})
+        project.blocks[shown] = block
+        result = main.compile_project_incremental("p", diff={"upsertBlocks": [block]}, revision=result["revision"])
+        self.assertEqual(result["rebuiltBlocks"], [shown])
+        self.assertEqual(result["code"], main.generate_python_code(project.project()))
+
+    def test_resync(self):
+        self.assertTrue(main.compile_project_incremental("missing", diff={})["resync"])
+        project = RandomProject(random.Random(2))
+        revision = main.compile_project_incremental("p", project_data=project.project())["revision"]
+        result = main.compile_project_incremental("p", diff={}, revision=revision - 1)
+        self.assertEqual((result["status"], result["resync"], result["revision"]), ("error", True, revision))
+
+    def test_compile_endpoint(self):
+        project = RandomProject(random.Random(3)).project()
+        client = main.app.test_client()
+        full = client.post('/api/project/compile', json={"project_data": project}).get_json()
+        incremental = client.post('/api/project/compile', json={"project_id": "p", "project_data": project}).get_json()
+        self.assertEqual(full["code"], incremental["code"])
+        self.assertEqual(client.post('/api/project/compile', json={"project_id": "p", "diff": {"upsertBlocks": [{}]}})
+                         .get_json()["status"], "error")
+
+
+def _emitted(project):
+    """Ids of the blocks reached from the header, in the order generate_python_code walks them."""
+    state = main.ProjectCompileState()
+    state.load(project.project())
+    nodes, _ = state._emission_tree()
+    return [node[0] for node in nodes]
+
+
+if __name__ == '__main__':
+    unittest.main()
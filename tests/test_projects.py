@@ -0,0 +1,399 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # main.py читает blocks_config.json и папки относительно текущей папки
+
+import main
+
+
+class ProjectFolderTestCase(unittest.TestCase):
+    """Runs the project endpoints against a temporary projects folder."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder, ignore_errors=True)
+        self.storage = main.ProjectStorage(self.folder, os.path.join(self.folder, '.backups'),
+                                           os.path.join(self.folder, '.locks'), backups=3)
+        self.index = main.ProjectIndex(self.folder, os.path.join(self.folder, '.index.sqlite3'))
+        self.documents = main.ProjectDocuments(self.storage)
+        for name, value in (('project_storage', self.storage), ('project_index', self.index),
+                            ('project_documents', self.documents)):
+            patcher = mock.patch.object(main, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = main.app.test_client()
+
+    def save(self, filename, project_data):
+        return self.client.post('/api/project/save-file', json={"filename": filename, "project_data": project_data}).get_json()
+
+    def load(self, filename, **extra):
+        return self.client.post('/api/project/load-file', json=dict(extra, filename=filename)).get_json()
+
+    def patch(self, filename, revision, ops, **extra):
+        return self.client.post('/api/project/patch', json=dict(extra, filename=filename, revision=revision, ops=ops))
+
+
+class SaveTest(ProjectFolderTestCase):
+    def test_save_over_truncated_file(self):
+        self.assertEqual(self.save('a', {"blocks": [{"id": "b1"}], "connections": []})["status"], "success")
+        path = self.storage.path('a.turtcd')
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) // 2)
+        self.assertEqual(self.load('a.turtcd')["status"], "error")
+
+        result = self.save('a', {"blocks": [{"id": "b2"}], "connections": []})
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(self.load('a.turtcd')["project_data"]["blocks"], [{"id": "b2"}])
+        # Повреждённая версия осталась среди резервных копий
+        backups = os.listdir(os.path.join(self.folder, '.backups', 'a.turtcd'))
+        self.assertTrue(backups)
+
+    def test_truncated_compressed_project_is_value_error(self):
+        data = main.encode_project({"blocks": [{"id": f"b{i}", "x": i} for i in range(200)]}, "compact")
+        self.assertTrue(data.startswith((main.ZSTD_MAGIC, main.GZIP_MAGIC)))
+        with self.assertRaises(ValueError):
+            main.decode_project(data[:len(data) // 2])
+
+
+class StorageCleanupTest(ProjectFolderTestCase):
+    def test_delete_removes_lock_file_and_caps_deleted_backups(self):
+        self.storage.deleted_backups = 2
+        for name in ('a', 'b', 'c'):
+            self.save(name, {"blocks": [], "connections": []})
+            self.assertEqual(self.client.post('/api/project/delete', json={"filename": name + '.turtcd'}).get_json(),
+                             {"status": "success"})
+        self.assertEqual(os.listdir(os.path.join(self.folder, '.locks')), [])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.folder, '.backups'))), ['b.turtcd', 'c.turtcd'])
+        self.assertEqual(len(self.storage._locks), 0)
+
+    def test_rename_merges_backups_of_deleted_project(self):
+        self.storage.backups = 2
+        for data in ({"v": 1}, {"v": 2}):
+            self.storage.write('old.turtcd', data)
+        self.storage.write('new.turtcd', {"v": 0})
+        self.storage.delete('new.turtcd')
+        self.assertTrue(self.storage.rename('old.turtcd', 'new.turtcd'))
+        self.assertEqual(len(os.listdir(os.path.join(self.folder, '.backups', 'new.turtcd'))), 2)
+        self.assertFalse(os.path.exists(os.path.join(self.folder, '.backups', 'old.turtcd')))
+        self.assertFalse(os.path.exists(os.path.join(self.folder, '.locks', 'old.turtcd.lock')))
+
+    @unittest.skipIf(main.fcntl is None, "lock files are not removed on Windows")
+    def test_waiter_locks_new_file_after_discard(self):
+        # Отдельные ProjectStorage - как разные процессы сервера: общие только файлы блокировок
+        other = main.ProjectStorage(self.folder, self.storage.backups_folder, self.storage.locks_folder)
+        third = main.ProjectStorage(self.folder, self.storage.backups_folder, self.storage.locks_folder)
+        self.storage.write('a.turtcd', {})
+        holder = self.storage.lock('a.turtcd')
+        holder.acquire()
+        waiter = other.lock('a.turtcd')
+        acquired = threading.Event()
+
+        def wait():
+            with waiter:
+                acquired.set()
+                time.sleep(0.3)
+
+        thread = threading.Thread(target=wait)
+        thread.start()
+        time.sleep(0.1)
+        holder.discard()
+        holder.release()
+        self.assertTrue(acquired.wait(5))
+        # Ожидавший держит новый файл блокировки, третий процесс его ждёт
+        started = time.monotonic()
+        with third.lock('a.turtcd'):
+            self.assertGreater(time.monotonic() - started, 0.1)
+        thread.join()
+
+
+class CompactFormatTest(unittest.TestCase):
+    def blocks(self):
+        return [{"id": f"b{i}", "width": 180, "x": i, "fields": {}, "hiddenBy": [], "ignoreIssues": i == 3}
+                for i in range(40)]
+
+    def test_round_trip_keeps_key_order(self):
+        blocks = self.blocks()
+        # Блоки с другим порядком ключей и с ключом, которого нет у остальных
+        blocks[5] = {"x": 5, "hiddenBy": [], "id": "b5", "width": 180, "fields": {}, "ignoreIssues": False}
+        blocks[7]["locked"] = True
+        project = {"blocks": blocks, "connections": [], "camera": {"x": 0, "y": 0, "scale": 1}}
+        data = main.encode_project(project, "compact")
+        self.assertEqual(json.dumps(main.decode_project(data)), json.dumps(project))
+
+    def test_compact_file_without_key_order(self):
+        # Файлы, записанные до появления PROJECT_COMPACT_ORDER_KEY, по-прежнему читаются
+        project = {"blocks": self.blocks(), "connections": []}
+        compact = main._compact_project(project)
+        del compact[main.PROJECT_COMPACT_ORDER_KEY]
+        self.assertEqual(main.decode_project(json.dumps(compact).encode('utf-8')), project)
+
+
+class ProjectListTest(ProjectFolderTestCase):
+    def setUp(self):
+        super().setUp()
+        # name -> (blocks, template); mtime задаём явно, чтобы порядок не зависел от скорости записи
+        projects = {"beta": (3, "game"), "Alpha": (1, None), "gamma_2": (5, "game"),
+                         "delta%": (0, "bot"), "epsilon": (2, None)}
+        for i, (name, (blocks, template)) in enumerate(projects.items()):
+            project = {"blocks": [{"id": f"b{j}"} for j in range(blocks)], "connections": []}
+            if template:
+                project["templateId"] = template
+            self.save(name, project)
+            os.utime(self.storage.path(name + '.turtcd'), ns=(0, (1_700_000_000 + i) * 10 ** 9))
+        self.index.reconcile(force=True)
+
+    def names(self, **args):
+        result = self.client.get('/api/project/list', query_string=args).get_json()
+        self.assertEqual(result["status"], "success", result)
+        self.assertEqual(result["projects"], [item["filename"] for item in result["items"]])
+        return [item["name"] for item in result["items"]], result["total"]
+
+    def test_sorting(self):
+        self.assertEqual(self.names()[0], ["Alpha", "beta", "delta%", "epsilon", "gamma_2"])
+        self.assertEqual(self.names(order="desc")[0], ["gamma_2", "epsilon", "delta%", "beta", "Alpha"])
+        self.assertEqual(self.names(sort="blocks")[0], ["delta%", "Alpha", "epsilon", "beta", "gamma_2"])
+        self.assertEqual(self.names(sort="lastModified", order="desc")[0],
+                         ["epsilon", "delta%", "gamma_2", "Alpha", "beta"])
+        # Неизвестная сортировка - по имени
+        self.assertEqual(self.names(sort="filename; DROP TABLE projects")[0], self.names()[0])
+
+    def test_paging(self):
+        pages = [self.names(offset=offset, limit=2) for offset in (0, 2, 4, 6)]
+        self.assertEqual([names for names, total in pages],
+                         [["Alpha", "beta"], ["delta%", "epsilon"], ["gamma_2"], []])
+        self.assertEqual({total for names, total in pages}, {5})
+        self.assertEqual(self.names(offset=-3, limit=1)[0], ["Alpha"])
+        self.assertEqual(self.names(limit=0), ([], 5))
+
+    def test_filters(self):
+        self.assertEqual(self.names(q="ta"), (["beta", "delta%"], 2))
+        self.assertEqual(self.names(q="ALPHA"), (["Alpha"], 1))
+        # % и _ ищутся как обычные символы
+        self.assertEqual(self.names(q="%"), (["delta%"], 1))
+        self.assertEqual(self.names(q="_"), (["gamma_2"], 1))
+        self.assertEqual(self.names(template="game", sort="blocks", order="desc"), (["gamma_2", "beta"], 2))
+        self.assertEqual(self.names(template="game", q="gam"), (["gamma_2"], 1))
+
+    def test_item_fields(self):
+        result = self.client.get('/api/project/list', query_string={"q": "gamma"}).get_json()
+        item = result["items"][0]
+        self.assertEqual((item["filename"], item["blocks"], item["connections"], item["templateId"]),
+                         ("gamma_2.turtcd", 5, 0, "game"))
+        self.assertEqual(item["size"], os.path.getsize(self.storage.path("gamma_2.turtcd")))
+        self.assertTrue(item["createdAt"])
+
+    def test_changes_outside_server(self):
+        with open(self.storage.path('zeta.turtcd'), 'w', encoding='utf-8') as f:
+            json.dump({"blocks": [{"id": "b"}] * 7, "connections": []}, f)
+        os.remove(self.storage.path('beta.turtcd'))
+        with open(self.storage.path('broken.turtcd'), 'wb') as f:
+            f.write(b'{"blocks": [')
+        self.index.reconcile(force=True)
+        self.assertEqual(self.names(sort="blocks", order="desc", limit=1)[0], ["zeta"])
+        names, total = self.names()
+        self.assertNotIn("beta", names)
+        # Повреждённый файл остаётся в списке
+        self.assertIn("broken", names)
+        self.assertEqual(total, 6)
+
+
+class ProjectPatchTest(unittest.TestCase):
+    def setUp(self):
+        self.project = {"blocks": [{"id": "b1", "x": 1, "fields": {"a/b": 1, "m~n": 2}}, {"id": "b2", "x": 2}],
+                        "connections": [], "camera": {"x": 0}}
+        self.original = json.dumps(self.project)
+
+    def apply(self, *ops):
+        result = main.apply_project_patch(self.project, list(ops))
+        # Исходный проект никогда не меняется
+        self.assertEqual(json.dumps(self.project), self.original)
+        return result
+
+    def test_operations(self):
+        result = self.apply(
+            {"op": "replace", "path": "/blocks/0/x", "value": 10},
+            {"op": "add", "path": "/blocks/-", "value": {"id": "b3"}},
+            {"op": "add", "path": "/blocks/0", "value": {"id": "b0"}},
+            {"op": "remove", "path": "/blocks/2"},
+            {"op": "add", "path": "/connections/0", "value": {"from": "b0", "to": "b1"}},
+            {"op": "move", "from": "/camera/x", "path": "/camera/y"},
+            {"op": "copy", "from": "/blocks/1/fields", "path": "/blocks/0/fields"},
+            {"op": "test", "path": "/blocks/1/x", "value": 10},
+        )
+        self.assertEqual([block["id"] for block in result["blocks"]], ["b0", "b1", "b3"])
+        self.assertEqual(result["blocks"][1]["x"], 10)
+        self.assertEqual(result["connections"], [{"from": "b0", "to": "b1"}])
+        self.assertEqual(result["camera"], {"y": 0})
+        # copy - независимая копия значения
+        self.assertEqual(result["blocks"][0]["fields"], result["blocks"][1]["fields"])
+        self.assertIsNot(result["blocks"][0]["fields"], result["blocks"][1]["fields"])
+
+    def test_escaped_pointer(self):
+        result = self.apply({"op": "replace", "path": "/blocks/0/fields/a~1b", "value": 5},
+                            {"op": "remove", "path": "/blocks/0/fields/m~0n"})
+        self.assertEqual(result["blocks"][0]["fields"], {"a/b": 5})
+
+    def test_untouched_parts_are_shared(self):
+        result = self.apply({"op": "replace", "path": "/blocks/0/x", "value": 10})
+        self.assertIs(result["blocks"][1], self.project["blocks"][1])
+        self.assertIs(result["connections"], self.project["connections"])
+        self.assertIsNot(result["blocks"][0], self.project["blocks"][0])
+
+    def test_replace_root(self):
+        self.assertEqual(self.apply({"op": "replace", "path": "", "value": {"blocks": []}}), {"blocks": []})
+
+    def test_errors(self):
+        for ops in (
+            [{"op": "replace", "path": "/missing/x", "value": 1}],
+            [{"op": "remove", "path": "/blocks/5"}],
+            [{"op": "add", "path": "/blocks/01", "value": 1}],
+            [{"op": "add", "path": "blocks", "value": 1}],
+            [{"op": "add", "path": "/blocks/0/x/y", "value": 1}],
+            [{"op": "replace", "path": "/camera/x"}],
+            [{"op": "increment", "path": "/camera/x"}],
+            [{"op": "move", "from": "/blocks", "path": "/blocks/0/inner"}],
+            [{"op": "remove", "path": ""}],
+            [{"op": "replace", "path": "", "value": []}],
+            # Первая операция применилась бы, но вторая не проходит - проект не меняется
+            [{"op": "replace", "path": "/blocks/0/x", "value": 3}, {"op": "test", "path": "/blocks/0/x", "value": 1}],
+            "not a list",
+        ):
+            with self.subTest(ops=ops), self.assertRaises(main.ProjectPatchError):
+                main.apply_project_patch(self.project, ops)
+        self.assertEqual(json.dumps(self.project), self.original)
+
+
+class PatchEndpointTest(ProjectFolderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.revision = self.save('p', {"blocks": [{"id": "b1", "x": 1}], "connections": []})["revision"]
+
+    def disk(self):
+        data = main.decode_project(open(self.storage.path('p.turtcd'), 'rb').read())
+        return data.pop(main.PROJECT_REVISION_KEY), data
+
+    def test_patch_and_conflict(self):
+        response = self.patch('p.turtcd', self.revision, [{"op": "replace", "path": "/blocks/0/x", "value": 5}], flush=True)
+        self.assertEqual(response.status_code, 200)
+        result = response.get_json()
+        self.assertEqual((result["revision"], result["saved"]), (self.revision + 1, True))
+        revision, data = self.disk()
+        self.assertEqual((revision, data["blocks"]), (self.revision + 1, [{"id": "b1", "x": 5}]))
+
+        # Клиент со старой ревизией получает конфликт и текущую ревизию
+        response = self.patch('p.turtcd', self.revision, [{"op": "replace", "path": "/blocks/0/x", "value": 6}])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.get_json()["revision"], self.revision + 1)
+        self.assertEqual(self.load('p.turtcd')["project_data"]["blocks"], [{"id": "b1", "x": 5}])
+
+    def test_bad_patch(self):
+        response = self.patch('p.turtcd', self.revision, [{"op": "remove", "path": "/blocks/3"}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.load('p.turtcd')["revision"], self.revision)
+        self.assertEqual(self.patch('missing.turtcd', 1, []).status_code, 404)
+
+    def test_delayed_write(self):
+        with mock.patch.object(main, "PROJECT_PATCH_SAVE_DELAY", 0):
+            result = self.patch('p.turtcd', self.revision, [{"op": "add", "path": "/blocks/-", "value": {"id": "b2"}}]).get_json()
+            self.addCleanup(self.documents.flush, force=True)
+            self.assertFalse(result["saved"])
+            # Пока изменения не записаны, load-file отдаёт их из памяти
+            loaded = self.load('p.turtcd')
+            self.assertEqual((loaded["revision"], len(loaded["project_data"]["blocks"])), (self.revision + 1, 2))
+            self.documents.flush()
+        self.assertEqual(self.disk()[0], self.revision + 1)
+
+
+class ProjectJournalTest(ProjectFolderTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(main.config, project_journal=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.revision = self.save('p', {"blocks": [], "connections": []})["revision"]
+        self.states = [self.load('p.turtcd')["project_data"]]
+        for i in range(5):
+            response = self.patch('p.turtcd', self.revision + i, [{"op": "add", "path": "/blocks/-", "value": {"id": f"b{i}"}}])
+            self.assertEqual(response.get_json(), {"status": "success", "revision": self.revision + i + 1, "saved": True})
+            self.states.append(self.load('p.turtcd')["project_data"])
+        self.journal = self.documents.journal_path('p.turtcd')
+
+    def reload(self):
+        # Новый ProjectDocuments - как перезапуск сервера: снимок плюс журнал
+        return main.ProjectDocuments(self.storage).read('p.turtcd')
+
+    def test_replay(self):
+        self.assertEqual(len(open(self.journal, 'rb').read().splitlines()), 5)
+        # Сам файл проекта не переписывался
+        data = main.decode_project(open(self.storage.path('p.turtcd'), 'rb').read())
+        self.assertEqual((data[main.PROJECT_REVISION_KEY], data["blocks"]), (self.revision, []))
+        self.assertEqual(self.reload(), (self.states[-1], self.revision + 5))
+
+    def test_torn_line_is_cut_off(self):
+        size = os.path.getsize(self.journal)
+        with open(self.journal, 'ab') as f:
+            f.write(b'{"revision": 7, "ops": [{"op": "add", "pa')
+        self.assertEqual(self.reload(), (self.states[-1], self.revision + 5))
+        self.assertEqual(os.path.getsize(self.journal), size)
+
+    def test_journal_of_other_snapshot_is_ignored(self):
+        # Журнал, у которого ревизии не продолжают снимок, не применяется
+        lines = open(self.journal, 'rb').read().splitlines(keepends=True)
+        with open(self.journal, 'wb') as f:
+            f.writelines(lines[:2] + lines[3:])
+        self.assertEqual(self.reload(), (self.states[2], self.revision + 2))
+
+    def test_history_and_read_at(self):
+        history = self.client.get('/api/project/history', query_string={"filename": "p.turtcd"}).get_json()
+        self.assertEqual((history["revision"], history["base_revision"]), (self.revision + 5, self.revision))
+        self.assertEqual([entry["revision"] for entry in history["entries"]], list(range(self.revision + 1, self.revision + 6)))
+        for i, state in enumerate(self.states):
+            self.assertEqual(self.load('p.turtcd', revision=self.revision + i)["project_data"], state)
+        self.assertEqual(self.load('p.turtcd', revision=self.revision + 6)["status"], "error")
+
+    def test_compaction(self):
+        with mock.patch.dict(main.config, project_journal_limit=1):
+            self.documents.flush()
+        self.assertFalse(os.path.exists(self.journal))
+        data = main.decode_project(open(self.storage.path('p.turtcd'), 'rb').read())
+        self.assertEqual(data.pop(main.PROJECT_REVISION_KEY), self.revision + 5)
+        self.assertEqual(data, self.states[-1])
+        self.assertEqual(self.reload(), (self.states[-1], self.revision + 5))
+
+    def test_save_file_replaces_journal(self):
+        result = self.save('p', {"blocks": [{"id": "new"}], "connections": []})
+        self.assertEqual(result["revision"], self.revision + 6)
+        self.assertFalse(os.path.exists(self.journal))
+        self.assertEqual(self.reload()[0]["blocks"], [{"id": "new"}])
+
+
+class FilenameTest(ProjectFolderTestCase):
+    def test_invalid_names_are_rejected(self):
+        for filename in ('../x.turtcd', 'sub/x.turtcd', 'x.json', '.index.turtcd'):
+            self.assertEqual(self.client.post('/api/project/load-file', json={"filename": filename}).status_code, 400)
+            self.assertEqual(self.patch(filename, 1, []).status_code, 400)
+
+    def test_start_ignores_project_outside_folder(self):
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside, ignore_errors=True)
+        with open(os.path.join(outside, 'x.turtcd'), 'w', encoding='utf-8') as f:
+            f.write('{"projectPath": "/secret"}')
+        self.save('p', {"blocks": [], "connections": [], "projectPath": "/project"})
+        relative = os.path.relpath(os.path.join(outside, 'x.turtcd'), self.folder)
+        with mock.patch.object(main.session_registry, 'start', return_value={"status": "success"}) as start:
+            self.client.post('/api/project/start', json={"code": "", "projectName": relative})
+            self.client.post('/api/project/start', json={"code": "", "projectName": "p.turtcd"})
+        self.assertEqual([call.args[2] for call in start.call_args_list], ['', '/project'])
+
+
+if __name__ == '__main__':
+    unittest.main()
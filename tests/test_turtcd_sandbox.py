@@ -0,0 +1,63 @@
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'runtime'))
+
+import turtcd_sandbox
+from turtcd_sandbox import PathPolicy
+
+
+class PathPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.project = os.path.join(self.root, 'project')
+        self.engine = os.path.join(self.root, 'engine')
+        self.policy = PathPolicy(project_path=self.project, engine_root=self.root, engine_folders=[self.engine])
+
+    def test_str_paths(self):
+        self.assertEqual(self.policy.classify(os.path.join(self.project, 'a.txt')), (True, False))
+        self.assertEqual(self.policy.classify(os.path.join(self.engine, 'a.txt')), (False, True))
+        self.assertEqual(self.policy.classify(os.path.join(self.root, 'other', 'a.txt')), (False, False))
+
+    def test_bytes_paths(self):
+        self.assertEqual(self.policy.classify(os.fsencode(os.path.join(self.project, 'a.txt'))), (True, False))
+        self.assertEqual(self.policy.classify(os.fsencode(os.path.join(self.engine, 'a.txt'))), (False, True))
+        self.assertEqual(self.policy.classify(os.fsencode(os.path.join(self.root, 'other', 'a.txt'))), (False, False))
+
+    def test_pathlike_paths(self):
+        self.assertEqual(self.policy.classify(Path(self.project) / 'a.txt'), (True, False))
+
+    def test_other_types_are_denied(self):
+        for filepath in (3, None, ['a.txt'], True):
+            self.assertEqual(self.policy.classify(filepath), (True, True))
+
+    def test_standard_fds_are_allowed(self):
+        for fd in (0, 1, 2):
+            self.assertEqual(self.policy.classify(fd), (False, False))
+
+    def test_limited_mode_fds(self):
+        old_mode, old_policy = turtcd_sandbox._safe_mode, turtcd_sandbox._policy
+        turtcd_sandbox._safe_mode, turtcd_sandbox._policy = 'limited', self.policy
+        try:
+            self.assertTrue(turtcd_sandbox._check_file_access(1, 'open'))
+            with self.assertRaises(PermissionError):
+                turtcd_sandbox._check_file_access(5, 'open')
+        finally:
+            turtcd_sandbox._safe_mode, turtcd_sandbox._policy = old_mode, old_policy
+
+    def test_limited_mode_denies_bytes_path_into_project(self):
+        old_mode, old_policy = turtcd_sandbox._safe_mode, turtcd_sandbox._policy
+        turtcd_sandbox._safe_mode, turtcd_sandbox._policy = 'limited', self.policy
+        try:
+            with self.assertRaises(PermissionError):
+                turtcd_sandbox._check_file_access(os.fsencode(os.path.join(self.project, 'a.txt')), 'open')
+            self.assertTrue(turtcd_sandbox._check_file_access(os.fsencode(os.path.join(self.root, 'other', 'a.txt')), 'open'))
+        finally:
+            turtcd_sandbox._safe_mode, turtcd_sandbox._policy = old_mode, old_policy
+
+
+if __name__ == '__main__':
+    unittest.main()